@@ -1,11 +1,23 @@
 __version__ = '0.5.2'
 
 
-from battenberg.core import Battenberg
+from battenberg.core import (
+    Battenberg,
+    BatchInstaller,
+    BatchUpgrader,
+    InstallResult,
+    MergeTargetResult,
+    UpgradeResult
+)
 from battenberg.utils import construct_keypair
 
 
 __all__ = [
     Battenberg,
+    BatchInstaller,
+    BatchUpgrader,
+    InstallResult,
+    MergeTargetResult,
+    UpgradeResult,
     construct_keypair
 ]
@@ -1,12 +1,29 @@
 import os
 import sys
+import json
 import logging
-import subprocess
-from typing import Optional
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, IO, List, Optional, Sequence, Tuple
 import click
 
-from battenberg.core import Battenberg
-from battenberg.utils import open_repository, open_or_init_repository
+from battenberg.core import (
+    Battenberg,
+    BatchInstaller,
+    BatchUpgrader,
+    UpgradeResult,
+    INSTALL_SUCCESS,
+    UPGRADE_CONFLICT,
+    UPGRADE_ERROR,
+    UPGRADE_NO_CHANGES,
+    UPGRADE_SUCCESS
+)
+from battenberg.profiling import PhaseTimer
+from battenberg.progress import Progress
+from battenberg.render_cache import DEFAULT_MAX_SIZE, RenderCache
+from battenberg.shared_objects import SharedObjectStore
+from battenberg.template_mirror import TemplateMirror
+from battenberg.utils import init_render_worker, open_repository, open_or_init_repository
 from battenberg.errors import MergeConflictException
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))  # noqa: E402
@@ -33,8 +50,80 @@ logger.addHandler(handler)
     is_flag=True,
     help='Enables the debug logging.'
 )
+@click.option(
+    '--cache-dir',
+    default=None,
+    envvar='BATTENBERG_CACHE_DIR',
+    help='Directory used to cache rendered templates between runs, disabled if not set.',
+    type=click.Path(file_okay=False)
+)
+@click.option(
+    '--cache-size',
+    default=DEFAULT_MAX_SIZE // (1024 * 1024),
+    show_default=True,
+    help='Maximum size of the render cache in megabytes.',
+    type=click.IntRange(min=0)
+)
+@click.option(
+    '--mirror-dir',
+    default=None,
+    envvar='BATTENBERG_MIRROR_DIR',
+    help='Directory holding local mirrors of remote templates to render from instead of cloning.',
+    type=click.Path(file_okay=False)
+)
+@click.option(
+    '--offline',
+    default=False,
+    is_flag=True,
+    help='Only fetch template mirrors when the requested checkout is not already mirrored.'
+)
+@click.option(
+    '--shared-objects-dir',
+    default=None,
+    envvar='BATTENBERG_SHARED_OBJECTS_DIR',
+    help='Directory holding object stores shared by every repository of a template, which '
+         'template trees written without a worktree are stored in.',
+    type=click.Path(file_okay=False)
+)
+@click.option(
+    '--render-jobs',
+    default=None,
+    envvar='BATTENBERG_RENDER_JOBS',
+    help='Render template files across this many processes instead of one at a time.',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--render-memo',
+    default=False,
+    is_flag=True,
+    help='Reuse the rendered files of template files which are unchanged since the last render.'
+)
+@click.option(
+    '--profile',
+    default=False,
+    is_flag=True,
+    help='Print how long each phase of an install or upgrade took to stderr.'
+)
+@click.option(
+    '--profile-output',
+    default=None,
+    help='Write how long each phase of an install or upgrade took to this file as JSON.',
+    type=click.File('w')
+)
+@click.option(
+    '--progress',
+    'progress_output',
+    default=None,
+    help='Stream progress events of an install or upgrade to this file, or "-" for stdout, as '
+         'newline-delimited JSON.',
+    type=click.File('w')
+)
 @click.pass_context
-def main(ctx, o: str, verbose: bool):
+def main(ctx, o: str, verbose: bool, cache_dir: Optional[str], cache_size: int,
+         mirror_dir: Optional[str], offline: bool, shared_objects_dir: Optional[str],
+         render_jobs: Optional[int],
+         render_memo: bool, profile: bool,
+         profile_output: Optional[IO[str]], progress_output: Optional[IO[str]]):
     """
     \f
 
@@ -43,16 +132,79 @@ def main(ctx, o: str, verbose: bool):
         ctx -- CLI context.
         o -- Path where to output battenberg to.
         verbose -- Enables debug logging
+        cache_dir -- Where to cache rendered templates.
+        cache_size -- Maximum size of the render cache in megabytes.
+        mirror_dir -- Where to mirror remote templates.
+        offline -- Avoid fetching template mirrors whenever possible.
+        shared_objects_dir -- Where to share template objects between repositories.
+        render_jobs -- How many processes to render template files with.
+        render_memo -- Reuse previously rendered files of unchanged template files.
+        profile -- Print a per-phase timing breakdown.
+        profile_output -- Where to write the per-phase timing breakdown as JSON.
+        progress_output -- Where to stream progress events as newline-delimited JSON.
     """
     ctx.obj = dict()
     ctx.obj.update({
         'target': o,
-        'verbose': verbose
+        'verbose': verbose,
+        'cache_dir': cache_dir,
+        'cache_size': cache_size,
+        'mirror_dir': mirror_dir,
+        'offline': offline,
+        'shared_objects_dir': shared_objects_dir,
+        'render_jobs': render_jobs,
+        'render_memo': render_memo,
+        'timer': None,
+        'progress': None
     })
 
     level = logging.DEBUG if verbose else logging.INFO
     logger.setLevel(level)
 
+    if profile or profile_output:
+        timer = ctx.obj['timer'] = PhaseTimer()
+
+        def report_profile():
+            if not timer.phases:
+                return
+            if profile:
+                click.echo(timer.format(), err=True)
+            if profile_output:
+                json.dump(timer.report(), profile_output, indent=2)
+
+        # Report once the subcommand has finished, even if it failed.
+        ctx.call_on_close(report_profile)
+
+    if progress_output:
+        def write_event(event: Dict[str, Any]):
+            progress_output.write(json.dumps(event, sort_keys=True) + '\n')
+            # Flush every event so orchestration can react to them as they happen.
+            progress_output.flush()
+
+        ctx.obj['progress'] = Progress([write_event])
+
+
+# The upgrade options which are relevant when only planning an upgrade.
+PLAN_KWARGS = ('checkout', 'no_input', 'merge_target', 'context_file', 'bare')
+# The upgrade options which are relevant when grouping repositories by their template context.
+GROUP_KWARGS = ('checkout', 'merge_target', 'context_file', 'bare')
+
+
+def _battenberg_kwargs(obj: Dict[str, Any]) -> Dict[str, Any]:
+    """Constructs the shared Battenberg options from the CLI context."""
+    render_cache = None
+    if obj.get('cache_dir'):
+        render_cache = RenderCache(obj['cache_dir'], obj['cache_size'] * 1024 * 1024)
+    template_mirror = None
+    if obj.get('mirror_dir'):
+        template_mirror = TemplateMirror(obj['mirror_dir'], offline=obj.get('offline', False))
+    shared_objects = None
+    if obj.get('shared_objects_dir'):
+        shared_objects = SharedObjectStore(obj['shared_objects_dir'])
+    return {'render_cache': render_cache, 'template_mirror': template_mirror,
+            'shared_objects': shared_objects, 'render_jobs': obj.get('render_jobs'),
+            'render_memo': obj.get('render_memo', False)}
+
 
 @main.command()
 @click.argument('template')
@@ -70,6 +222,18 @@ def main(ctx, o: str, verbose: bool):
     '--no-input', is_flag=True,
     help='Do not prompt for parameters and only use cookiecutter.json file content',
 )
+@click.option(
+    '--worktree/--no-worktree',
+    'use_worktree',
+    default=True,
+    help='Whether to stage the template in a temporary worktree or write it directly to the '
+         'object database'
+)
+@click.option(
+    '--in-memory',
+    is_flag=True,
+    help='Merge the template in memory, only updating the changed paths of the working directory'
+)
 @click.pass_context
 def install(ctx, template: str, initial_branch: Optional[str], **kwargs):
     """Create a new copy from the TEMPLATE repository.
@@ -77,10 +241,83 @@ def install(ctx, template: str, initial_branch: Optional[str], **kwargs):
     TEMPLATE is expected to be the URL of a git repository.
     """
 
-    battenberg = Battenberg(open_or_init_repository(ctx.obj['target'], template, initial_branch))
+    battenberg_kwargs = _battenberg_kwargs(ctx.obj)
+    template_mirror = battenberg_kwargs['template_mirror']
+    repo = open_or_init_repository(
+        ctx.obj['target'], template, initial_branch,
+        mirror_path=template_mirror.mirror_path(template) if template_mirror else None)
+    battenberg = Battenberg(repo, timer=ctx.obj.get('timer'), progress=ctx.obj.get('progress'),
+                            **battenberg_kwargs)
     battenberg.install(template, **kwargs)
 
 
+@main.command('install-many')
+@click.argument('template')
+@click.argument('manifest', type=click.File('r'))
+@click.option(
+    '--jobs',
+    '-j',
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help='Maximum number of distinct template contexts to render and install concurrently',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--initial-branch',
+    help='The initial branch name to use when creating new repos',
+    default=None
+)
+@click.option(
+    '--checkout',
+    help='branch, tag or commit to checkout from the remote template',
+    default=None
+)
+@click.pass_context
+def install_many(ctx, template: str, manifest: IO[str], jobs: int, **kwargs):
+    """Create many new copies of the TEMPLATE repository.
+
+    MANIFEST is a JSON file, or "-" for stdin, listing the copies to create as objects with a
+    "target" path, relative to -O, and optionally a "context" of answers overriding the template
+    defaults. Template questions are never prompted for. Copies sharing a context are installed
+    from a single render without any worktree.
+    """
+
+    try:
+        targets = [(os.path.join(ctx.obj['target'], entry['target']), entry.get('context'))
+                   for entry in json.load(manifest)]
+    except (ValueError, TypeError, KeyError) as e:
+        raise click.BadParameter(f'Expected a JSON list of targets ({e})', param_hint='MANIFEST')
+
+    battenberg_kwargs = _battenberg_kwargs(ctx.obj)
+    # Nothing was rendered into new repositories before.
+    battenberg_kwargs.pop('render_memo')
+    results = BatchInstaller(targets, timer=ctx.obj.get('timer'), **battenberg_kwargs).install(
+        template, jobs=jobs, **kwargs)
+
+    failures = 0
+    for path, status, message, seconds in results:
+        if status != INSTALL_SUCCESS:
+            failures += 1
+        click.echo(f'{status}: {path} [{seconds:.2f}s]' + (f' ({message})' if message else ''))
+
+    click.echo(f'Installed {len(results) - failures}/{len(results)} repositories')
+    if failures:
+        sys.exit(1)  # Ensure we exit with a failure code.
+
+
+CONFLICT_FORMAT_TEXT = 'text'
+CONFLICT_FORMAT_JSON = 'json'
+
+
+def _format_conflicts(conflicts: List[Dict[str, Any]]) -> str:
+    """Formats conflicts, as described by battenberg.utils.describe_conflicts, for humans."""
+    lines = ['Unmerged paths:']
+    width = max([len(conflict['type']) for conflict in conflicts] + [0])
+    for conflict in conflicts:
+        lines.append(f"  {conflict['type'] + ':':<{width + 1}} {conflict['path']}")
+    return '\n'.join(lines)
+
+
 @main.command()
 @click.option(
     '--checkout',
@@ -89,8 +326,10 @@ def install(ctx, template: str, initial_branch: Optional[str], **kwargs):
 )
 @click.option(
     '--merge-target',
-    help='A branch that the upgrade should be merged into',
-    default=None
+    'merge_targets',
+    help='A branch that the upgrade should be merged into, repeat to merge one render of the '
+         'template into many branches',
+    multiple=True
 )
 @click.option(
     '--context-file',
@@ -103,18 +342,253 @@ def install(ctx, template: str, initial_branch: Optional[str], **kwargs):
     is_flag=True,
     help='Do not prompt for parameters and only use .cookiecutter.json file content',
 )
+@click.option(
+    '--worktree/--no-worktree',
+    'use_worktree',
+    default=True,
+    help='Whether to stage the template in a temporary worktree or write it directly to the '
+         'object database'
+)
+@click.option(
+    '--in-memory',
+    is_flag=True,
+    help='Merge the template in memory, only updating the changed paths of the working directory'
+)
+@click.option(
+    '--bare',
+    is_flag=True,
+    help='Upgrade entirely within the object database, never reading or writing the working '
+         'directory'
+)
+@click.option(
+    '--output-branch',
+    help='A branch to write the upgrade merge commit to instead of the merge target',
+    default=None
+)
+@click.option(
+    '--persistent-worktree',
+    is_flag=True,
+    help='Keep the worktree the template is staged in between upgrades instead of recreating it'
+)
+@click.option(
+    '--plan',
+    is_flag=True,
+    help='Only report the impact of the upgrade as JSON, without writing any refs, commits or '
+         'checkouts'
+)
+@click.option(
+    '--conflict-format',
+    default=CONFLICT_FORMAT_TEXT,
+    show_default=True,
+    help='How to report any conflicts preventing the upgrade from being merged',
+    type=click.Choice([CONFLICT_FORMAT_TEXT, CONFLICT_FORMAT_JSON])
+)
 @click.pass_context
-def upgrade(ctx, **kwargs):
+def upgrade(ctx, merge_targets: Tuple[str, ...], plan: bool, conflict_format: str, **kwargs):
     """Upgrade a existing copy of a template."""
 
+    if len(merge_targets) > 1:
+        if plan:
+            raise click.BadParameter('Only a single merge target can be planned.',
+                                     param_hint='--merge-target')
+        kwargs['merge_target'] = list(merge_targets)
+    else:
+        kwargs['merge_target'] = merge_targets[0] if merge_targets else None
+
+    try:
+        battenberg = Battenberg(open_repository(ctx.obj['target']), timer=ctx.obj.get('timer'),
+                                progress=ctx.obj.get('progress'), **_battenberg_kwargs(ctx.obj))
+        if plan:
+            report = battenberg.plan_upgrade(**{key: kwargs[key] for key in PLAN_KWARGS})
+            click.echo(json.dumps(report, sort_keys=True))
+            return
+        results = battenberg.upgrade(**kwargs)
+    except MergeConflictException as e:
+        if conflict_format == CONFLICT_FORMAT_JSON:
+            click.echo(json.dumps({'message': str(e), 'conflicts': e.conflicts}, sort_keys=True))
+        else:
+            click.echo(_format_conflicts(e.conflicts))
+            click.echo('Cannot merge upgrade automatically, please manually resolve the conflicts')
+        sys.exit(1)  # Ensure we exit with a failure code.
+
+    if isinstance(kwargs['merge_target'], list):
+        failures = 0
+        for merge_target, status, message in results:
+            if status not in (UPGRADE_SUCCESS, UPGRADE_NO_CHANGES):
+                failures += 1
+            click.echo(f'{status}: {merge_target}' + (f' ({message})' if message else ''))
+
+        click.echo(f'Upgraded {len(results) - failures}/{len(results)} merge targets')
+        if failures:
+            sys.exit(1)  # Ensure we exit with a failure code.
+
+
+def _upgrade_repository(path: str, upgrade_kwargs: Dict[str, Any],
+                        battenberg_kwargs: Dict[str, Any]) -> UpgradeResult:
+    """
+    Upgrade a single repository, capturing the outcome rather than raising so one failure
+    does not abort the rest of the fleet. Defined at module level so it can be pickled into
+    worker processes.
+    """
+    try:
+        battenberg = Battenberg(open_repository(path), **battenberg_kwargs)
+        if not battenberg.upgrade(**upgrade_kwargs):
+            return UpgradeResult(path, UPGRADE_NO_CHANGES)
+    except MergeConflictException as e:
+        return UpgradeResult(path, UPGRADE_CONFLICT, str(e))
+    except (Exception, SystemExit) as e:
+        # Hook failures surface as SystemExit from Battenberg._render.
+        return UpgradeResult(path, UPGRADE_ERROR, str(e) or type(e).__name__)
+    return UpgradeResult(path, UPGRADE_SUCCESS)
+
+
+def _upgrade_batch(paths: List[str], upgrade_kwargs: Dict[str, Any],
+                   battenberg_kwargs: Dict[str, Any]) -> List[UpgradeResult]:
+    """
+    Upgrade repositories sharing a template context with a single render.
+    """
+    # Batches never stage the template in a worktree.
+    batch_kwargs = {key: value for key, value in upgrade_kwargs.items()
+                    if key not in ('no_input', 'use_worktree', 'persistent_worktree')}
+    return BatchUpgrader(paths, **battenberg_kwargs).upgrade(**batch_kwargs)
+
+
+def _plan_repository(path: str, plan_kwargs: Dict[str, Any],
+                     battenberg_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Plan the upgrade of a single repository, reporting any error in place of the plan.
+    """
     try:
-        battenberg = Battenberg(open_repository(ctx.obj['target']))
-        battenberg.upgrade(**kwargs)
-    except MergeConflictException:
-        # Just run "git status" in a subprocess so we don't have to re-implement the formatting
-        # logic atop pygit2.
-        completed_process = subprocess.run(['git', 'status'], stdout=subprocess.PIPE,
-                                           stderr=subprocess.STDOUT)
-        click.echo(completed_process.stdout.decode('utf-8'))
-        click.echo('Cannot merge upgrade automatically, please manually resolve the conflicts')
+        battenberg = Battenberg(open_repository(path), **battenberg_kwargs)
+        return battenberg.plan_upgrade(**plan_kwargs)
+    except (Exception, SystemExit) as e:
+        return {'repository': path, 'error': str(e) or type(e).__name__}
+
+
+def _map_repositories(func: Callable, repositories: Sequence[Any], jobs: int,
+                      *args: Any) -> List[Any]:
+    """
+    Apply "func" to each repository path, or group of paths, along with "args", using a pool of
+    "jobs" processes.
+    """
+    if jobs == 1:
+        # Avoid the process pool overhead when running serially.
+        return [func(path, *args) for path in repositories]
+
+    with tempfile.TemporaryDirectory() as clone_dir, \
+            ProcessPoolExecutor(max_workers=min(jobs, len(repositories)),
+                                initializer=init_render_worker,
+                                initargs=(clone_dir,)) as executor:
+        return list(executor.map(func, repositories, *[[arg] * len(repositories) for arg in args]))
+
+
+@main.command('upgrade-many')
+@click.argument('repositories', nargs=-1, required=True, type=click.Path())
+@click.option(
+    '--jobs',
+    '-j',
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help='Maximum number of repositories to upgrade concurrently',
+    type=click.IntRange(min=1)
+)
+@click.option(
+    '--checkout',
+    help='branch, tag or commit to checkout from the remote template',
+    default=None
+)
+@click.option(
+    '--merge-target',
+    help='A branch that the upgrade should be merged into',
+    default=None
+)
+@click.option(
+    '--context-file',
+    default='.cookiecutter.json',
+    help='Path where we can find the output of the cookiecutter template context',
+    type=click.Path()
+)
+@click.option(
+    '--worktree/--no-worktree',
+    'use_worktree',
+    default=True,
+    help='Whether to stage the template in a temporary worktree or write it directly to the '
+         'object database'
+)
+@click.option(
+    '--in-memory',
+    is_flag=True,
+    help='Merge the template in memory, only updating the changed paths of the working directory'
+)
+@click.option(
+    '--bare',
+    is_flag=True,
+    help='Upgrade entirely within the object database, never reading or writing the working '
+         'directory'
+)
+@click.option(
+    '--output-branch',
+    help='A branch to write the upgrade merge commit to instead of the merge target',
+    default=None
+)
+@click.option(
+    '--persistent-worktree',
+    is_flag=True,
+    help='Keep the worktree the template is staged in between upgrades instead of recreating it'
+)
+@click.option(
+    '--plan',
+    is_flag=True,
+    help='Only report the impact of the upgrade as JSON, without writing any refs, commits or '
+         'checkouts'
+)
+@click.option(
+    '--dedupe',
+    is_flag=True,
+    help='Render the template once for all repositories sharing the same template context and '
+         'write it into each of them without a worktree'
+)
+@click.pass_context
+def upgrade_many(ctx, repositories: Tuple[str, ...], jobs: int, plan: bool, dedupe: bool,
+                 **kwargs):
+    """Upgrade many existing copies of templates in parallel.
+
+    REPOSITORIES are paths to repositories previously installed with battenberg. Template
+    questions are never prompted for, the answers are always read from each repository's
+    context file. With --plan a JSON report is printed per line for each repository instead.
+    With --dedupe repositories sharing a template context are upgraded together from one render.
+    """
+
+    upgrade_kwargs = dict(kwargs, no_input=True)
+    battenberg_kwargs = _battenberg_kwargs(ctx.obj)
+
+    if plan:
+        plan_kwargs = {key: upgrade_kwargs[key] for key in PLAN_KWARGS}
+        reports = _map_repositories(_plan_repository, repositories, jobs, plan_kwargs,
+                                    battenberg_kwargs)
+        for report in reports:
+            click.echo(json.dumps(report, sort_keys=True))
+        if any('error' in report for report in reports):
+            sys.exit(1)  # Ensure we exit with a failure code.
+        return
+
+    if dedupe:
+        groups = BatchUpgrader(repositories, **battenberg_kwargs).group(
+            **{key: upgrade_kwargs[key] for key in GROUP_KWARGS})
+        batches = _map_repositories(_upgrade_batch, groups, jobs, upgrade_kwargs,
+                                    battenberg_kwargs)
+        upgraded = {result.repository: result for batch in batches for result in batch}
+        results = [upgraded[path] for path in repositories]
+    else:
+        results = _map_repositories(_upgrade_repository, repositories, jobs, upgrade_kwargs,
+                                    battenberg_kwargs)
+
+    failures = 0
+    for path, status, message in results:
+        if status not in (UPGRADE_SUCCESS, UPGRADE_NO_CHANGES):
+            failures += 1
+        click.echo(f'{status}: {path}' + (f' ({message})' if message else ''))
+
+    click.echo(f'Upgraded {len(results) - failures}/{len(results)} repositories')
+    if failures:
         sys.exit(1)  # Ensure we exit with a failure code.
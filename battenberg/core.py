@@ -2,38 +2,108 @@ import sys
 import os
 import json
 import logging
-import shutil
+import queue
 import tempfile
-from typing import Any, Dict, Optional
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from typing import (
+    Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+)
 
 from pygit2 import (
-    RemoteCallbacks,
+    Commit,
+    GitError,
+    Object,
+    Oid,
     Repository,
+    Tree,
+    GIT_CHECKOUT_FORCE,
+    GIT_DELTA_ADDED,
+    GIT_DELTA_DELETED,
     GIT_MERGE_ANALYSIS_UP_TO_DATE,
     GIT_MERGE_ANALYSIS_FASTFORWARD,
-    GIT_MERGE_ANALYSIS_NORMAL
+    GIT_MERGE_ANALYSIS_NORMAL,
+    GIT_STATUS_CURRENT,
+    GIT_STATUS_IGNORED
 )
+from cookiecutter.config import get_user_config
 from cookiecutter.main import cookiecutter
 from cookiecutter.exceptions import FailedHookException
+from cookiecutter.repository import is_repo_url
 from battenberg.errors import (
     BattenbergException,
     MergeConflictException,
+    RepositoryEmptyException,
     TemplateConflictException,
     TemplateNotFoundException
 )
-from battenberg.temporary_worktree import TemporaryWorktree
-from battenberg.utils import construct_keypair
+from battenberg.parallel_render import parallel_rendering
+from battenberg.profiling import PhaseTimer
+from battenberg.progress import (
+    EVENT_MERGED,
+    EVENT_RENDERED,
+    EVENT_RESULT,
+    EVENT_STAGED,
+    MERGE_CONFLICT,
+    MERGE_MERGED,
+    MERGE_UP_TO_DATE,
+    Progress
+)
+from battenberg.render_cache import RenderCache, canonicalize_context
+from battenberg.render_memo import RenderMemo
+from battenberg.shared_objects import SharedObjectStore
+from battenberg.template_mirror import TemplateMirror
+from battenberg.temporary_worktree import PersistentWorktree, TemporaryWorktree
+from battenberg.utils import (
+    Blobs,
+    construct_keypair,
+    copy_tree_objects,
+    create_tree_from_directory,
+    describe_conflicts,
+    init_render_worker,
+    is_same_render,
+    link_tree,
+    list_files,
+    open_or_init_repository,
+    open_repository,
+    repository_lock,
+    resolve_remote_commit,
+    stage_paths
+)
 
 
 WORKTREE_NAME = 'templating'
+PERSISTENT_WORKTREE_NAME = 'templating-persistent'
 TEMPLATE_BRANCH = 'template'
 logger = logging.getLogger(__name__)
 
 
 class Battenberg:
 
-    def __init__(self, repo: Repository):
+    def __init__(self, repo: Repository, render_cache: Optional[RenderCache] = None,
+                 template_mirror: Optional[TemplateMirror] = None,
+                 timer: Optional[PhaseTimer] = None, progress: Optional[Progress] = None,
+                 render_jobs: Optional[int] = None, render_memo: bool = False,
+                 shared_objects: Optional[SharedObjectStore] = None):
         self.repo = repo
+        self.render_cache = render_cache
+        self.template_mirror = template_mirror
+        # How many processes render template files in parallel, cookiecutter's own single
+        # threaded rendering is used if not set.
+        self.render_jobs = render_jobs
+        # Whether to reuse the blobs of template files which rendered the same before.
+        self.render_memo = render_memo
+        # Where template trees written straight to the object database are stored, shared by
+        # every repository of the template, rather than in the repo itself.
+        self.shared_objects = shared_objects
+        self.timer = timer or PhaseTimer()
+        self.progress = progress or Progress()
+        # Timers and progress may be shared by many instances, only publish each phase once.
+        if self.progress.phase_hook not in self.timer.hooks:
+            self.timer.add_hook(self.progress.phase_hook)
 
     def is_installed(self) -> bool:
         """Determines in the repo is already using battenberg.
@@ -47,39 +117,313 @@ class Battenberg:
         # First try to pull it from the remote origin/TEMPLATE_BRANCH
         keypair = construct_keypair()
         self.repo.remotes['origin'].fetch([TEMPLATE_BRANCH],
-                                          callbacks=RemoteCallbacks(credentials=keypair))
+                                          callbacks=self.progress.remote_callbacks(keypair))
         self.repo.references.create(
             f'refs/heads/{TEMPLATE_BRANCH}',
             self.repo.references.get(f'refs/remotes/origin/{TEMPLATE_BRANCH}').target
         )
 
-    def _cookiecut(self, cookiecutter_kwargs: dict, worktree: TemporaryWorktree):
-        with tempfile.TemporaryDirectory() as tmpdir:
-            logger.debug(f"Cookiecutting {cookiecutter_kwargs['template']} into {tmpdir}")
+    def _uses_template_mirror(self, template: str) -> bool:
+        return self.template_mirror is not None and is_repo_url(template)
+
+    def _render_cache_key(self, cookiecutter_kwargs: dict) -> Optional[str]:
+        if self.render_cache is None or not cookiecutter_kwargs.get('no_input'):
+            # Answers given interactively can't be known upfront.
+            return None
+
+        template = cookiecutter_kwargs['template']
+        if not is_repo_url(template):
+            # Local directories have no commit to key on and may change in place.
+            return None
+
+        checkout = cookiecutter_kwargs.get('checkout')
+        if self._uses_template_mirror(template):
+            template_commit = self.template_mirror.resolve(template, checkout)
+        else:
             try:
-                cookiecutter(
-                    replay=False,
-                    overwrite_if_exists=True,
-                    output_dir=tmpdir,
-                    **cookiecutter_kwargs
-                )
-            except FailedHookException as e:
-                # Suppress stacktrace for known hook error to ensure it is easy for user to diget.
-                logging.error(e)
-                sys.exit(1)
+                template_commit = resolve_remote_commit(self.repo, template, checkout)
+            except GitError as e:
+                # Listing the remote goes through pygit2's own credentials rather than the user's
+                # git configuration which cookiecutter clones with, so it may fail where cloning
+                # wouldn't.
+                logger.debug(f'Could not list the references of {template}: {e}')
+                template_commit = None
+        if template_commit is None:
+            logger.debug(f'Could not resolve {template}@{checkout}, skipping the render cache.')
+            return None
+
+        return RenderCache.key(
+            template,
+            checkout,
+            str(template_commit),
+            cookiecutter_kwargs.get('extra_context'),
+            get_user_config()['default_context']
+        )
+
+    def _render_memo(self) -> Optional[RenderMemo]:
+        return RenderMemo(self.repo) if self.render_memo else None
+
+    @contextmanager
+    def _render(self, cookiecutter_kwargs: dict, dir: Optional[str] = None,
+                memo: Optional[RenderMemo] = None) -> Iterator[Tuple[str, bool]]:
+        """Renders the template, yielding the rendered project directory and whether it came from
+        the render cache. Cached renders are shared and must not be modified.
+
+        Fresh renders are written to a temporary directory within "dir", if given, so they can be
+        renamed rather than copied into place on the same filesystem. Files whose blob "memo"
+        already knows are left out of the rendered directory and recorded in its "hits"."""
+        template = cookiecutter_kwargs['template']
+        if self._uses_template_mirror(template):
+            callbacks = None
+            if self.progress.enabled:
+                callbacks = self.progress.remote_callbacks(construct_keypair())
+            with self.timer.phase('mirror'):
+                self.template_mirror.update(template, cookiecutter_kwargs.get('checkout'),
+                                            callbacks)
+
+        with self.timer.phase('render_cache'):
+            cache_key = self._render_cache_key(cookiecutter_kwargs)
+            cached_path = self.render_cache.get(cache_key) if cache_key else None
+        if cached_path:
+            logger.debug(f'Reusing cached render of {template}')
+            self._emit_rendered(template, cached_path, cached=True)
+            yield cached_path, True
+            return
+
+        with tempfile.TemporaryDirectory(dir=dir) as tmpdir:
+            with ExitStack() as stack, self.timer.phase('cookiecutter'):
+                if self._uses_template_mirror(template):
+                    # Clone from the local mirror instead of the network.
+                    stack.enter_context(self.template_mirror.redirect(template))
+                if cache_key:
+                    # Only complete renders may be cached.
+                    memo = None
+                if self.render_jobs or memo is not None:
+                    stack.enter_context(parallel_rendering(self.render_jobs or 1, memo))
+
+                logger.debug(f'Cookiecutting {template} into {tmpdir}')
+                try:
+                    cookiecutter(
+                        replay=False,
+                        overwrite_if_exists=True,
+                        output_dir=tmpdir,
+                        **cookiecutter_kwargs
+                    )
+                except FailedHookException as e:
+                    # Suppress stacktrace for known hook error to ensure it is easy for user to
+                    # diget.
+                    logging.error(e)
+                    sys.exit(1)
 
             # Cookiecutter guarantees a single top-level directory after templating.
-            logger.debug('Shifting directories down a level')
             top_level_dir = os.path.join(tmpdir, os.listdir(tmpdir)[0])
-            for f in os.listdir(top_level_dir):
-                shutil.move(os.path.join(top_level_dir, f), worktree.path)
+            self._emit_rendered(template, top_level_dir, cached=False)
+            if cache_key:
+                with self.timer.phase('render_cache'):
+                    self.render_cache.put(cache_key, top_level_dir)
+
+            yield top_level_dir, False
+
+    def _emit_rendered(self, template: str, rendered_path: str, cached: bool):
+        if self.progress.enabled:
+            files = sum(len(filenames) for _, _, filenames in os.walk(rendered_path))
+            self.progress.emit(EVENT_RENDERED, template=template, files=files, cached=cached)
+
+    def _emit_staged(self, tree: Oid, files: Optional[int] = None):
+        if not self.progress.enabled:
+            return
+        if files is None:
+            files = sum(1 for _ in self._walk_blobs(self.repo[tree]))
+        self.progress.emit(EVENT_STAGED, tree=str(tree), files=files)
+
+    def _walk_blobs(self, tree: Tree) -> Iterator[Object]:
+        for entry in tree:
+            if isinstance(entry, Tree):
+                yield from self._walk_blobs(entry)
+            else:
+                yield entry
+
+    def _cookiecut(self, cookiecutter_kwargs: dict, worktree: TemporaryWorktree,
+                   memo: Optional[RenderMemo] = None) -> List[str]:
+        """Renders the template into "worktree".
+
+        Returns:
+            The relative paths of the rendered files.
+        """
+        # Render next to the worktree so shifting the output into it is a rename, not a copy.
+        with self._render(cookiecutter_kwargs, dir=worktree.tmp, memo=memo) as \
+                (rendered_path, cached), \
+                self.timer.phase('shift'):
+            rendered_files = list_files(rendered_path)
+            if cached:
+                link_tree(rendered_path, worktree.path)
+                return rendered_files
+
+            logger.debug('Shifting directories down a level')
+            for f in os.listdir(rendered_path):
+                os.rename(os.path.join(rendered_path, f), os.path.join(worktree.path, f))
+            return rendered_files
+
+    def _create_template_tree(self, template: str, rendered_path: str,
+                              blobs: Optional[Blobs] = None) -> Oid:
+        if self.shared_objects is not None:
+            return self.shared_objects.write_tree(self.repo, template, rendered_path, blobs)
+        return create_tree_from_directory(self.repo, rendered_path, blobs)
+
+    def _import_template_tree(self, source: Repository, tree: Oid, template: str):
+        """Makes "tree", which was written by "source" for another repository, available."""
+        if self.shared_objects is not None:
+            self.shared_objects.attach(self.repo, template)
+        else:
+            copy_tree_objects(source, self.repo, tree)
+
+    def _write_template_tree(self, cookiecutter_kwargs: dict, plan: bool = False) -> Oid:
+        """Renders the template straight into the object database, bypassing any worktree or
+        index.
+
+        When only planning, the tree is written into the repository's own object database without
+        attaching any shared object store or recording any memoized renders."""
+        memo = None if plan else self._render_memo()
+        with self._render(cookiecutter_kwargs, memo=memo) as (rendered_path, _), \
+                self.timer.phase('stage'):
+            if plan:
+                tree = create_tree_from_directory(self.repo, rendered_path)
+            else:
+                tree = self._create_template_tree(cookiecutter_kwargs['template'], rendered_path,
+                                                  memo and memo.hits)
+            if memo is not None:
+                memo.record(tree)
+            logger.debug(f"Successfully wrote {cookiecutter_kwargs['template']} as tree {tree}.")
+            self._emit_staged(tree)
+            return tree
 
     def _get_context(self, context_file: str, base_path: str = None) -> Dict[str, Any]:
         with open(os.path.join(base_path or self.repo.workdir, context_file)) as f:
             return json.load(f)
 
-    def _merge_template_branch(self, message: str, merge_target: str = None):
-        branch = self.repo.lookup_branch(TEMPLATE_BRANCH)
+    def _get_context_from_revision(self, context_file: str, revision: str) -> Dict[str, Any]:
+        tree = self.repo.revparse_single(revision).peel(Commit).tree
+        return json.loads(tree[context_file].data)
+
+    def _check_paths_unmodified(self, paths: List[str]):
+        """Refuses to overwrite "paths" in the working directory or index when they differ from
+        HEAD, like a safe checkout would, other than ignored files."""
+        modified = []
+        for path in paths:
+            try:
+                status = self.repo.status_file(path)
+            except KeyError:
+                # Neither in HEAD, the index nor the working directory.
+                continue
+            if status not in (GIT_STATUS_CURRENT, GIT_STATUS_IGNORED):
+                modified.append(path)
+        if modified:
+            raise BattenbergException(
+                'Cannot merge the template, local changes to these files would be overwritten: '
+                f'{", ".join(modified)}')
+
+    def _merge_template_branch_in_memory(self, message: str, merge_target: str = None,
+                                         output_branch: str = None, update_workdir: bool = True,
+                                         template_commit: Optional[Oid] = None):
+        # Merge the commit this run produced, the branch may have moved on since.
+        template_commit = template_commit or self.repo.lookup_branch(TEMPLATE_BRANCH).target
+
+        if merge_target is not None:
+            # Create the merge target if needed but leave whatever is checked out alone.
+            merge_target_ref = f'refs/heads/{merge_target}'
+            if merge_target not in self.repo.listall_branches():
+                self.repo.branches.local.create(
+                    merge_target, self.repo.get(
+                        self.repo.head.target))
+        elif self.repo.head_is_unborn:
+            raise RepositoryEmptyException()
+        else:
+            merge_target_ref = self.repo.head.name
+
+        # Where the merge commit is written, by default the merge target itself.
+        output_ref = f'refs/heads/{output_branch}' if output_branch else merge_target_ref
+        update_workdir = update_workdir and not self.repo.is_bare
+        checked_out = (update_workdir and not self.repo.head_is_unborn
+                       and self.repo.head.name == output_ref)
+
+        target = self.repo.references[merge_target_ref].resolve().target
+        analysis, _ = self.repo.merge_analysis(template_commit, merge_target_ref)
+
+        if analysis & GIT_MERGE_ANALYSIS_UP_TO_DATE:
+            logger.info('The branch is already up to date, no need to merge.')
+            if output_ref != merge_target_ref:
+                self.repo.references.create(output_ref, target, force=True)
+            self.progress.emit(EVENT_MERGED, target=output_ref, status=MERGE_UP_TO_DATE,
+                               commit=str(target))
+
+        elif analysis & GIT_MERGE_ANALYSIS_FASTFORWARD or analysis & GIT_MERGE_ANALYSIS_NORMAL:
+            logger.debug('Merging template branch into target branch in memory.')
+            with self.timer.phase('merge_commits'):
+                index = self.repo.merge_commits(target, template_commit)
+
+            if index.conflicts is not None:
+                if update_workdir and output_branch is None:
+                    # Leave the conflicts in the working directory for the user to resolve.
+                    logger.debug('Found conflicts, falling back to merging in the worktree.')
+                    self._merge_template_branch(message, merge_target, template_commit)
+                    return
+                self.progress.emit(EVENT_MERGED, target=output_ref, status=MERGE_CONFLICT,
+                                   conflicts=describe_conflicts(index))
+                raise MergeConflictException(
+                    f'Cannot merge the template commit ({template_commit}) with '
+                    f'{merge_target_ref} ({target}).',
+                    describe_conflicts(index)
+                )
+
+            tree = index.write_tree(self.repo)
+
+            paths = []
+            if checked_out:
+                # Only touch the paths in the working directory (and index) which changed.
+                diff = self.repo[self.repo.head.target].tree.diff_to_tree(self.repo[tree])
+                paths = sorted({path for delta in diff.deltas
+                                for path in (delta.old_file.path, delta.new_file.path)})
+                self._check_paths_unmodified(paths)
+
+            with self.timer.phase('commit'):
+                if output_ref == merge_target_ref:
+                    oid = self.repo.create_commit(
+                        merge_target_ref,
+                        self.repo.default_signature,
+                        self.repo.default_signature,
+                        message,
+                        tree,
+                        [target, template_commit]
+                    )
+                else:
+                    oid = self.repo.create_commit(
+                        None,
+                        self.repo.default_signature,
+                        self.repo.default_signature,
+                        message,
+                        tree,
+                        [target, template_commit]
+                    )
+                    # Overwrite any output from previous runs so the branch is ready to push.
+                    self.repo.references.create(output_ref, oid, force=True)
+
+            if paths:
+                # The working directory catches up last, once the merge commit is in place. The
+                # paths were checked for local changes up front, so forcing only updates them.
+                with self.timer.phase('checkout'):
+                    self.repo.checkout_tree(self.repo[tree], paths=paths,
+                                            strategy=GIT_CHECKOUT_FORCE)
+
+            self.progress.emit(EVENT_MERGED, target=output_ref, status=MERGE_MERGED,
+                               commit=str(oid))
+            logger.debug('Successfully applied changes.')
+        else:
+            raise BattenbergException(
+                f'Unknown merge analysis result: {analysis}')
+
+    def _merge_template_branch(self, message: str, merge_target: str = None,
+                               template_commit: Optional[Oid] = None):
+        template_commit = template_commit or self.repo.lookup_branch(TEMPLATE_BRANCH).target
 
         merge_target_ref = 'HEAD'
         if merge_target is not None:
@@ -92,10 +436,12 @@ class Battenberg:
                         self.repo.head.target))
             self.repo.checkout(merge_target_ref)
 
-        analysis, _ = self.repo.merge_analysis(branch.target, merge_target_ref)
+        analysis, _ = self.repo.merge_analysis(template_commit, merge_target_ref)
 
         if analysis & GIT_MERGE_ANALYSIS_UP_TO_DATE:
             logger.info('The branch is already up to date, no need to merge.')
+            self.progress.emit(EVENT_MERGED, target=self.repo.head.name, status=MERGE_UP_TO_DATE,
+                               commit=str(self.repo.head.target))
 
         elif analysis & GIT_MERGE_ANALYSIS_FASTFORWARD or analysis & GIT_MERGE_ANALYSIS_NORMAL:
             # Ensure we're merging into the right
@@ -108,42 +454,277 @@ class Battenberg:
             #     "git merge --allow-unrelated-histories template"
             #
             logger.debug('Forcing merge of template branch into target branch.')
-            self.repo.merge(branch.target)
+            with self.timer.phase('merge_index'):
+                self.repo.merge(template_commit)
 
             # If there is a conflict we should error and let the user manually
             # resolve it.
             if self.repo.index.conflicts is not None:
+                self.progress.emit(EVENT_MERGED, target=self.repo.head.name,
+                                   status=MERGE_CONFLICT,
+                                   conflicts=describe_conflicts(self.repo.index))
                 raise MergeConflictException(
-                    f'Cannot merge the template commit ({branch.target}) with the current HEAD '
+                    f'Cannot merge the template commit ({template_commit}) with the current HEAD '
                     f'({self.repo.head}). Please resolve them manually and run \'git commit\' '
-                    'to merge'
+                    'to merge',
+                    describe_conflicts(self.repo.index)
                 )
 
-            # Stage all the changes for commit.
-            tree = self.repo.index.write_tree()
+            with self.timer.phase('commit'):
+                # Stage all the changes for commit.
+                tree = self.repo.index.write_tree()
 
-            # Add the commit back to the HEAD (normally the main branch unless --merge-target
-            # is passed).
-            self.repo.create_commit(
-                'HEAD',
-                self.repo.default_signature,
-                self.repo.default_signature,
-                message,
-                tree,
-                [self.repo.head.target, branch.target]
-            )
+                # Add the commit back to the HEAD (normally the main branch unless --merge-target
+                # is passed).
+                oid = self.repo.create_commit(
+                    'HEAD',
+                    self.repo.default_signature,
+                    self.repo.default_signature,
+                    message,
+                    tree,
+                    [self.repo.head.target, template_commit]
+                )
 
             # Ensure we're not keeping any lingering metadata state before trying to merge the tmp
             # worktree into the main HEAD.
-            self.repo.state_cleanup()
-            self.repo.checkout('HEAD')
+            with self.timer.phase('checkout'):
+                self.repo.state_cleanup()
+                self.repo.checkout('HEAD')
 
+            self.progress.emit(EVENT_MERGED, target=self.repo.head.name, status=MERGE_MERGED,
+                               commit=str(oid))
             logger.debug('Successfully applied changes.')
         else:
             raise BattenbergException(
                 f'Unknown merge analysis result: {analysis}')
 
-    def install(self, template: str, checkout: Optional[str] = None, no_input: bool = False):
+    def _worktree_name(self) -> str:
+        # Unique per run so concurrent runs on the same repo never share a worktree or its branch.
+        return f'{WORKTREE_NAME}-{uuid.uuid4().hex[:12]}'
+
+    def _install_in_worktree(self, cookiecutter_kwargs: dict) -> Oid:
+        # Create temporary worktree
+        with TemporaryWorktree(self.repo, self._worktree_name(), timer=self.timer) as worktree:
+            memo = self._render_memo()
+            rendered_files = self._cookiecut(cookiecutter_kwargs, worktree, memo)
+            logger.debug(
+                f"Successfully cookiecut {cookiecutter_kwargs['template']} into {worktree.path}.")
+
+            # Stage changes
+            with self.timer.phase('stage'):
+                tree = stage_paths(worktree.repo, rendered_files, memo and memo.hits)
+                if memo is not None:
+                    memo.record(tree)
+            self._emit_staged(tree, len(worktree.repo.index))
+            return tree
+
+    def _commit_template_install(self, tree: Oid) -> Oid:
+        """Creates the template branch from an orphaned commit of "tree".
+
+        Returns:
+            The id of the commit.
+
+        Raises:
+            TemplateConflictException: When another run created the template branch first.
+        """
+        with repository_lock(self.repo, TEMPLATE_BRANCH), self.timer.phase('commit'):
+            if self.is_installed():
+                raise TemplateConflictException()
+
+            oid = self.repo.create_commit(
+                None,
+                self.repo.default_signature,
+                self.repo.default_signature,
+                'Prepared template installation',
+                tree,
+                []
+            )
+            self.repo.create_branch(TEMPLATE_BRANCH, self.repo.get(oid))
+            return oid
+
+    def _merge_target_revision(self, merge_target: Optional[str] = None) -> str:
+        """The revision the merge target currently points to, new merge targets are created from
+        HEAD."""
+        if merge_target is not None and merge_target in self.repo.listall_branches():
+            return f'refs/heads/{merge_target}'
+        if self.repo.head_is_unborn:
+            raise RepositoryEmptyException()
+        return 'HEAD'
+
+    def _get_upgrade_cookiecutter_kwargs(self, checkout: Optional[str], no_input: bool,
+                                         merge_target: Optional[str], context_file: str,
+                                         bare: bool) -> Dict[str, Any]:
+        # Get last context used to apply template
+        if bare:
+            # Read the context from the merge target rather than the working directory.
+            context = self._get_context_from_revision(
+                context_file, self._merge_target_revision(merge_target))
+        else:
+            context = self._get_context(context_file)
+        logger.debug(f'Found context: {context}')
+        # Fetch template information, this is normally the git:// URL.
+        template = context['_template']
+        logger.debug(f'Found template: {template}')
+
+        return {
+            'template': template,
+            'checkout': checkout,
+            'extra_context': context,
+            'no_input': no_input
+        }
+
+    def _commit_template_upgrade(self, tree: Oid,
+                                 context_file: str = '.cookiecutter.json') -> Tuple[bool, Oid]:
+        """Commits "tree" onto the template branch unless it's identical to the branch already,
+        but for the output directory recorded in "context_file".
+
+        Concurrent runs on the same repo take turns, so each commit's parent is the branch as
+        left by the previous run.
+
+        Returns:
+            Whether a commit was created and the template commit holding "tree".
+        """
+        with repository_lock(self.repo, TEMPLATE_BRANCH):
+            branch = self.repo.lookup_branch(TEMPLATE_BRANCH)
+            if is_same_render(self.repo, tree, self.repo[branch.target].tree.id, context_file):
+                logger.debug('Rendered template is identical to the template branch.')
+                return False, branch.target
+
+            # Create commit on the template branch
+            with self.timer.phase('commit'):
+                oid = self.repo.create_commit(
+                    branch.name,
+                    self.repo.default_signature,
+                    self.repo.default_signature,
+                    'Prepared template upgrade',
+                    tree,
+                    [branch.target]
+                )
+            return True, oid
+
+    def _is_template_merged(self, merge_target: Optional[str] = None,
+                            template_commit: Optional[Oid] = None) -> bool:
+        """Determines whether the template branch, or "template_commit", was already merged into
+        the merge target."""
+        try:
+            merge_target_ref = self._merge_target_revision(merge_target)
+        except RepositoryEmptyException:
+            return False
+
+        template_commit = template_commit or self.repo.lookup_branch(TEMPLATE_BRANCH).target
+        analysis, _ = self.repo.merge_analysis(template_commit, merge_target_ref)
+        return bool(analysis & GIT_MERGE_ANALYSIS_UP_TO_DATE)
+
+    def _ensure_template_branch(self):
+        if self.is_installed():
+            return
+        try:
+            with repository_lock(self.repo, TEMPLATE_BRANCH), self.timer.phase('fetch'):
+                if not self.is_installed():
+                    self._fetch_remote_template()
+        except KeyError as e:
+            # Cannot find the origin remote branch.
+            logger.error(e)
+            raise TemplateNotFoundException() from e
+
+    def _check_bare_upgrade(self, merge_targets: List[Optional[str]],
+                            output_branch: Optional[str]):
+        """Refuses to upgrade the checked out branch of a repository with a working directory
+        bare, which would move the branch while leaving its index and working directory behind
+        for the next commit to silently revert the upgrade."""
+        if self.repo.is_bare or self.repo.head_is_unborn or output_branch is not None:
+            return
+
+        head = self.repo.head.name
+        for merge_target in merge_targets:
+            if merge_target is None or f'refs/heads/{merge_target}' == head:
+                raise BattenbergException(
+                    f'Cannot upgrade the checked out branch {self.repo.head.shorthand} bare, '
+                    'please use an output branch or merge target instead.')
+
+    def _merge_template_upgrade(self, template: str, changed: bool, merge_target: Optional[str],
+                                in_memory: bool, bare: bool, output_branch: Optional[str],
+                                template_commit: Optional[Oid] = None) -> bool:
+        if not changed and self._is_template_merged(merge_target, template_commit):
+            logger.info('The template has not changed, nothing to upgrade.')
+            return False
+
+        # Let's merge our changes into HEAD
+        message = f'Upgraded template \'{template}\''
+        with self.timer.phase('merge'):
+            if in_memory:
+                self._merge_template_branch_in_memory(message, merge_target, output_branch,
+                                                      update_workdir=not bare,
+                                                      template_commit=template_commit)
+            else:
+                self._merge_template_branch(message, merge_target, template_commit)
+        return True
+
+    def _merge_template_upgrades(self, template: str, changed: bool, merge_targets: List[str],
+                                 bare: bool, template_commit: Oid) -> List['MergeTargetResult']:
+        """Merges "template_commit" into each of "merge_targets" in memory, concurrently.
+
+        Each merge uses a repository handle of its own, only the merge target which is checked
+        out, if any, touches the working directory.
+        """
+        checked_out = None
+        if not self.repo.is_bare and not self.repo.head_is_unborn:
+            checked_out = self.repo.head.name
+
+        def merge(merge_target: str) -> MergeTargetResult:
+            battenberg = Battenberg(Repository(self.repo.path), progress=self.progress)
+            # Any other merge target merged as if bare, so conflicts are reported rather than
+            # checked out into the one working directory every merge shares.
+            workdir = f'refs/heads/{merge_target}' == checked_out
+            try:
+                if not battenberg._merge_template_upgrade(template, changed, merge_target, True,
+                                                          bare or not workdir, None,
+                                                          template_commit):
+                    return MergeTargetResult(merge_target, UPGRADE_NO_CHANGES)
+            except MergeConflictException as e:
+                return MergeTargetResult(merge_target, UPGRADE_CONFLICT, str(e))
+            except Exception as e:
+                return MergeTargetResult(merge_target, UPGRADE_ERROR, str(e) or type(e).__name__)
+            return MergeTargetResult(merge_target, UPGRADE_SUCCESS)
+
+        with self.timer.phase('merge'), \
+                ThreadPoolExecutor(min(len(merge_targets), os.cpu_count() or 1)) as executor:
+            return list(executor.map(merge, merge_targets))
+
+    def _upgrade_in_worktree(self, cookiecutter_kwargs: dict,
+                             persistent_worktree: bool = False) -> Oid:
+        """Renders and stages the template on top of the template branch in a worktree.
+
+        Returns:
+            The id of the staged tree.
+        """
+        with ExitStack() as stack:
+            # Create temporary EMPTY worktree, or empty the persistent one.
+            if persistent_worktree:
+                # There's only one persistent worktree, so concurrent runs take turns using it.
+                stack.enter_context(repository_lock(self.repo, PERSISTENT_WORKTREE_NAME))
+                worktree = PersistentWorktree(self.repo, PERSISTENT_WORKTREE_NAME,
+                                              timer=self.timer)
+            else:
+                worktree = TemporaryWorktree(self.repo, self._worktree_name(), timer=self.timer)
+            stack.enter_context(worktree)
+
+            # Detach HEAD at the template branch, which is only ever committed to under lock.
+            worktree.repo.set_head(worktree.repo.lookup_branch(TEMPLATE_BRANCH).target)
+
+            memo = self._render_memo()
+            rendered_files = self._cookiecut(cookiecutter_kwargs, worktree, memo)
+
+            # Stage changes, only hashing the files the template rendered.
+            with self.timer.phase('stage'):
+                tree = stage_paths(worktree.repo, rendered_files, memo and memo.hits)
+                if memo is not None:
+                    memo.record(tree)
+            self._emit_staged(tree, len(worktree.repo.index))
+            return tree
+
+    def install(self, template: str, checkout: Optional[str] = None, no_input: bool = False,
+                use_worktree: bool = True, in_memory: bool = False):
         """Creates a fresh template install within the supplied repo.
 
         Generates a template using the provided context, or invokes the questionnaire to elicit it.
@@ -155,6 +736,11 @@ class Battenberg:
                 the template repo.
             no_input: Whether to ask the user to answer the template questions again or take the
                 default answers from the templates "cookiecutter.json".
+            use_worktree: Whether to stage the template within a temporary worktree. Otherwise the
+                template commit is written directly into the object database.
+            in_memory: Whether to merge the template branch in memory, writing the merge commit
+                straight to the target branch and only updating the changed paths in the working
+                directory. Falls back to merging in the working directory on conflicts.
 
         Raises:
             MergeConflictException: Thrown when an upgrade results in merge conflicts between the
@@ -163,50 +749,35 @@ class Battenberg:
                 encounter this please run "battenberg upgrade" instead.
         """
 
-        # Assert template branch doesn't exist or raise conflict
-        if self.is_installed():
-            raise TemplateConflictException()
+        with self.timer.phase('install'):
+            # Assert template branch doesn't exist or raise conflict
+            if self.is_installed():
+                raise TemplateConflictException()
 
-        # Create temporary worktree
-        with TemporaryWorktree(self.repo, WORKTREE_NAME) as worktree:
             cookiecutter_kwargs = {
                 'template': template,
                 'checkout': checkout,
                 'no_input': no_input
             }
-            self._cookiecut(cookiecutter_kwargs, worktree)
-            logger.debug(
-                f"Successfully cookiecut {cookiecutter_kwargs['template']} into {worktree.path}.")
 
-            # Stage changes
-            worktree.repo.index.add_all()
-            worktree.repo.index.write()
-            tree = worktree.repo.index.write_tree()
+            if not use_worktree:
+                tree = self._write_template_tree(cookiecutter_kwargs)
+            else:
+                tree = self._install_in_worktree(cookiecutter_kwargs)
+            commit = self._commit_template_install(tree)
 
-            # Create an orphaned commit
-            oid = worktree.repo.create_commit(
-                None,
-                worktree.repo.default_signature,
-                worktree.repo.default_signature,
-                'Prepared template installation',
-                tree,
-                []
-            )
-            commit = self.repo.get(oid)
-
-            # Create a branch which target orphaned commit
-            branch = self.repo.create_branch(TEMPLATE_BRANCH, commit)
-
-            # Optionally, set worktree HEAD to this branch (useful for debugging)
-            # Optional ? Obviously the tmp worktree will be removed in __exit__
-            worktree.repo.set_head(branch.name)
-
-        # Let's merge our changes into HEAD
-        logger.debug('Merging changes into HEAD.')
-        self._merge_template_branch(f'Installed template \'{template}\'')
+            # Let's merge our changes into HEAD
+            logger.debug('Merging changes into HEAD.')
+            merge = (self._merge_template_branch_in_memory if in_memory
+                     else self._merge_template_branch)
+            with self.timer.phase('merge'):
+                merge(f'Installed template \'{template}\'', template_commit=commit)
 
     def upgrade(self, checkout: Optional[str] = None, no_input: bool = True,
-                merge_target: Optional[str] = None, context_file: str = '.cookiecutter.json'):
+                merge_target: Union[None, str, Sequence[str]] = None,
+                context_file: str = '.cookiecutter.json', use_worktree: bool = True,
+                in_memory: bool = False, bare: bool = False, output_branch: Optional[str] = None,
+                persistent_worktree: bool = False) -> Union[bool, List['MergeTargetResult']]:
         """Updates a repo using the found template context.
 
         Generates and applies any updates from the current repo state to the template state defined
@@ -219,65 +790,540 @@ class Battenberg:
             no_input: Whether to ask the user to answer the template questions again or take the
                 answers from the template context defined in "context_file".
             merge_target: A branch to checkout other than the current HEAD. Useful if you're
-                upgrading a project you do not directly own.
+                upgrading a project you do not directly own. Given a list of branches, the
+                template is rendered and committed once and then merged into each of them in
+                memory and concurrently, "in_memory" is implied and the context is read from the
+                first of them when upgrading bare.
             context_file: Where battenberg should look to read the template context.
+            use_worktree: Whether to stage the template within a temporary worktree. Otherwise the
+                template commit is written directly into the object database.
+            in_memory: Whether to merge the template branch in memory, writing the merge commit
+                straight to the target branch and only updating the changed paths in the working
+                directory. Falls back to merging in the working directory on conflicts.
+            bare: Whether to upgrade entirely within the object database without ever reading or
+                writing the working directory, the context is read from the merge target instead.
+                Always enabled for bare repositories. Otherwise the checked out branch can only be
+                upgraded bare into an output branch.
+            output_branch: A branch to write the merge commit to instead of the merge target,
+                overwriting it if it already exists. Implies "in_memory".
+            persistent_worktree: Whether to keep the worktree the template is staged in between
+                upgrades, so the repo only has to be checked out into it once.
+
+        Returns:
+            Whether anything was upgraded. False when the rendered template is identical to the
+            template branch which was already merged into the merge target, in which case no
+            commits are created and nothing is checked out. Given a list of merge targets, the
+            result of merging into each of them instead, with failures including merge
+            conflicts reported rather than raised.
 
         Raises:
             MergeConflictException: Thrown when an upgrade results in merge conflicts between the
                 template branch and the merge-target branch.
+            RepositoryEmptyException: When upgrading the HEAD of a bare repository which is unborn.
             TemplateNotFoundException: When the repo does not already contain a template branch. If
                 you encounter this please run "battenberg install" instead.
+            BattenbergException: When upgrading the checked out branch of a repository with a
+                working directory bare without an output branch.
         """
 
-        if not self.is_installed():
+        merge_targets = None
+        if merge_target is not None and not isinstance(merge_target, str):
+            # Merging into the same branch twice at once would race.
+            merge_targets = list(dict.fromkeys(merge_target))
+            if not merge_targets:
+                raise BattenbergException('At least one merge target is required.')
+            if output_branch is not None:
+                raise BattenbergException(
+                    'An output branch can only be used with a single merge target.')
+            merge_target = merge_targets[0]
+
+        if bare:
+            self._check_bare_upgrade(merge_targets or [merge_target], output_branch)
+
+        with self.timer.phase('upgrade'):
+            self._ensure_template_branch()
+
+            bare = bare or self.repo.is_bare
+            if bare:
+                use_worktree = False
+            in_memory = in_memory or bare or output_branch is not None
+
+            cookiecutter_kwargs = self._get_upgrade_cookiecutter_kwargs(
+                checkout, no_input, merge_target, context_file, bare)
+            template = cookiecutter_kwargs['template']
+
+            if not use_worktree:
+                tree = self._write_template_tree(cookiecutter_kwargs)
+            else:
+                tree = self._upgrade_in_worktree(cookiecutter_kwargs, persistent_worktree)
+            changed, commit = self._commit_template_upgrade(tree, context_file)
+
+            if merge_targets is not None:
+                return self._merge_template_upgrades(template, changed, merge_targets, bare,
+                                                     commit)
+            return self._merge_template_upgrade(template, changed, merge_target, in_memory, bare,
+                                                output_branch, commit)
+
+    def plan_upgrade(self, checkout: Optional[str] = None, no_input: bool = True,
+                     merge_target: Optional[str] = None,
+                     context_file: str = '.cookiecutter.json',
+                     bare: bool = False) -> Dict[str, Any]:
+        """Predicts the impact of an upgrade without performing it.
+
+        Renders the template, diffs it against the template branch and performs a virtual
+        three-way merge with the merge target to find which paths would conflict. No refs, commits
+        or checkouts are written, although the rendered files are stored as loose objects.
+
+        Args:
+            checkout: The new state to pull from the template, normally this will be a git tag on
+                the template repo.
+            no_input: Whether to ask the user to answer the template questions again or take the
+                answers from the template context defined in "context_file".
+            merge_target: A branch the upgrade would be merged into other than the current HEAD.
+            context_file: Where battenberg should look to read the template context.
+            bare: Whether to read the context from the merge target instead of the working
+                directory. Always enabled for bare repositories.
+
+        Returns:
+            A JSON serializable report of the paths the upgrade would add, modify and delete on
+            the template branch and the paths which would conflict with the merge target.
+
+        Raises:
+            TemplateNotFoundException: When the repo does not contain a template branch, nor has
+                already fetched it from the origin remote.
+        """
+        template_ref = self.repo.references.get(f'refs/heads/{TEMPLATE_BRANCH}') or \
+            self.repo.references.get(f'refs/remotes/origin/{TEMPLATE_BRANCH}')
+        if template_ref is None:
+            raise TemplateNotFoundException()
+        template_commit = self.repo[template_ref.target]
+
+        cookiecutter_kwargs = self._get_upgrade_cookiecutter_kwargs(
+            checkout, no_input, merge_target, context_file, bare or self.repo.is_bare)
+        tree = self.repo[self._write_template_tree(cookiecutter_kwargs, plan=True)]
+        if is_same_render(self.repo, tree.id, template_commit.tree.id, context_file):
+            tree = template_commit.tree
+
+        changes = {'added': [], 'modified': [], 'deleted': []}
+        for delta in template_commit.tree.diff_to_tree(tree).deltas:
+            if delta.status == GIT_DELTA_ADDED:
+                changes['added'].append(delta.new_file.path)
+            elif delta.status == GIT_DELTA_DELETED:
+                changes['deleted'].append(delta.old_file.path)
+            else:
+                changes['modified'].append(delta.new_file.path)
+
+        merge_target_revision = self._merge_target_revision(merge_target)
+        target = self.repo.revparse_single(merge_target_revision).peel(Commit)
+        # The template branch history is merged into the target, so their merge base is what the
+        # upgrade would be merged relative to.
+        base = self.repo.merge_base(target.id, template_commit.id)
+        ancestor = self.repo[base].tree if base else self.repo[self.repo.TreeBuilder().write()]
+        index = self.repo.merge_trees(ancestor, target.tree, tree)
+
+        conflicts = []
+        if index.conflicts is not None:
+            conflicts = sorted(next(entry.path for entry in conflict if entry is not None)
+                               for conflict in index.conflicts)
+
+        return {
+            'repository': self.repo.workdir or self.repo.path,
+            'template': cookiecutter_kwargs['template'],
+            'checkout': checkout,
+            'merge_target': merge_target_revision,
+            'changed': tree.id != template_commit.tree.id,
+            'changes': changes,
+            'conflicts': conflicts
+        }
+
+    def iter_events(self, operation: str, *args: Any, **kwargs: Any) -> Iterator[Dict[str, Any]]:
+        """Runs "operation" in a background thread, yielding its progress events as they happen.
+
+        Args:
+            operation: The name of the method to run, e.g. "install", "upgrade" or
+                "plan_upgrade", which is called with the remaining arguments.
+
+        Returns:
+            An iterator of progress events, the last of which is a "result" event holding whatever
+            the operation returned. If the operation raises, the exception is re-raised once every
+            event it emitted was yielded.
+        """
+        method = getattr(self, operation)
+        events: queue.Queue = queue.Queue()
+        outcome: Dict[str, Any] = {}
+
+        def run():
             try:
-                self._fetch_remote_template()
-            except KeyError as e:
-                # Cannot find the origin remote branch.
-                logger.error(e)
-                raise TemplateNotFoundException() from e
+                outcome['result'] = method(*args, **kwargs)
+            except BaseException as e:
+                # Includes the SystemExit raised by failed hooks.
+                outcome['error'] = e
+            finally:
+                events.put(None)
 
-        # Get last context used to apply template
-        context = self._get_context(context_file)
-        logger.debug(f'Found context: {context}')
-        # Fetch template information, this is normally the git:// URL.
-        template = context['_template']
-        logger.debug(f'Found template: {template}')
+        self.progress.add_callback(events.put)
+        thread = threading.Thread(target=run, name=f'battenberg-{operation}', daemon=True)
+        thread.start()
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            thread.join()
+            self.progress.remove_callback(events.put)
 
-        # Create temporary EMPTY worktree
-        with TemporaryWorktree(self.repo, WORKTREE_NAME) as worktree:
-            # Set HEAD to template branch
-            branch = worktree.repo.lookup_branch(TEMPLATE_BRANCH)
-            worktree.repo.set_head(branch.name)
+        if 'error' in outcome:
+            raise outcome['error']
+        yield {'event': EVENT_RESULT, 'time': time.time(), 'result': outcome['result']}
 
-            cookiecutter_kwargs = {
-                'template': template,
-                'checkout': checkout,
-                'extra_context': context,
-                'no_input': no_input
-            }
-            self._cookiecut(cookiecutter_kwargs, worktree)
 
-            # Stage changes
-            worktree.repo.index.read()
-            worktree.repo.index.add_all()
-            worktree.repo.index.write()
-            tree = worktree.repo.index.write_tree()
+UPGRADE_SUCCESS = 'success'
+UPGRADE_NO_CHANGES = 'no-changes'
+UPGRADE_CONFLICT = 'conflict'
+UPGRADE_ERROR = 'error'
 
-            # Create commit on the template branch
-            oid = worktree.repo.create_commit(
-                'HEAD',
-                worktree.repo.default_signature,
-                worktree.repo.default_signature,
-                'Prepared template upgrade',
-                tree,
-                [worktree.repo.head.target]
-            )
-            commit = worktree.repo.get(oid)
 
-        # Make template branch ref to created commit, see https://github.com/libgit2/pygit2/blob/master/CHANGELOG.md#1150-2024-05-18
-        self.repo.lookup_branch(TEMPLATE_BRANCH).set_target(str(commit.id))
+class UpgradeResult(NamedTuple):
+    repository: str
+    status: str
+    message: str = ''
 
-        # Let's merge our changes into HEAD
-        self._merge_template_branch(
-            f'Upgraded template \'{template}\'', merge_target)
+
+class MergeTargetResult(NamedTuple):
+    merge_target: str
+    status: str
+    message: str = ''
+
+
+# The index, path, Battenberg instance and whether to upgrade bare of each repository in a batch.
+_BatchMember = Tuple[int, str, Battenberg, bool]
+# Batch members which share a render, along with the cookiecutter arguments to render with.
+_BatchGroup = Tuple[Dict[str, Any], List[_BatchMember]]
+
+
+class BatchUpgrader:
+    """
+    Upgrades many repositories, rendering each distinct template, checkout and context only once.
+
+    Repositories are grouped by the template URL and the canonical form of the answers found in
+    their context files, which ignores the values cookiecutter overwrites while rendering such as
+    "_output_dir". Each group is rendered once and written into the object database of its first
+    repository, the resulting tree is then copied object by object into the rest of the group so
+    every "template" branch receives the same tree ID. With a shared object store the tree is
+    written into the store instead, which every repository borrows it from. No temporary
+    worktrees are created and remote templates are fetched once per batch through a shared
+    template mirror.
+    """
+
+    def __init__(self, repositories: Iterable[Union[Repository, str]],
+                 render_cache: Optional[RenderCache] = None,
+                 template_mirror: Optional[TemplateMirror] = None,
+                 timer: Optional[PhaseTimer] = None, render_jobs: Optional[int] = None,
+                 render_memo: bool = False, shared_objects: Optional[SharedObjectStore] = None):
+        self.repositories = list(repositories)
+        self.render_cache = render_cache
+        self.template_mirror = template_mirror
+        self.timer = timer or PhaseTimer()
+        self.render_jobs = render_jobs
+        self.render_memo = render_memo
+        self.shared_objects = shared_objects
+
+    def _open(self, repository: Union[Repository, str],
+              template_mirror: Optional[TemplateMirror]) -> Battenberg:
+        repo = open_repository(repository) if isinstance(repository, str) else repository
+        return Battenberg(repo, render_cache=self.render_cache, template_mirror=template_mirror,
+                          timer=self.timer, render_jobs=self.render_jobs,
+                          render_memo=self.render_memo, shared_objects=self.shared_objects)
+
+    def _group(self, template_mirror: Optional[TemplateMirror], checkout: Optional[str],
+               merge_target: Optional[str], context_file: str, bare: bool,
+               output_branch: Optional[str] = None) -> Tuple[List[Optional[UpgradeResult]],
+                                                             Dict[Tuple[str, str], _BatchGroup]]:
+        """Reads the context of every repository, returning the results of those which failed and
+        the rest grouped by template and canonical context."""
+        results: List[Optional[UpgradeResult]] = [None] * len(self.repositories)
+        groups: Dict[Tuple[str, str], _BatchGroup] = {}
+
+        for i, repository in enumerate(self.repositories):
+            path = repository if isinstance(repository, str) else \
+                repository.workdir or repository.path
+            try:
+                battenberg = self._open(repository, template_mirror)
+                if bare:
+                    battenberg._check_bare_upgrade([merge_target], output_branch)
+                battenberg._ensure_template_branch()
+                repo_bare = bare or battenberg.repo.is_bare
+                cookiecutter_kwargs = battenberg._get_upgrade_cookiecutter_kwargs(
+                    checkout, True, merge_target, context_file, repo_bare)
+            except Exception as e:
+                results[i] = UpgradeResult(path, UPGRADE_ERROR, str(e) or type(e).__name__)
+                continue
+
+            key = (cookiecutter_kwargs['template'],
+                   canonicalize_context(cookiecutter_kwargs['extra_context']))
+            _, members = groups.setdefault(key, (cookiecutter_kwargs, []))
+            members.append((i, path, battenberg, repo_bare))
+
+        return results, groups
+
+    def group(self, checkout: Optional[str] = None, merge_target: Optional[str] = None,
+              context_file: str = '.cookiecutter.json',
+              bare: bool = False) -> List[List[Union[Repository, str]]]:
+        """Groups the repositories which would share a single render when upgraded together.
+
+        Repositories whose context cannot be read are placed in groups of their own.
+        """
+        results, groups = self._group(self.template_mirror, checkout, merge_target,
+                                      context_file, bare)
+        return [[self.repositories[i] for i, _, _, _ in members]
+                for _, members in groups.values()] + \
+            [[self.repositories[i]] for i, result in enumerate(results) if result is not None]
+
+    def upgrade(self, checkout: Optional[str] = None, merge_target: Optional[str] = None,
+                context_file: str = '.cookiecutter.json', in_memory: bool = False,
+                bare: bool = False, output_branch: Optional[str] = None) -> List[UpgradeResult]:
+        """Upgrades every repository using the template context found within each of them.
+
+        Template questions are never prompted for. The arguments have the same meaning as for
+        Battenberg.upgrade.
+
+        Returns:
+            The result of upgrading each repository, in the order they were given. Failures,
+            including merge conflicts, are reported rather than raised.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Without a persistent mirror, still share a single fetch of each remote template
+            # across the whole batch.
+            template_mirror = self.template_mirror or TemplateMirror(tmpdir)
+            results, groups = self._group(template_mirror, checkout, merge_target, context_file,
+                                          bare, output_branch)
+
+            for cookiecutter_kwargs, members in groups.values():
+                template = cookiecutter_kwargs['template']
+                logger.debug(f'Rendering {template} once for {len(members)} repositories.')
+                try:
+                    memo = members[0][2]._render_memo()
+                    with members[0][2]._render(cookiecutter_kwargs, memo=memo) as \
+                            (rendered_path, _):
+                        source = tree = None
+                        for i, path, battenberg, repo_bare in members:
+                            try:
+                                with self.timer.phase('stage'):
+                                    if source is None:
+                                        tree = battenberg._create_template_tree(
+                                            template, rendered_path, memo and memo.hits)
+                                        source = battenberg.repo
+                                        if memo is not None:
+                                            memo.record(tree)
+                                    else:
+                                        battenberg._import_template_tree(source, tree, template)
+                                battenberg._emit_staged(tree)
+                            except Exception as e:
+                                results[i] = UpgradeResult(path, UPGRADE_ERROR,
+                                                           str(e) or type(e).__name__)
+                                continue
+
+                            results[i] = self._upgrade_repository(
+                                battenberg, path, tree, template, merge_target, context_file,
+                                in_memory or repo_bare or output_branch is not None, repo_bare,
+                                output_branch)
+                except (Exception, SystemExit) as e:
+                    # Hook failures surface as SystemExit from Battenberg._render.
+                    for i, path, _, _ in members:
+                        if results[i] is None:
+                            results[i] = UpgradeResult(path, UPGRADE_ERROR,
+                                                       str(e) or type(e).__name__)
+
+            return results
+
+    def _upgrade_repository(self, battenberg: Battenberg, path: str, tree: Oid, template: str,
+                            merge_target: Optional[str], context_file: str, in_memory: bool,
+                            bare: bool, output_branch: Optional[str]) -> UpgradeResult:
+        try:
+            with self.timer.phase('upgrade'):
+                changed, commit = battenberg._commit_template_upgrade(tree, context_file)
+                if not battenberg._merge_template_upgrade(template, changed, merge_target,
+                                                          in_memory, bare, output_branch, commit):
+                    return UpgradeResult(path, UPGRADE_NO_CHANGES)
+        except MergeConflictException as e:
+            return UpgradeResult(path, UPGRADE_CONFLICT, str(e))
+        except Exception as e:
+            return UpgradeResult(path, UPGRADE_ERROR, str(e) or type(e).__name__)
+        return UpgradeResult(path, UPGRADE_SUCCESS)
+
+
+INSTALL_SUCCESS = 'success'
+INSTALL_CONFLICT = 'conflict'
+INSTALL_ERROR = 'error'
+
+
+class InstallResult(NamedTuple):
+    repository: str
+    status: str
+    message: str = ''
+    # How long the install took, the first repository of each group includes the render.
+    seconds: float = 0.0
+
+
+def _install_group(template: str, checkout: Optional[str], extra_context: Optional[Dict[str, Any]],
+                   paths: List[str], initial_branch: Optional[str],
+                   battenberg_kwargs: Dict[str, Any]) -> List[InstallResult]:
+    """
+    Installs "template" rendered once with "extra_context" into each of "paths", capturing the
+    outcome of each rather than raising. Defined at module level so it can be pickled into worker
+    processes.
+    """
+    template_mirror = battenberg_kwargs.get('template_mirror')
+    mirror_path = None
+    if template_mirror is not None and is_repo_url(template):
+        mirror_path = template_mirror.mirror_path(template)
+
+    results: List[Optional[InstallResult]] = [None] * len(paths)
+    seconds = [0.0] * len(paths)
+    # The index and Battenberg instance of each repository which is ready to install into.
+    members: List[Tuple[int, Battenberg]] = []
+    for i, path in enumerate(paths):
+        start = time.perf_counter()
+        try:
+            battenberg = Battenberg(
+                open_or_init_repository(path, template, initial_branch, mirror_path),
+                **battenberg_kwargs)
+            if battenberg.is_installed():
+                raise TemplateConflictException()
+            members.append((i, battenberg))
+        except Exception as e:
+            results[i] = InstallResult(path, INSTALL_ERROR, str(e) or type(e).__name__)
+        seconds[i] += time.perf_counter() - start
+
+    cookiecutter_kwargs = {
+        'template': template,
+        'checkout': checkout,
+        'extra_context': extra_context,
+        'no_input': True
+    }
+    start = time.perf_counter()
+    try:
+        if members:
+            with members[0][1]._render(cookiecutter_kwargs) as (rendered_path, _):
+                seconds[members[0][0]] += time.perf_counter() - start
+                source = tree = None
+                for i, battenberg in members:
+                    start = time.perf_counter()
+                    try:
+                        with battenberg.timer.phase('install'):
+                            with battenberg.timer.phase('stage'):
+                                if source is None:
+                                    tree = battenberg._create_template_tree(template,
+                                                                            rendered_path)
+                                    source = battenberg.repo
+                                else:
+                                    battenberg._import_template_tree(source, tree, template)
+                            battenberg._emit_staged(tree)
+                            commit = battenberg._commit_template_install(tree)
+                            with battenberg.timer.phase('merge'):
+                                battenberg._merge_template_branch_in_memory(
+                                    f'Installed template \'{template}\'',
+                                    template_commit=commit)
+                        results[i] = InstallResult(paths[i], INSTALL_SUCCESS)
+                    except MergeConflictException as e:
+                        results[i] = InstallResult(paths[i], INSTALL_CONFLICT, str(e))
+                    except Exception as e:
+                        results[i] = InstallResult(paths[i], INSTALL_ERROR,
+                                                   str(e) or type(e).__name__)
+                    seconds[i] += time.perf_counter() - start
+    except (Exception, SystemExit) as e:
+        # Hook failures surface as SystemExit from Battenberg._render.
+        for i, _ in members:
+            if results[i] is None:
+                results[i] = InstallResult(paths[i], INSTALL_ERROR, str(e) or type(e).__name__)
+
+    return [result._replace(seconds=round(seconds[i], 3)) for i, result in enumerate(results)]
+
+
+class BatchInstaller:
+    """
+    Installs a template into many new repositories, rendering each distinct set of context
+    overrides only once.
+
+    Each target is a path, where a repository is created if there isn't one already, along with
+    the answers overriding the template defaults. Targets sharing the same overrides are grouped
+    like BatchUpgrader groups repositories: the template is rendered once per group and its tree
+    copied object by object into the rest of the group. No worktrees are created, the template
+    and merge commits are written straight to each object database and only the merged files are
+    checked out. Remote templates are fetched once per batch through a shared template mirror.
+    """
+
+    def __init__(self, targets: Iterable[Tuple[str, Optional[Dict[str, Any]]]],
+                 render_cache: Optional[RenderCache] = None,
+                 template_mirror: Optional[TemplateMirror] = None,
+                 timer: Optional[PhaseTimer] = None, render_jobs: Optional[int] = None,
+                 shared_objects: Optional[SharedObjectStore] = None):
+        self.targets = list(targets)
+        self.render_cache = render_cache
+        self.template_mirror = template_mirror
+        self.timer = timer or PhaseTimer()
+        self.render_jobs = render_jobs
+        self.shared_objects = shared_objects
+
+    def group(self) -> List[Tuple[Optional[Dict[str, Any]], List[int]]]:
+        """Groups the targets which share a single render.
+
+        Returns:
+            The context overrides of each group and the indices of its targets.
+        """
+        groups: Dict[str, Tuple[Optional[Dict[str, Any]], List[int]]] = {}
+        for i, (_, extra_context) in enumerate(self.targets):
+            _, members = groups.setdefault(canonicalize_context(extra_context),
+                                           (extra_context, []))
+            members.append(i)
+        return list(groups.values())
+
+    def install(self, template: str, checkout: Optional[str] = None,
+                initial_branch: Optional[str] = None, jobs: int = 1) -> List[InstallResult]:
+        """Installs "template" into every target, rendering groups across "jobs" processes.
+
+        Template questions are never prompted for, the defaults of the template are used unless
+        overridden by the target. The arguments have the same meaning as for Battenberg.install
+        and open_or_init_repository.
+
+        Returns:
+            The result of installing into each target, in the order they were given. Failures,
+            including repositories which already have a template installed, are reported rather
+            than raised.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            template_mirror = self.template_mirror or TemplateMirror(tmpdir)
+            if is_repo_url(template):
+                with self.timer.phase('mirror'):
+                    template_mirror.update(template, checkout)
+                # Every group renders from the mirror which was just fetched.
+                template_mirror = TemplateMirror(template_mirror.path, offline=True)
+
+            battenberg_kwargs = {'render_cache': self.render_cache,
+                                 'template_mirror': template_mirror,
+                                 'render_jobs': self.render_jobs,
+                                 'shared_objects': self.shared_objects}
+            groups = self.group()
+            args = [(template, checkout, extra_context,
+                     [self.targets[i][0] for i in indices], initial_branch)
+                    for extra_context, indices in groups]
+
+            if jobs == 1 or len(groups) == 1:
+                # Avoid the process pool overhead when running serially.
+                batches = [_install_group(*arg, dict(battenberg_kwargs, timer=self.timer))
+                           for arg in args]
+            else:
+                with ProcessPoolExecutor(max_workers=min(jobs, len(groups)),
+                                         initializer=init_render_worker,
+                                         initargs=(tmpdir,)) as executor:
+                    futures = [executor.submit(_install_group, *arg, battenberg_kwargs)
+                               for arg in args]
+                    batches = [future.result() for future in futures]
+
+        results: List[Optional[InstallResult]] = [None] * len(self.targets)
+        for (_, indices), batch in zip(groups, batches):
+            for i, result in zip(indices, batch):
+                results[i] = result
+        return results
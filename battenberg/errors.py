@@ -1,3 +1,6 @@
+from typing import Any, Dict, List, Optional
+
+
 class BattenbergException(Exception):
     """
     Abstract Battenberg generic exception.
@@ -55,8 +58,13 @@ class RepositoryEmptyException(BattenbergException):
 class MergeConflictException(BattenbergException):
     """
     Error raised when we cannot merge the template commit with the target branch.
+
+    The conflicts are described by "conflicts", see battenberg.utils.describe_conflicts.
     """
-    pass
+
+    def __init__(self, message: str = '', conflicts: Optional[List[Dict[str, Any]]] = None):
+        super().__init__(message)
+        self.conflicts = conflicts or []
 
 
 class InvalidRepositoryException(BattenbergException):
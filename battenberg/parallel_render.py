@@ -0,0 +1,275 @@
+import os
+import sys
+import shutil
+import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import cookiecutter.main
+from cookiecutter.exceptions import UndefinedVariableInTemplate
+from cookiecutter.find import find_template
+from cookiecutter.generate import generate_file, is_copy_only_path, render_and_create_dir
+from cookiecutter.hooks import find_hook, run_hook_from_repo_dir
+from cookiecutter.utils import create_env_with_context, rmtree, work_in
+from jinja2 import Environment, FileSystemLoader
+from jinja2.exceptions import UndefinedError
+from battenberg.render_memo import RenderMemo
+
+
+logger = logging.getLogger(__name__)
+
+# Below this many files to render, starting worker processes costs more than it saves.
+MIN_PARALLEL_FILES = 32
+
+COPY = 'copy'
+RENDER = 'render'
+
+# The operation (COPY or RENDER) and template relative path of each file to generate.
+FileOperation = Tuple[str, str]
+
+# The rendering environment of each worker process, see _init_worker.
+_worker: Dict[str, Any] = {}
+
+
+def _loader_env(context: Dict[str, Any]) -> Environment:
+    env = create_env_with_context(context)
+    # Cookiecutter renders from within the template directory, see generate_files.
+    env.loader = FileSystemLoader(['.', '../templates'])
+    return env
+
+
+def _init_worker(repo_dir: str, template_dir: str, context: Dict[str, Any]):
+    # Local Jinja extensions are imported from the template repository.
+    sys.path.append(repo_dir)
+    os.chdir(template_dir)
+    _worker['context'] = context
+    _worker['env'] = _loader_env(context)
+
+
+def _render_files(project_dir: str, infiles: List[str],
+                  skip_if_file_exists: bool) -> Optional[Tuple[str, UndefinedError]]:
+    """Renders a chunk of files in a worker process, stopping at the first undefined variable."""
+    for infile in infiles:
+        try:
+            generate_file(project_dir, infile, _worker['context'], _worker['env'],
+                          skip_if_file_exists)
+        except UndefinedError as err:
+            return infile, err
+    return None
+
+
+def _copy_file(infile: str, project_dir: str, context: Dict[str, Any], env: Environment):
+    outfile = os.path.join(project_dir, env.from_string(infile).render(**context))
+    logger.debug(f'Copying file {infile} to {outfile} without rendering')
+    shutil.copyfile(infile, outfile)
+    shutil.copymode(infile, outfile)
+
+
+def _create_dirs(project_dir: str, output_dir: str, context: Dict[str, Any], env: Environment,
+                 overwrite_if_exists: bool, delete_project_on_failure: bool
+                 ) -> List[FileOperation]:
+    """Walks the template exactly as cookiecutter does, creating every directory and copying
+    directories which aren't rendered.
+
+    Returns:
+        The files to generate, in the order cookiecutter would generate them.
+    """
+    operations = []
+    for root, dirs, files in os.walk('.'):
+        copy_dirs = []
+        render_dirs = []
+        for d in sorted(dirs):
+            if is_copy_only_path(os.path.normpath(os.path.join(root, d)), context):
+                copy_dirs.append(d)
+            else:
+                render_dirs.append(d)
+
+        for copy_dir in copy_dirs:
+            indir = os.path.normpath(os.path.join(root, copy_dir))
+            outdir = env.from_string(os.path.normpath(os.path.join(project_dir, indir))).render(
+                **context)
+            logger.debug(f'Copying dir {indir} to {outdir} without rendering')
+            if os.path.isdir(outdir):
+                shutil.rmtree(outdir)
+            shutil.copytree(indir, outdir)
+
+        dirs[:] = render_dirs
+        for d in dirs:
+            unrendered_dir = os.path.join(project_dir, root, d)
+            try:
+                render_and_create_dir(unrendered_dir, context, output_dir, env,
+                                      overwrite_if_exists)
+            except UndefinedError as err:
+                if delete_project_on_failure:
+                    rmtree(project_dir)
+                _dir = os.path.relpath(unrendered_dir, output_dir)
+                raise UndefinedVariableInTemplate(
+                    f"Unable to create directory '{_dir}'", err, context) from err
+
+        for f in sorted(files):
+            infile = os.path.normpath(os.path.join(root, f))
+            operations.append((COPY if is_copy_only_path(infile, context) else RENDER, infile))
+    return operations
+
+
+def _order_dependent(operations: List[FileOperation], context: Dict[str, Any],
+                     env: Environment) -> bool:
+    """Whether generating "operations" out of order could change the result, which is the case
+    when several files render to the same path and overwrite one another."""
+    try:
+        outfiles = Counter(env.from_string(infile).render(**context) for _, infile in operations)
+    except UndefinedError:
+        # Generate in order so the failure is reported exactly as cookiecutter would.
+        return True
+    return any(count > 1 for count in outfiles.values())
+
+
+def _has_hooks(repo_dir: str) -> bool:
+    with work_in(repo_dir):
+        return any(find_hook(hook) for hook in ('pre_gen_project', 'post_gen_project'))
+
+
+def _reuse_rendered(operations: List[FileOperation], repo_dir: str, project_dir: str,
+                    context: Dict[str, Any], env: Environment, memo: RenderMemo,
+                    skip_if_file_exists: bool, accept_hooks: bool) -> List[FileOperation]:
+    """Drops the files "memo" already knows the rendered blob of from "operations"."""
+    if accept_hooks and _has_hooks(repo_dir):
+        # Hooks may read or modify any generated file, so they must all be generated.
+        logger.debug('Not reusing rendered files as the template has hooks.')
+        return operations
+    if skip_if_file_exists or _order_dependent(operations, context, env) or \
+            not memo.prepare(context):
+        return operations
+
+    remaining = []
+    for operation, infile in operations:
+        if operation == RENDER:
+            outfile = env.from_string(infile).render(**context)
+            # Files whose name renders empty are skipped by cookiecutter.
+            if not os.path.isdir(os.path.join(project_dir, outfile)) and \
+                    memo.reuse(infile, outfile.replace(os.sep, '/'), context, env):
+                continue
+        remaining.append((operation, infile))
+    logger.debug(f'Reusing {len(operations) - len(remaining)} previously rendered files.')
+    return remaining
+
+
+def _generate(operations: List[FileOperation], repo_dir: str, project_dir: str,
+              context: Dict[str, Any], env: Environment, skip_if_file_exists: bool, jobs: int
+              ) -> Optional[Tuple[str, UndefinedError]]:
+    """Generates the files of "operations", rendering them across "jobs" worker processes
+    unless the result could depend on the order they're generated in."""
+    render = [infile for operation, infile in operations if operation == RENDER]
+    if jobs < 2 or len(render) < MIN_PARALLEL_FILES or \
+            _order_dependent(operations, context, env):
+        for operation, infile in operations:
+            if operation == COPY:
+                _copy_file(infile, project_dir, context, env)
+                continue
+            try:
+                generate_file(project_dir, infile, context, env, skip_if_file_exists)
+            except UndefinedError as err:
+                return infile, err
+        return None
+
+    for operation, infile in operations:
+        if operation == COPY:
+            _copy_file(infile, project_dir, context, env)
+
+    # A few chunks per worker balance uneven files without paying for a task per file.
+    size = max(1, len(render) // (jobs * 4))
+    chunks = [render[i:i + size] for i in range(0, len(render), size)]
+    logger.debug(f'Rendering {len(render)} files in {len(chunks)} chunks across {jobs} workers')
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(repo_dir, os.getcwd(), context)) as executor:
+        futures = [executor.submit(_render_files, project_dir, chunk, skip_if_file_exists)
+                   for chunk in chunks]
+        # Report the first failure in the order cookiecutter would have hit it.
+        for future in futures:
+            failure = future.result()
+            if failure is not None:
+                executor.shutdown(cancel_futures=True)
+                return failure
+    return None
+
+
+def generate_files(repo_dir: str, context: Optional[Dict[str, Any]] = None,
+                   output_dir: str = '.', overwrite_if_exists: bool = False,
+                   skip_if_file_exists: bool = False, accept_hooks: bool = True,
+                   keep_project_on_failure: bool = False, jobs: Optional[int] = None,
+                   memo: Optional[RenderMemo] = None) -> str:
+    """A drop in replacement for cookiecutter.generate.generate_files which renders the template
+    files across "jobs" worker processes, defaulting to the number of CPUs.
+
+    Directories, hooks and files copied without rendering are handled in the calling process in
+    the same order as cookiecutter. Each file is rendered with cookiecutter's own generate_file
+    so the output is byte-identical.
+
+    Files whose rendered blob is already known to "memo" aren't generated at all, they're
+    recorded in its "hits" instead.
+    """
+    context = context or {}
+    env = create_env_with_context(context)
+    template_dir = find_template(repo_dir, env)
+    logger.debug(f'Generating project from {template_dir} in parallel')
+
+    unrendered_dir = os.path.split(template_dir)[1]
+    try:
+        project_dir, output_directory_created = render_and_create_dir(
+            unrendered_dir, context, output_dir, env, overwrite_if_exists)
+    except UndefinedError as err:
+        raise UndefinedVariableInTemplate(
+            f"Unable to create project directory '{unrendered_dir}'", err, context) from err
+
+    project_dir = os.path.abspath(project_dir)
+    delete_project_on_failure = output_directory_created and not keep_project_on_failure
+
+    if accept_hooks:
+        run_hook_from_repo_dir(repo_dir, 'pre_gen_project', project_dir, context,
+                               delete_project_on_failure)
+
+    with work_in(template_dir):
+        env = _loader_env(context)
+        operations = _create_dirs(project_dir, output_dir, context, env, overwrite_if_exists,
+                                  delete_project_on_failure)
+        if memo is not None:
+            operations = _reuse_rendered(operations, str(repo_dir), project_dir, context, env,
+                                         memo, skip_if_file_exists, accept_hooks)
+        failure = _generate(operations, str(repo_dir), project_dir, context, env,
+                            skip_if_file_exists, jobs or os.cpu_count() or 1)
+
+    if failure is not None:
+        infile, err = failure
+        if delete_project_on_failure:
+            rmtree(project_dir)
+        raise UndefinedVariableInTemplate(
+            f"Unable to create file '{infile}'", err, context) from err
+
+    if accept_hooks:
+        run_hook_from_repo_dir(repo_dir, 'post_gen_project', project_dir, context,
+                               delete_project_on_failure)
+
+    return project_dir
+
+
+@contextmanager
+def parallel_rendering(jobs: Optional[int] = None,
+                       memo: Optional[RenderMemo] = None) -> Iterator[None]:
+    """Makes cookiecutter.main.cookiecutter render template files across "jobs" worker
+    processes, reusing the files "memo" already knows the rendered blob of.
+
+    Cookiecutter offers no extension point for rendering, so its generate_files is swapped out
+    for the duration, much like TemplateMirror.redirect temporarily configures git.
+    """
+    original = cookiecutter.main.generate_files
+
+    def generate_files_in_parallel(*args: Any, **kwargs: Any) -> str:
+        return generate_files(*args, jobs=jobs, memo=memo, **kwargs)
+
+    cookiecutter.main.generate_files = generate_files_in_parallel
+    try:
+        yield
+    finally:
+        cookiecutter.main.generate_files = original
@@ -0,0 +1,71 @@
+import time
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+PHASE_START = 'start'
+PHASE_END = 'end'
+
+# Called with the event (PHASE_START or PHASE_END), the phase name and, for PHASE_END events, how
+# many seconds the phase took.
+PhaseHook = Callable[[str, str, Optional[float]], None]
+
+
+class PhaseTimer:
+    """
+    Records how long each named phase of an install or upgrade takes.
+
+    Phases may be nested, in which case their names are joined with a "." e.g. "upgrade.render".
+    Callers can observe phases as they happen by registering hooks.
+    """
+
+    def __init__(self, hooks: Optional[List[PhaseHook]] = None):
+        self.hooks = list(hooks or [])
+        self.phases: List[Dict[str, Any]] = []
+        self._stack: List[str] = []
+
+    def add_hook(self, hook: PhaseHook):
+        self.hooks.append(hook)
+
+    def _notify(self, event: str, name: str, seconds: Optional[float] = None):
+        for hook in self.hooks:
+            hook(event, name, seconds)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        if self._stack:
+            name = f'{self._stack[-1]}.{name}'
+        # Record the phase up front so phases are reported in the order they started.
+        record = {'phase': name, 'seconds': None}
+        self.phases.append(record)
+        self._stack.append(name)
+        self._notify(PHASE_START, name)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self._stack.pop()
+            logger.debug(f"Phase {name} took {record['seconds']:.3f}s")
+            self._notify(PHASE_END, name, record['seconds'])
+
+    def report(self) -> Dict[str, Any]:
+        """A JSON serializable breakdown of the recorded phases."""
+        return {
+            'phases': [dict(record) for record in self.phases],
+            'total': sum(record['seconds'] or 0 for record in self.phases
+                         if '.' not in record['phase'])
+        }
+
+    def format(self) -> str:
+        """A human readable breakdown of the recorded phases."""
+        report = self.report()
+        width = max([len(record['phase']) for record in report['phases']] + [len('total')])
+        lines = [f"{record['phase']:<{width}}  {record['seconds'] or 0:8.3f}s"
+                 for record in report['phases']]
+        lines.append(f"{'total':<{width}}  {report['total']:8.3f}s")
+        return '\n'.join(lines)
@@ -0,0 +1,89 @@
+import time
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from pygit2 import Keypair, RemoteCallbacks
+from battenberg.profiling import PHASE_START
+
+
+logger = logging.getLogger(__name__)
+
+EVENT_PHASE_START = 'phase_start'
+EVENT_PHASE_END = 'phase_end'
+EVENT_FETCH_PROGRESS = 'fetch_progress'
+EVENT_RENDERED = 'rendered'
+EVENT_STAGED = 'staged'
+EVENT_MERGED = 'merged'
+EVENT_RESULT = 'result'
+
+MERGE_UP_TO_DATE = 'up-to-date'
+MERGE_MERGED = 'merged'
+MERGE_CONFLICT = 'conflict'
+
+# Minimum number of seconds between two fetch progress events.
+FETCH_PROGRESS_INTERVAL = 0.1
+
+Event = Dict[str, Any]
+ProgressCallback = Callable[[Event], None]
+
+
+class _FetchProgressCallbacks(RemoteCallbacks):
+
+    def __init__(self, progress: 'Progress', credentials: Optional[Keypair] = None):
+        super().__init__(credentials=credentials)
+        self.progress = progress
+        self._last_emitted = 0.0
+
+    def transfer_progress(self, stats):
+        now = time.monotonic()
+        done = stats.received_objects == stats.total_objects
+        if not done and now - self._last_emitted < FETCH_PROGRESS_INTERVAL:
+            return
+        self._last_emitted = now
+        self.progress.emit(
+            EVENT_FETCH_PROGRESS,
+            received_bytes=stats.received_bytes,
+            received_objects=stats.received_objects,
+            total_objects=stats.total_objects
+        )
+
+
+class Progress:
+    """
+    Publishes structured progress events of an install or upgrade to callbacks as they happen.
+
+    Every event is a JSON serializable dictionary holding the "event" type, the "time" it was
+    emitted at and any event specific data, e.g. the "phase" of phase start and end events.
+    """
+
+    def __init__(self, callbacks: Optional[List[ProgressCallback]] = None):
+        self.callbacks = list(callbacks or [])
+
+    def add_callback(self, callback: ProgressCallback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback: ProgressCallback):
+        self.callbacks.remove(callback)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether anyone is listening, so expensive event data can be skipped otherwise."""
+        return bool(self.callbacks)
+
+    def emit(self, event: str, **data: Any):
+        if not self.callbacks:
+            return
+        payload = {'event': event, 'time': time.time(), **data}
+        for callback in self.callbacks:
+            callback(payload)
+
+    def phase_hook(self, event: str, name: str, seconds: Optional[float]):
+        """A PhaseTimer hook which publishes phases as progress events."""
+        if event == PHASE_START:
+            self.emit(EVENT_PHASE_START, phase=name)
+        else:
+            self.emit(EVENT_PHASE_END, phase=name, seconds=seconds)
+
+    def remote_callbacks(self, credentials: Optional[Keypair] = None) -> RemoteCallbacks:
+        """Remote callbacks which publish the progress of fetches."""
+        return _FetchProgressCallbacks(self, credentials)
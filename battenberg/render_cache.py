@@ -0,0 +1,140 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+from typing import Any, Dict, Optional
+
+import cookiecutter
+from battenberg.utils import link_tree
+
+
+logger = logging.getLogger(__name__)
+
+# 1 GiB
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+# Cookiecutter always overwrites these context values while rendering, so whatever is read back
+# from a previous ".cookiecutter.json" must not influence the cache key.
+VOLATILE_CONTEXT_KEYS = ('_template', '_output_dir', '_repo_dir', '_checkout')
+TMP_PREFIX = '.tmp-'
+
+
+def canonicalize_context(context: Optional[Dict[str, Any]]) -> str:
+    """Serializes a cookiecutter context deterministically, ignoring values cookiecutter
+    overwrites during rendering."""
+    return json.dumps(
+        {k: v for k, v in (context or {}).items() if k not in VOLATILE_CONTEXT_KEYS},
+        sort_keys=True,
+        separators=(',', ':'),
+        default=str
+    )
+
+
+def _directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.lstat(os.path.join(root, f)).st_size
+    return size
+
+
+class RenderCache:
+    """
+    On-disk, content-addressed cache of rendered cookiecutter output.
+
+    Each entry is a directory named after its key holding the contents of the rendered project
+    (cookiecutter's top-level directory already removed). Entries are evicted least recently used
+    first once the cache grows beyond "max_size" bytes.
+    """
+
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def key(template: str, checkout: Optional[str], template_commit: str,
+            context: Optional[Dict[str, Any]],
+            default_context: Optional[Dict[str, Any]] = None) -> str:
+        """Constructs the cache key for a render.
+
+        Args:
+            template: The template URL, it is rendered into the output as "_template".
+            checkout: The requested template reference, it is rendered into the output as
+                "_checkout".
+            template_commit: The commit "checkout" resolved to in the template repo.
+            context: The extra context passed to cookiecutter.
+            default_context: The "default_context" from the cookiecutter user config.
+        """
+        payload = '\n'.join([
+            template,
+            checkout or '',
+            template_commit,
+            canonicalize_context(context),
+            canonicalize_context(default_context),
+            cookiecutter.__version__
+        ])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the path to the cached render for "key" or None if it isn't cached."""
+        entry_path = self._entry_path(key)
+        if not os.path.isdir(entry_path):
+            logger.debug(f'Render cache miss for {key}.')
+            return None
+
+        # Bump the modification time so eviction treats it as recently used.
+        os.utime(entry_path)
+        logger.debug(f'Render cache hit for {key}.')
+        return entry_path
+
+    def put(self, key: str, rendered_path: str) -> str:
+        """Links, or copies, a rendered project into the cache and evicts stale entries.
+
+        Returns:
+            The path of the cached entry.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        entry_path = self._entry_path(key)
+
+        # Link into a temporary directory first and rename it into place so concurrent
+        # battenberg processes never observe a partially written entry.
+        tmp = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=self.path)
+        try:
+            link_tree(rendered_path, tmp)
+            os.rename(tmp, entry_path)
+        except OSError:
+            # Another process already stored the same render.
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(entry_path):
+                raise
+        else:
+            logger.debug(f'Stored render {key} in the render cache.')
+
+        self.evict(keep=key)
+        return entry_path
+
+    def evict(self, keep: Optional[str] = None):
+        """Removes least recently used entries until the cache fits within "max_size"."""
+        if not os.path.isdir(self.path):
+            return
+
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith(TMP_PREFIX):
+                continue
+            entry_path = self._entry_path(name)
+            entries.append((os.stat(entry_path).st_mtime, name, _directory_size(entry_path)))
+
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            logger.debug(f'Evicting {name} from the render cache.')
+            shutil.rmtree(self._entry_path(name), ignore_errors=True)
+            total -= size
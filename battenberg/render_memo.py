@@ -0,0 +1,233 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import cookiecutter
+import jinja2
+from binaryornot.check import is_binary
+from jinja2 import Environment, nodes
+from jinja2.exceptions import TemplateError
+from pygit2 import Oid, Repository, hash as hash_blob
+from battenberg.utils import filemode
+
+
+logger = logging.getLogger(__name__)
+
+MEMO_FILE = 'render-memo.json'
+# Files which change how every other file is staged are always rendered.
+ALWAYS_RENDERED = ('.gitattributes', '.gitignore')
+# Globals which always return the same value for the same arguments.
+DETERMINISTIC_GLOBALS = ('range', 'dict', 'namespace', 'cycler', 'joiner')
+NONDETERMINISTIC_FILTERS = ('random',)
+# Extensions whose output only depends on their arguments, third-party and local extensions
+# may change along with the template without the template files themselves changing.
+DETERMINISTIC_EXTENSIONS = (
+    'cookiecutter.extensions.JsonifyExtension',
+    'cookiecutter.extensions.SlugifyExtension'
+)
+
+# Context values configuring how cookiecutter renders every file rather than what's rendered: the
+# newline written, Jinja options such as "trim_blocks" and the extensions loaded.
+ENVIRONMENT_KEYS = ('_new_lines', '_jinja2_env_vars', '_extensions')
+
+
+class _Unmemoizable(Exception):
+    pass
+
+
+def _context_keys(template: nodes.Template) -> Optional[Set[str]]:
+    """Finds which keys of the cookiecutter context a template renders.
+
+    Returns:
+        The keys, or None when the context is used as a whole e.g. "cookiecutter | jsonify".
+
+    Raises:
+        _Unmemoizable: When the output may also depend on anything besides the context, e.g.
+            included templates, the time or random numbers.
+    """
+    keys: Set[str] = set()
+    whole = False
+
+    def visit(node: nodes.Node, parent: Optional[nodes.Node]):
+        nonlocal whole
+        if isinstance(node, (nodes.Include, nodes.Import, nodes.FromImport, nodes.Extends,
+                             nodes.ExtensionAttribute, nodes.ImportedName)):
+            raise _Unmemoizable()
+        if isinstance(node, nodes.Call) and not (
+                isinstance(node.node, nodes.Getattr) or
+                (isinstance(node.node, nodes.Name) and node.node.name in DETERMINISTIC_GLOBALS)):
+            raise _Unmemoizable()
+        if isinstance(node, nodes.Filter) and node.name in NONDETERMINISTIC_FILTERS:
+            raise _Unmemoizable()
+
+        if isinstance(node, nodes.Name) and node.name == 'cookiecutter' and node.ctx == 'load':
+            if isinstance(parent, nodes.Getattr) and not hasattr(dict, parent.attr):
+                keys.add(parent.attr)
+            elif isinstance(parent, nodes.Getitem) and parent.node is node and \
+                    isinstance(parent.arg, nodes.Const):
+                keys.add(str(parent.arg.value))
+            else:
+                whole = True
+
+        for child in node.iter_child_nodes():
+            visit(child, node)
+
+    visit(template, None)
+    return None if whole else keys
+
+
+def _analyze(source: bytes, infile: str, env: Environment) -> Optional[Dict[str, Any]]:
+    """Finds what rendering "infile" depends on besides its source.
+
+    Returns:
+        The context keys and other names the file renders, see _context_keys, or None when it
+        can't be reused.
+    """
+    if is_binary(infile):
+        # Binaries are copied as is.
+        return {'binary': True}
+    try:
+        template = env.parse(source.decode('utf-8'))
+        keys = _context_keys(template)
+    except (_Unmemoizable, TemplateError, UnicodeDecodeError):
+        return None
+    # Loop variables and the like are included too, they're simply not in the context.
+    names = {node.name for node in template.find_all(nodes.Name) if node.ctx == 'load'}
+    return {'keys': None if keys is None else sorted(keys),
+            'names': sorted(names - {'cookiecutter'})}
+
+
+class RenderMemo:
+    """
+    Remembers the blob each template file rendered to within a repository, so unchanged template
+    files needn't be rendered again when upgrading to a new template version.
+
+    Entries are keyed by the template file's blob ID, the parts of the context it renders and the
+    cookiecutter and Jinja versions. Files whose output may depend on anything else, such as
+    included templates, hooks, the time or random numbers, are always rendered. What each
+    template file depends on is remembered by its blob ID too, so unchanged files aren't even
+    parsed. Only the entries used by the latest render are kept.
+    """
+
+    def __init__(self, repo: Repository, path: Optional[str] = None):
+        self.repo = repo
+        self.path = path or os.path.join(repo.path, 'battenberg', MEMO_FILE)
+        # The blob ID and file mode of each rendered path reused from the memo.
+        self.hits: Dict[str, Tuple[Oid, int]] = {}
+        # The key of each rendered path which had to be rendered.
+        self.misses: Dict[str, str] = {}
+        memo = self._load()
+        self._entries: Dict[str, str] = memo.get('blobs', {})
+        self._sources: Dict[str, Dict[str, Any]] = memo.get('sources', {})
+        self._used: Dict[str, str] = {}
+        self._used_sources: Dict[str, Dict[str, Any]] = {}
+        self._salt = ''
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path) as f:
+                memo = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return memo if isinstance(memo, dict) else {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Write to a temporary file first so concurrent runs never read a partial memo.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'blobs': self._used, 'sources': self._used_sources}, f, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def prepare(self, context: Dict[str, Any]) -> bool:
+        """Prepares to render the template in the current directory with "context".
+
+        Returns:
+            Whether any files of the template may be reused at all.
+        """
+        extensions = context.get('cookiecutter', {}).get('_extensions') or []
+        unknown = [name for name in extensions if name not in DETERMINISTIC_EXTENSIONS]
+        if unknown:
+            logger.debug(f'Not reusing rendered files, unknown extensions {unknown} are enabled.')
+            return False
+
+        # Staging filters depend on the attributes, which would apply to reused files too.
+        salt = hashlib.sha256()
+        for root, _, files in sorted(os.walk('.')):
+            if '.gitattributes' in files:
+                with open(os.path.join(root, '.gitattributes'), 'rb') as f:
+                    salt.update(f.read())
+        self._salt = salt.hexdigest()
+        return True
+
+    def key(self, infile: str, context: Dict[str, Any], env: Environment) -> Optional[str]:
+        """Constructs the memo key for rendering "infile", or None if it can't be reused."""
+        if os.path.basename(infile) in ALWAYS_RENDERED or os.path.islink(infile):
+            return None
+
+        with open(infile, 'rb') as f:
+            source = f.read()
+        blob = str(hash_blob(source))
+        analysis = self._sources.get(blob) or _analyze(source, infile, env)
+        if analysis is None:
+            return None
+        self._used_sources[blob] = analysis
+
+        parts = [self._salt, infile, blob]
+        if analysis.get('binary'):
+            return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+        variables = context['cookiecutter']
+        keys: Optional[List[str]] = analysis['keys']
+        if keys is not None:
+            variables = {key: variables.get(key) for key in keys + list(ENVIRONMENT_KEYS)}
+        names = analysis['names']
+        parts += [
+            json.dumps({'cookiecutter': variables,
+                        'names': {name: context.get(name) for name in names}},
+                       sort_keys=True, default=str),
+            cookiecutter.__version__,
+            jinja2.__version__
+        ]
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def reuse(self, infile: str, outfile: str, context: Dict[str, Any],
+              env: Environment) -> bool:
+        """Looks up the blob "infile" previously rendered to.
+
+        Returns:
+            Whether the blob was found, in which case it's recorded in "hits" and "infile" needn't
+            be rendered to "outfile", a path relative to the rendered project.
+        """
+        key = self.key(infile, context, env)
+        if key is None:
+            return False
+
+        blob = self._entries.get(key)
+        if blob is None or Oid(hex=blob) not in self.repo:
+            self.misses[outfile] = key
+            return False
+
+        self.hits[outfile] = (Oid(hex=blob), filemode(os.stat(infile).st_mode))
+        self._used[key] = blob
+        return True
+
+    def record(self, tree: Oid):
+        """Remembers the blobs the rendered files were staged as in "tree" and saves the memo."""
+        if not self.hits and not self.misses:
+            # Nothing was rendered through the memo, e.g. the render cache was used instead.
+            return
+
+        root = self.repo[tree]
+        for path, key in self.misses.items():
+            try:
+                entry = root[path]
+            except KeyError:
+                # Ignored files are never staged.
+                continue
+            if entry.type_str == 'blob':
+                self._used[key] = str(entry.id)
+        self.save()
@@ -0,0 +1,92 @@
+import os
+import hashlib
+import logging
+from typing import Optional
+
+from pygit2 import GIT_OBJECT_BLOB, GitError, Oid, Repository, init_repository
+from battenberg.utils import Blobs, create_tree_from_directory
+
+
+logger = logging.getLogger(__name__)
+
+# Every template tree written into a store is referenced below here, so garbage collecting the
+# store never prunes objects the repositories borrowing from it depend on.
+TREE_REF_PREFIX = 'refs/battenberg/trees/'
+
+
+class SharedObjectStore:
+    """
+    Object databases shared by every repository generated from the same template.
+
+    Each template URL gets its own bare repository under "path". Template trees are written into
+    it rather than into each repository, which reference its objects through git alternates
+    ("objects/info/alternates"). Committing the same template tree into many repositories then
+    only writes a commit and updates a ref in each of them instead of copying every blob and tree.
+
+    Repositories attached to a store can't be used without it, so it must not be removed while
+    they exist. Run "git repack -a -d" in a repository to copy the borrowed objects into it
+    before detaching it by removing its alternates file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def store_path(self, url: str) -> str:
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f'{name}.git')
+
+    def _open(self, url: str) -> Repository:
+        path = self.store_path(url)
+        if os.path.isdir(path):
+            return Repository(path)
+
+        logger.debug(f'Creating shared object store of {url} at {path}.')
+        os.makedirs(self.path, exist_ok=True)
+        return init_repository(path, bare=True)
+
+    def attach(self, repo: Repository, url: str) -> Repository:
+        """Makes "repo" borrow the objects of the store of "url" through git alternates.
+
+        Returns:
+            The store of "url".
+        """
+        store = self._open(url)
+        objects = os.path.abspath(os.path.join(store.path, 'objects'))
+        alternates = os.path.join(repo.path, 'objects', 'info', 'alternates')
+
+        try:
+            with open(alternates) as f:
+                attached = objects in f.read().splitlines()
+        except FileNotFoundError:
+            attached = False
+
+        if not attached:
+            logger.debug(f'Borrowing objects of {url} from {store.path}.')
+            os.makedirs(os.path.dirname(alternates), exist_ok=True)
+            with open(alternates, 'a') as f:
+                f.write(f'{objects}\n')
+            # Alternates are only read when a repository is opened.
+            repo.odb.add_disk_alternate(objects)
+        return store
+
+    def write_tree(self, repo: Repository, url: str, path: str,
+                   blobs: Optional[Blobs] = None) -> Oid:
+        """Writes the rendered directory "path" into the store of "url" as a tree which "repo"
+        can commit, see create_tree_from_directory.
+
+        Returns:
+            The id of the written tree.
+        """
+        store = self.attach(repo, url)
+        for oid, _ in (blobs or {}).values():
+            if oid not in store:
+                # Reused blobs may only exist in the repository itself.
+                store.write(GIT_OBJECT_BLOB, repo[oid].read_raw())
+
+        tree = create_tree_from_directory(store, path, blobs)
+        try:
+            store.references.create(f'{TREE_REF_PREFIX}{tree}', tree, force=True)
+        except GitError as e:
+            # Another run writing the same tree at once is just as good.
+            logger.debug(f'Unable to reference tree {tree} in {store.path}: {e}')
+        return tree
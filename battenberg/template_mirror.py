@@ -0,0 +1,125 @@
+import os
+import hashlib
+import logging
+from contextlib import contextmanager
+from typing import Iterator, Optional, Set
+
+from pygit2 import (
+    Commit,
+    GitError,
+    InvalidSpecError,
+    Oid,
+    RemoteCallbacks,
+    Repository,
+    init_repository
+)
+from battenberg.utils import construct_keypair, list_remote_refs
+
+
+logger = logging.getLogger(__name__)
+
+MIRROR_REFSPEC = '+refs/*:refs/*'
+
+
+class TemplateMirror:
+    """
+    Persistent bare mirrors of remote templates.
+
+    Each template URL is mirrored into its own bare repository under "path" and kept up to date
+    with incremental fetches. While rendering, cookiecutter's clone of the URL is transparently
+    redirected to the local mirror so the template is never cloned over the network.
+
+    In "offline" mode the mirror is only fetched from the remote when the requested reference
+    cannot already be found locally.
+    """
+
+    def __init__(self, path: str, offline: bool = False):
+        self.path = path
+        self.offline = offline
+        # URLs already fetched by this instance, so batches only fetch each template once.
+        self._fetched: Set[str] = set()
+
+    def mirror_path(self, url: str) -> str:
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f'{name}.git')
+
+    def _open(self, url: str) -> Repository:
+        path = self.mirror_path(url)
+        if os.path.isdir(path):
+            return Repository(path)
+
+        logger.debug(f'Creating template mirror of {url} at {path}.')
+        repo = init_repository(path, bare=True)
+        repo.remotes.create('origin', url, MIRROR_REFSPEC)
+        return repo
+
+    def _resolve(self, repo: Repository, checkout: Optional[str]) -> Optional[Oid]:
+        try:
+            return repo.revparse_single(checkout or 'HEAD').peel(Commit).id
+        except (KeyError, ValueError, GitError, InvalidSpecError):
+            return None
+
+    def _fetch(self, repo: Repository, url: str, callbacks: Optional[RemoteCallbacks] = None):
+        logger.debug(f'Fetching {url} into template mirror {repo.path}.')
+        callbacks = callbacks or RemoteCallbacks(credentials=construct_keypair())
+        repo.remotes['origin'].fetch(callbacks=callbacks)
+
+        # Mirror the remote HEAD so rendering without a checkout uses the default branch.
+        for ref in list_remote_refs(repo, url):
+            if ref['name'] == 'HEAD' and ref['symref_target']:
+                repo.references['HEAD'].set_target(ref['symref_target'])
+                break
+
+        self._fetched.add(url)
+
+    def update(self, url: str, checkout: Optional[str] = None,
+               callbacks: Optional[RemoteCallbacks] = None) -> Optional[Oid]:
+        """Ensures the mirror of "url" contains "checkout", fetching with "callbacks" if given.
+
+        Returns:
+            The commit "checkout" resolves to in the mirror, or None if it can't be found.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        repo = self._open(url)
+
+        if url not in self._fetched:
+            commit = self._resolve(repo, checkout) if self.offline else None
+            if commit is not None:
+                logger.debug(f'Found {checkout or "HEAD"} in template mirror, skipping fetch.')
+                return commit
+            self._fetch(repo, url, callbacks)
+
+        return self._resolve(repo, checkout)
+
+    def resolve(self, url: str, checkout: Optional[str] = None) -> Optional[Oid]:
+        """Resolves "checkout" against the mirror of "url" without fetching."""
+        if not os.path.isdir(self.mirror_path(url)):
+            return None
+        return self._resolve(Repository(self.mirror_path(url)), checkout)
+
+    @contextmanager
+    def redirect(self, url: str) -> Iterator[str]:
+        """Redirects git subprocesses cloning "url" to the local mirror.
+
+        Uses git's "url.<base>.insteadOf" configuration, injected through the environment so
+        neither the user's nor the template's configuration are modified.
+        """
+        mirror_path = self.mirror_path(url)
+        # Append to any configuration the caller may already be injecting.
+        index = int(os.environ.get('GIT_CONFIG_COUNT') or 0)
+        original = {key: os.environ.get(key) for key in (
+            'GIT_CONFIG_COUNT', f'GIT_CONFIG_KEY_{index}', f'GIT_CONFIG_VALUE_{index}'
+        )}
+
+        os.environ['GIT_CONFIG_COUNT'] = str(index + 1)
+        os.environ[f'GIT_CONFIG_KEY_{index}'] = f'url.{mirror_path}.insteadOf'
+        # Cookiecutter strips trailing slashes before cloning.
+        os.environ[f'GIT_CONFIG_VALUE_{index}'] = url.rstrip('/')
+        try:
+            yield mirror_path
+        finally:
+            for key, value in original.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
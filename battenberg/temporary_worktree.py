@@ -2,23 +2,35 @@ import os
 import shutil
 import tempfile
 import logging
+from contextlib import nullcontext
 from types import TracebackType
-from typing import Optional, Type
+from typing import ContextManager, Optional, Type
 
-from pygit2 import Repository, Worktree
+from pygit2 import Branch, Repository, Signature, Worktree
 from battenberg.errors import (
     RepositoryEmptyException,
     WorktreeConflictException,
     WorktreeException
 )
+from battenberg.profiling import PhaseTimer
+from battenberg.utils import repository_lock
 
 
 logger = logging.getLogger(__name__)
 
+EMPTY_COMMIT_MESSAGE = 'Empty templating worktree'
+# A fixed author and time keeps the empty commit, and so its ID, identical across runs.
+EMPTY_COMMIT_SIGNATURE = Signature('battenberg', 'battenberg', 0, 0)
+# Held while adding or removing worktrees. libgit2 reads every worktree's HEAD to check a branch
+# isn't checked out elsewhere, and mistakes one which is halfway added or removed by a concurrent
+# run for having the branch checked out.
+WORKTREES_LOCK = 'worktrees'
+
 
 class TemporaryWorktree:
 
-    def __init__(self, upstream: Repository, name: str, empty: bool = True):
+    def __init__(self, upstream: Repository, name: str, empty: bool = True,
+                 timer: Optional[PhaseTimer] = None):
         if name in upstream.list_worktrees():
             raise WorktreeConflictException(name)
 
@@ -30,6 +42,19 @@ class TemporaryWorktree:
         self.worktree = None
         self.repo = None
         self.empty = empty
+        self.timer = timer
+
+    def _phase(self, name: str) -> ContextManager[None]:
+        return self.timer.phase(name) if self.timer is not None else nullcontext()
+
+    def _create_empty_branch(self) -> Branch:
+        """Points the worktree's branch at a commit of the empty tree, so adding the worktree
+        doesn't check out any files at all."""
+        tree = self.upstream.TreeBuilder().write()
+        commit = self.upstream.create_commit(None, EMPTY_COMMIT_SIGNATURE, EMPTY_COMMIT_SIGNATURE,
+                                             EMPTY_COMMIT_MESSAGE, tree, [])
+        # Overwrite any branch left behind by a run which crashed.
+        return self.upstream.branches.local.create(self.name, self.upstream[commit], force=True)
 
     def __enter__(self) -> 'TemporaryWorktree':
         logger.debug(f'Creating temporary worktree at {self.path}.')
@@ -37,21 +62,22 @@ class TemporaryWorktree:
         if self.upstream.head_is_unborn:
             raise RepositoryEmptyException()
 
-        try:
-            self.worktree: Worktree = self.upstream.add_worktree(self.name, self.path)
-        except ValueError as error:
-            raise WorktreeException(self.name, self.path) from error
-
-        # Construct a separate repository instance so we can commit to a different copy and merge
-        # between branches.
-        self.repo = Repository(self.worktree.path)
-
-        if self.empty:
-            for entry in self.repo[self.repo.head.target].tree:
-                if os.path.isdir(os.path.join(self.path, entry.name)):
-                    shutil.rmtree(os.path.join(self.path, entry.name))
+        with self._phase('worktree_create'), repository_lock(self.upstream, WORKTREES_LOCK):
+            try:
+                if self.empty:
+                    self.worktree: Worktree = self.upstream.add_worktree(
+                        self.name, self.path, self._create_empty_branch())
                 else:
-                    os.remove(os.path.join(self.path, entry.name))
+                    self.worktree = self.upstream.add_worktree(self.name, self.path)
+            except ValueError as error:
+                branch = self.upstream.lookup_branch(self.name)
+                if self.empty and branch is not None:
+                    branch.delete()
+                raise WorktreeException(self.name, self.path) from error
+
+            # Construct a separate repository instance so we can commit to a different copy and
+            # merge between branches.
+            self.repo = Repository(self.worktree.path)
 
         logger.debug(f'Successfully created temporary worktree at {self.path}.')
 
@@ -60,12 +86,118 @@ class TemporaryWorktree:
     def __exit__(self, type: Optional[Type[BaseException]], value: Optional[BaseException],
                  traceback: TracebackType):
         logger.debug(f'Removing temporary worktree at {self.path}.')
-        shutil.rmtree(self.tmp)
+        with self._phase('worktree_remove'), repository_lock(self.upstream, WORKTREES_LOCK):
+            shutil.rmtree(self.tmp)
 
-        # Prune temp worktree
-        if self.worktree is not None:
-            self.worktree.prune(True)
+            # Prune temp worktree
+            if self.worktree is not None:
+                self.worktree.prune(True)
 
-        self.upstream.lookup_branch(self.name).delete()
+            # Delete the ref itself rather than the branch, libgit2 refuses to delete a branch
+            # while any worktree's HEAD looks like it refers to it, even when that worktree is
+            # stale. The branch is gone already if something else removed the worktree meanwhile.
+            ref = f'refs/heads/{self.name}'
+            if ref in self.upstream.references:
+                self.upstream.references.delete(ref)
 
         logger.debug(f'Successfully removed temporary worktree at {self.path}.')
+
+
+class PersistentWorktree(TemporaryWorktree):
+    """
+    A worktree which stays registered between runs so the upstream repository is only checked out
+    into it once.
+
+    It is emptied every time it is entered, which only costs as much as the files templated into
+    it last time. Stale state left behind by crashed runs, such as a registered worktree whose
+    directory was deleted, a directory which was never registered or a leftover index lock, is
+    cleaned up before use.
+    """
+
+    def __init__(self, upstream: Repository, name: str, path: Optional[str] = None,
+                 timer: Optional[PhaseTimer] = None):
+        self.upstream = upstream
+        self.name = name
+        # Keep the worktree within the git directory by default so it's out of the way.
+        self.path = os.path.abspath(path or os.path.join(upstream.path, 'battenberg', name))
+        # Renders are placed next to the worktree so they can be moved into it cheaply.
+        self.tmp = os.path.dirname(self.path)
+        self.worktree = None
+        self.repo = None
+        self.empty = True
+        self.timer = timer
+
+    def _remove_stale_lock(self):
+        lock_path = os.path.join(self.upstream.path, 'worktrees', self.name, 'index.lock')
+        if os.path.exists(lock_path):
+            logger.warning(f'Removing stale index lock {lock_path}.')
+            os.remove(lock_path)
+
+    def _open_worktree(self) -> Worktree:
+        with repository_lock(self.upstream, WORKTREES_LOCK):
+            return self._open_worktree_locked()
+
+    def _open_worktree_locked(self) -> Worktree:
+        if self.name in self.upstream.list_worktrees():
+            worktree = self.upstream.lookup_worktree(self.name)
+            if not worktree.is_prunable and \
+                    os.path.realpath(worktree.path) == os.path.realpath(self.path):
+                logger.debug(f'Reusing persistent worktree at {self.path}.')
+                self._remove_stale_lock()
+                return worktree
+
+            logger.debug(f'Pruning stale worktree {self.name} at {worktree.path}.')
+            worktree.prune(True)
+
+        if os.path.exists(self.path):
+            # Left behind by a run which crashed before registering the worktree.
+            shutil.rmtree(self.path)
+        os.makedirs(self.tmp, exist_ok=True)
+
+        logger.debug(f'Creating persistent worktree at {self.path}.')
+        try:
+            return self.upstream.add_worktree(self.name, self.path, self._create_empty_branch())
+        except ValueError as error:
+            raise WorktreeException(self.name, self.path) from error
+
+    def _clear(self):
+        for entry in os.listdir(self.path):
+            if entry == '.git':
+                continue
+            entry_path = os.path.join(self.path, entry)
+            if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+                shutil.rmtree(entry_path)
+            else:
+                os.remove(entry_path)
+
+    def __enter__(self) -> 'PersistentWorktree':
+        if self.upstream.head_is_unborn:
+            raise RepositoryEmptyException()
+
+        with self._phase('worktree_create'):
+            self.worktree = self._open_worktree()
+            self.repo = Repository(self.worktree.path)
+
+        with self._phase('worktree_empty'):
+            self._clear()
+
+        return self
+
+    def __exit__(self, type: Optional[Type[BaseException]], value: Optional[BaseException],
+                 traceback: TracebackType):
+        # Check the worktree's own branch back out so it doesn't keep holding on to whichever
+        # branch was templated into, e.g. the template branch.
+        if self.repo is not None and self.upstream.lookup_branch(self.name) is not None:
+            self.repo.set_head(f'refs/heads/{self.name}')
+
+    def remove(self):
+        """Unregisters and deletes the worktree along with its branch."""
+        logger.debug(f'Removing persistent worktree at {self.path}.')
+        with repository_lock(self.upstream, WORKTREES_LOCK):
+            if self.name in self.upstream.list_worktrees():
+                self.upstream.lookup_worktree(self.name).prune(True)
+            shutil.rmtree(self.path, ignore_errors=True)
+
+            branch = self.upstream.lookup_branch(self.name)
+            if branch is not None:
+                branch.delete()
@@ -1,14 +1,53 @@
 import os
+import json
+import stat
 import logging
 import re
-import subprocess
-from typing import Optional
-from pygit2 import discover_repository, init_repository, Keypair, Repository
+import shutil
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from pygit2 import (
+    Commit,
+    Diff,
+    discover_repository,
+    GitError,
+    Index,
+    IndexEntry,
+    init_repository,
+    Keypair,
+    Oid,
+    RemoteCallbacks,
+    Repository,
+    GIT_FILEMODE_BLOB,
+    GIT_FILEMODE_BLOB_EXECUTABLE,
+    GIT_FILEMODE_COMMIT,
+    GIT_FILEMODE_LINK,
+    GIT_FILEMODE_TREE,
+    GIT_DELTA_MODIFIED,
+    GIT_OBJECT_BLOB,
+    GIT_OBJECT_TREE,
+    hash as hash_blob,
+    hashfile
+)
+from cookiecutter.config import get_user_config
 from battenberg.errors import InvalidRepositoryException
 
+try:
+    import fcntl
+except ImportError:
+    # Advisory locks aren't available on Windows.
+    fcntl = None
+
 
 logger = logging.getLogger(__name__)
 
+# How long in seconds the default branch of a remote template is remembered for.
+DEFAULT_BRANCH_TTL = 300
+
+# The time each template URL's default branch was looked up at and the branch, if any.
+_default_branches: Dict[str, Tuple[float, Optional[str]]] = {}
+
 
 def open_repository(path: str) -> Repository:
     try:
@@ -26,7 +65,8 @@ def open_repository(path: str) -> Repository:
     return Repository(repo_path)
 
 
-def open_or_init_repository(path: str, template: str, initial_branch: Optional[str] = None):
+def open_or_init_repository(path: str, template: str, initial_branch: Optional[str] = None,
+                            mirror_path: Optional[str] = None):
     try:
         return open_repository(path)
     except InvalidRepositoryException:
@@ -37,7 +77,7 @@ def open_or_init_repository(path: str, template: str, initial_branch: Optional[s
 
     # Mirror the default HEAD of the template repo if client hasn't explicitly provided it.
     if not initial_branch:
-        set_initial_branch(repo, template)
+        set_initial_branch(repo, template, mirror_path)
 
     repo.create_commit(
         'HEAD',
@@ -50,18 +90,353 @@ def open_or_init_repository(path: str, template: str, initial_branch: Optional[s
     return repo
 
 
-def set_initial_branch(repo: Repository, template: str):
-    completed_process = subprocess.run(
-        ['git', 'ls-remote', '--symref', template, 'HEAD'],
-        stdout=subprocess.PIPE, encoding='utf-8')
-    found_refs = completed_process.stdout.split('\n')
+def set_initial_branch(repo: Repository, template: str, mirror_path: Optional[str] = None):
+    initial_branch = remote_default_branch(repo, template, mirror_path)
+    if initial_branch:
+        logger.debug(f'Found remote default branch: {initial_branch}')
+        repo.references['HEAD'].set_target(initial_branch)
+
+
+def remote_default_branch(repo: Repository, url: str, mirror_path: Optional[str] = None
+                          ) -> Optional[str]:
+    """Finds the branch the HEAD of the remote "url" points to, e.g. "refs/heads/main".
+
+    Looked up from the template mirror at "mirror_path" when it has already been fetched, or
+    else from the remote itself. Either way the branch is remembered for DEFAULT_BRANCH_TTL
+    seconds, so installing many copies of a template only looks it up once.
+
+    Returns:
+        The full name of the branch, or None if the remote doesn't advertise it.
+    """
+    cached = _default_branches.get(url)
+    if cached is not None and time.monotonic() - cached[0] < DEFAULT_BRANCH_TTL:
+        return cached[1]
+
+    branch = None
+    if mirror_path and os.path.isdir(mirror_path):
+        mirror = Repository(mirror_path)
+        if not mirror.head_is_unborn:
+            branch = mirror.references['HEAD'].target
+
+    if branch is None:
+        try:
+            branch = next((ref['symref_target'] for ref in list_remote_refs(repo, url)
+                           if ref['name'] == 'HEAD' and ref['symref_target']), None)
+        except GitError as e:
+            logger.debug(f'Unable to list the references of {url}: {e}')
+
+    _default_branches[url] = (time.monotonic(), branch)
+    return branch
+
+
+def list_remote_refs(repo: Repository, url: str) -> List[Dict[str, Any]]:
+    remote = repo.remotes.create_anonymous(url)
+    callbacks = RemoteCallbacks(credentials=construct_keypair())
+    if not hasattr(remote, 'list_heads'):
+        # pygit2 < 1.15 only provides the dictionary based API.
+        return remote.ls_remotes(callbacks=callbacks)
+
+    return [
+        {'name': head.name, 'oid': head.oid, 'symref_target': head.symref_target}
+        for head in remote.list_heads(callbacks=callbacks)
+    ]
+
+
+def resolve_remote_commit(repo: Repository, url: str, checkout: Optional[str] = None
+                          ) -> Optional[str]:
+    """Resolves the commit a remote reference points to without cloning the remote.
+
+    Returns:
+        The hex commit id, or None if "checkout" is not advertised by the remote.
+    """
+    if checkout and re.fullmatch(r'[0-9a-f]{40}', checkout):
+        return checkout
+
+    refs = {ref['name']: ref['oid'] for ref in list_remote_refs(repo, url)}
+    if not checkout:
+        candidates = ['HEAD']
+    else:
+        # Prefer the peeled commit of annotated tags over the tag object itself.
+        candidates = [f'refs/tags/{checkout}^{{}}', f'refs/tags/{checkout}',
+                      f'refs/heads/{checkout}', checkout]
+
+    for name in candidates:
+        if refs.get(name) is not None:
+            return str(refs[name])
+    return None
+
+
+def filemode(st_mode: int) -> int:
+    """The git file mode of a file with the stat "st_mode"."""
+    if stat.S_ISLNK(st_mode):
+        return GIT_FILEMODE_LINK
+    if st_mode & stat.S_IXUSR:
+        return GIT_FILEMODE_BLOB_EXECUTABLE
+    return GIT_FILEMODE_BLOB
+
+
+def _write_directory_tree(repo: Repository, relative_path: str) -> Optional[Oid]:
+    builder = repo.TreeBuilder()
+    entries = 0
+    for entry in os.scandir(os.path.join(repo.workdir, relative_path)):
+        path = f'{relative_path}/{entry.name}' if relative_path else entry.name
+        if entry.name == '.git':
+            continue
+
+        if entry.is_dir(follow_symlinks=False):
+            if repo.path_is_ignored(f'{path}/'):
+                continue
+            oid = _write_directory_tree(repo, path)
+            if oid is None:
+                # Much like git, skip empty directories.
+                continue
+            mode = GIT_FILEMODE_TREE
+        else:
+            if repo.path_is_ignored(path):
+                continue
+            # Applies the same filters (e.g. line endings) as staging the file would.
+            oid = repo.create_blob_fromworkdir(path)
+            mode = filemode(entry.stat(follow_symlinks=False).st_mode)
+
+        builder.insert(entry.name, oid, mode)
+        entries += 1
+
+    if not entries and relative_path:
+        return None
+    return builder.write()
+
+
+# The blob ID and file mode of files to stage without them existing on disk, by relative path.
+Blobs = Dict[str, Tuple[Oid, int]]
+
+
+def create_tree_from_directory(repo: Repository, path: str, blobs: Optional[Blobs] = None) -> Oid:
+    """Writes the contents of a directory into the object database of "repo" as a tree.
+
+    This produces the same tree as staging every file of "path" in a worktree would, including
+    honoring ignore rules, without needing a worktree checkout or an index file. Any "blobs" are
+    added as though they were files of "path".
+
+    Returns:
+        The id of the written tree.
+    """
+    # Open a separate handle on the same object database whose working directory is "path" so
+    # ignore rules and filters are evaluated against it, just as they would be in a worktree.
+    workdir_repo = Repository(repo.path)
+    workdir_repo.workdir = path
+    tree = _write_directory_tree(workdir_repo, '')
+    if not blobs:
+        return tree
+
+    index = Index()
+    index.read_tree(repo[tree])
+    for blob_path, (oid, mode) in blobs.items():
+        if not workdir_repo.path_is_ignored(blob_path):
+            index.add(IndexEntry(blob_path, oid, mode))
+    return index.write_tree(repo)
+
+
+def list_files(path: str) -> List[str]:
+    """Lists the files, including symlinks, beneath "path" as "/" separated relative paths."""
+    files = []
+    for root, dirnames, filenames in os.walk(path):
+        relative_root = os.path.relpath(root, path).replace(os.sep, '/')
+        prefix = '' if relative_root == '.' else f'{relative_root}/'
+        # Git treats symlinks to directories like any other file.
+        links = [name for name in dirnames if os.path.islink(os.path.join(root, name))]
+        dirnames[:] = [name for name in dirnames if name != '.git' and name not in links]
+        files.extend(f'{prefix}{name}' for name in filenames + links)
+    return files
+
+
+def _unchanged(repo: Repository, path: str, entry: IndexEntry) -> bool:
+    st_mode = os.lstat(os.path.join(repo.workdir, path)).st_mode
+    if entry.mode != filemode(st_mode):
+        return False
+    if stat.S_ISLNK(st_mode):
+        return entry.id == hash_blob(os.readlink(os.path.join(repo.workdir, path)))
+    return entry.id == hashfile(os.path.join(repo.workdir, path))
+
+
+def stage_paths(repo: Repository, paths: Iterable[str], blobs: Optional[Blobs] = None) -> Oid:
+    """Stages exactly "paths", and "blobs", on top of the HEAD tree of "repo", typically a
+    worktree.
+
+    Unlike Index.add_all only "paths" are examined. Files of HEAD which are missing from "paths"
+    are removed, while files whose content and mode match HEAD keep their existing entries
+    instead of being added again. New files which are ignored are skipped, just as add_all
+    would.
+
+    Returns:
+        The id of the staged tree.
+    """
+    blobs = blobs or {}
+    paths = set(paths) | set(blobs)
+    index = repo.index
+    index.read_tree(repo[repo.head.target].peel(Commit).tree)
+
+    for entry in list(index):
+        if entry.path not in paths:
+            index.remove(entry.path)
+
+    for path in sorted(paths):
+        if path in index:
+            if path in blobs and (index[path].id, index[path].mode) == blobs[path] or \
+                    path not in blobs and _unchanged(repo, path, index[path]):
+                continue
+        elif repo.path_is_ignored(path):
+            continue
+
+        if path in blobs:
+            index.add(IndexEntry(path, *blobs[path]))
+        else:
+            index.add(path)
+
+    index.write()
+    return index.write_tree()
+
+
+CONFLICT_BOTH_MODIFIED = 'both-modified'
+CONFLICT_BOTH_ADDED = 'both-added'
+CONFLICT_DELETED_BY_US = 'deleted-by-us'
+CONFLICT_DELETED_BY_THEM = 'deleted-by-them'
+
+
+def describe_conflicts(index: Index) -> List[Dict[str, Any]]:
+    """Describes the conflicts of a merged index, "ours" being the merge target and "theirs" the
+    template branch.
+
+    Returns:
+        A JSON serializable description of each conflict, sorted by path, holding the "path",
+        conflict "type" and the "ancestor", "ours" and "theirs" blob IDs, which are None when the
+        path doesn't exist on that side.
+    """
+    if index.conflicts is None:
+        return []
+
+    conflicts = []
+    for ancestor, ours, theirs in index.conflicts:
+        if ours is None:
+            conflict_type = CONFLICT_DELETED_BY_US
+        elif theirs is None:
+            conflict_type = CONFLICT_DELETED_BY_THEM
+        elif ancestor is None:
+            conflict_type = CONFLICT_BOTH_ADDED
+        else:
+            conflict_type = CONFLICT_BOTH_MODIFIED
+
+        conflicts.append({
+            'path': next(entry.path for entry in (ours, theirs, ancestor) if entry is not None),
+            'type': conflict_type,
+            'ancestor': str(ancestor.id) if ancestor else None,
+            'ours': str(ours.id) if ours else None,
+            'theirs': str(theirs.id) if theirs else None
+        })
+    return sorted(conflicts, key=lambda conflict: conflict['path'])
+
+
+# The directory cookiecutter rendered into, which it records in the context and so in any context
+# file rendered from "{{ cookiecutter | jsonify }}". Every render uses a fresh temporary directory.
+_OUTPUT_DIR_PATTERN = re.compile(rb'("_output_dir"\s*:\s*)"(?:[^"\\]|\\.)*"')
+
+
+def _strip_output_dir(data: bytes) -> bytes:
+    return _OUTPUT_DIR_PATTERN.sub(rb'\1""', data)
+
+
+def is_same_render(repo: Repository, tree: Oid, other: Oid,
+                   context_file: str = '.cookiecutter.json') -> bool:
+    """Determines whether two rendered trees are identical but for where they were rendered.
+
+    Only the output directory recorded in "context_file" may differ, every other file, and the
+    rest of the context file, must be byte for byte identical.
+    """
+    if tree == other:
+        return True
+
+    diff: Diff = repo[other].diff_to_tree(repo[tree])
+    return all(delta.status == GIT_DELTA_MODIFIED
+               and delta.new_file.path == context_file
+               and delta.old_file.mode == delta.new_file.mode
+               and _strip_output_dir(repo[delta.old_file.id].data) ==
+               _strip_output_dir(repo[delta.new_file.id].data)
+               for delta in diff.deltas)
+
+
+def copy_tree_objects(source: Repository, target: Repository, tree: Oid):
+    """Copies "tree", and every blob and tree it references, from "source" into "target".
+
+    Object IDs are content addressed so the tree keeps the same ID in "target". Any objects
+    "target" already contains, along with everything they reference, are skipped.
+    """
+    if tree in target:
+        return
+
+    for entry in source[tree]:
+        if entry.filemode == GIT_FILEMODE_TREE:
+            copy_tree_objects(source, target, entry.id)
+        elif entry.filemode != GIT_FILEMODE_COMMIT and entry.id not in target:
+            # Submodule commits live in another repository entirely.
+            target.odb.write(GIT_OBJECT_BLOB, source[entry.id].read_raw())
+
+    target.odb.write(GIT_OBJECT_TREE, source[tree].read_raw())
+
+
+def link_or_copy(src: str, dst: str) -> str:
+    """Hardlinks "src" to "dst", falling back to a copy where hardlinks aren't possible, e.g.
+    across filesystems. Suitable as the "copy_function" of shutil.copytree and shutil.move."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        return shutil.copy2(src, dst)
+    return dst
+
+
+def link_tree(src: str, dst: str):
+    """Recreates the directory "src" at "dst" without copying file contents where possible.
+
+    The files of both directories share storage so neither should be modified in place.
+    """
+    shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True, copy_function=link_or_copy)
+
+
+@contextmanager
+def repository_lock(repo: Repository, name: str) -> Iterator[None]:
+    """Holds the advisory lock "name" of "repo" for the duration, waiting for any other process
+    or thread holding it to release it first.
+
+    The lock is a file within the git directory, so it's released by the operating system even
+    if the holder crashes. Without fcntl, i.e. on Windows, nothing is locked.
+    """
+    path = os.path.join(repo.path, 'battenberg', f'{name}.lock')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is None:
+            yield
+            return
+
+        logger.debug(f'Waiting for lock {path}.')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def init_render_worker(clone_dir: str):
+    """Initializes a worker process rendering templates alongside others.
 
-    if found_refs:
-        match = re.match(r"^ref: (?P<initial_branch>(\w+)/(\w+)/(\w+))\s*HEAD", found_refs[0])
-        if match:
-            initial_branch = match.group('initial_branch')
-            logger.debug(f'Found remote default branch: {initial_branch}')
-            repo.references['HEAD'].set_target(initial_branch)
+    Cookiecutter clones remote templates into the same directory for every render, and removes
+    whatever is there first, so each worker process gets a directory of its own within
+    "clone_dir" to keep concurrent renders from colliding.
+    """
+    config = get_user_config()
+    config['cookiecutters_dir'] = os.path.join(clone_dir, str(os.getpid()))
+    # JSON is valid YAML, which cookiecutter reads its configuration as.
+    config_file = os.path.join(clone_dir, f'{os.getpid()}.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    os.environ['COOKIECUTTER_CONFIG'] = config_file
 
 
 def construct_keypair(public_key_path: str = None, private_key_path: str = None,
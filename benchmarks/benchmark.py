@@ -0,0 +1,338 @@
+"""
+Benchmarks battenberg installs and upgrades against synthetic host repositories and templates.
+
+Everything runs locally, templates are served to cookiecutter through file:// URLs. Results are
+written as JSON so they can be compared between battenberg versions, e.g.:
+
+    python benchmarks/benchmark.py --output before.json
+    git checkout my-branch
+    python benchmarks/benchmark.py --output after.json --baseline before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import statistics
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, IO, Iterator, List, Optional
+import click
+import cookiecutter
+import pygit2
+from pygit2 import (
+    Index,
+    IndexEntry,
+    Repository,
+    Signature,
+    init_repository,
+    GIT_CHECKOUT_FORCE,
+    GIT_FILEMODE_BLOB
+)
+
+import battenberg
+from battenberg.core import Battenberg, WORKTREE_NAME
+from battenberg.profiling import PhaseTimer
+from battenberg.temporary_worktree import TemporaryWorktree
+
+
+logger = logging.getLogger('battenberg.benchmark')
+
+SIGNATURE = Signature('benchmark', 'benchmark@example.com', 0, 0)
+CONTEXT_FILE = '.cookiecutter.json'
+# Directory the template renders into, cookiecutter requires exactly one top-level directory.
+TEMPLATE_ROOT = '{{cookiecutter.project_name}}'
+
+SCENARIOS = ['install', 'upgrade', 'worktree', 'worktree_checkout', 'merge']
+
+# Renders a loop per file so the Jinja templating itself carries a realistic cost.
+JINJA_MODULE = """\
+# Generated for {{ cookiecutter.project_name }} by {{ cookiecutter.author }}.
+{% for n in range(cookiecutter.loops | int) %}
+{%- if n % 2 %}
+VALUE_{{ n }} = '{{ cookiecutter.project_name | upper }}-{{ n }}'
+{%- else %}
+VALUE_{{ n }} = '{{ cookiecutter.author | title }}-{{ n * 2 }}'
+{%- endif %}
+{%- endfor %}
+"""
+
+
+def _write_commit(repo: Repository, files: Dict[str, bytes], message: str,
+                  parents: List[pygit2.Oid], ref: Optional[str] = None) -> pygit2.Oid:
+    index = Index()
+    for path, data in files.items():
+        index.add(IndexEntry(path, repo.create_blob(data), GIT_FILEMODE_BLOB))
+    tree = index.write_tree(repo)
+    return repo.create_commit(ref, SIGNATURE, SIGNATURE, message, tree, parents)
+
+
+def make_host_repo(path: str, files: int, commits: int, seed: int = 0) -> Repository:
+    """Creates a repository of "files" text files spread over nested directories, with a
+    history of "commits" commits each modifying a handful of them."""
+    rng = random.Random(seed)
+    repo = init_repository(path, initial_head='main')
+    contents = {
+        f'host/{i % 10}/{i // 10 % 100}/file_{i}.txt': f'file {i} revision 0\n'.encode() * 20
+        for i in range(files)
+    }
+    paths = list(contents)
+    parents = []
+    for revision in range(commits):
+        if revision:
+            for changed in rng.sample(paths, min(len(paths), 10)):
+                contents[changed] = f'{changed} revision {revision}\n'.encode() * 20
+        parents = [_write_commit(repo, contents, f'Revision {revision}', parents, 'HEAD')]
+
+    repo.checkout_head(strategy=GIT_CHECKOUT_FORCE)
+    return repo
+
+
+def _template_files(files: int, binaries: int, binary_size: int, revision: int,
+                    changed: float, seed: int) -> Dict[str, bytes]:
+    rng = random.Random(seed)
+    changed_files = set(rng.sample(range(files), int(files * changed))) if revision else set()
+    contents = {
+        'cookiecutter.json': json.dumps({
+            'project_name': 'benchmark',
+            'author': 'battenberg',
+            'loops': '50'
+        }, indent=4).encode(),
+        f'{TEMPLATE_ROOT}/{CONTEXT_FILE}': b'{{ cookiecutter | jsonify }}'
+    }
+    for i in range(files):
+        module_revision = revision if i in changed_files else 0
+        contents[f'{TEMPLATE_ROOT}/bench/{i % 10}/module_{i}.py'] = (
+            f'{JINJA_MODULE}MODULE = {i}\nREVISION = {module_revision}\n').encode()
+    for i in range(binaries):
+        # Binaries are detected by cookiecutter and copied without rendering.
+        contents[f'{TEMPLATE_ROOT}/assets/blob_{i}.bin'] = rng.randbytes(binary_size)
+    return contents
+
+
+def make_template_repo(path: str, files: int, binaries: int, binary_size: int,
+                       changed: float, seed: int = 0) -> str:
+    """Creates a template repository tagged "v1" and "v2", where "v2" modifies the "changed"
+    fraction of the templated files.
+
+    Returns:
+        The file:// URL of the template.
+    """
+    # Cookiecutter only recognises URLs which mention git, so name the repository accordingly.
+    path = os.path.join(path, 'template.git')
+    repo = init_repository(path, initial_head='main')
+    parents = []
+    for revision in (1, 2):
+        contents = _template_files(files, binaries, binary_size, revision - 1, changed, seed)
+        commit = _write_commit(repo, contents, f'Template v{revision}', parents, 'HEAD')
+        repo.references.create(f'refs/tags/v{revision}', commit)
+        parents = [commit]
+
+    repo.checkout_head(strategy=GIT_CHECKOUT_FORCE)
+    return f'file://{path}'
+
+
+def _install(repo: Repository, template: str, timer: PhaseTimer,
+             render_jobs: Optional[int] = None, render_memo: bool = False):
+    battenberg = Battenberg(repo, timer=timer, render_jobs=render_jobs, render_memo=render_memo)
+    battenberg.install(template, checkout='v1', no_input=True)
+
+
+class Fixtures:
+    """Generates the synthetic repositories once, copying them for each run so every run starts
+    from the same state."""
+
+    def __init__(self, root: str, host_files: int, commits: int, template_files: int,
+                 binaries: int, binary_size: int, changed: float,
+                 render_jobs: Optional[int] = None, render_memo: bool = False):
+        self.root = root
+        self.render_jobs = render_jobs
+        self.render_memo = render_memo
+        self.host = os.path.join(root, 'host')
+        self.installed = os.path.join(root, 'installed')
+
+        logger.info(f'Generating a host repository with {host_files} files and {commits} commits.')
+        make_host_repo(self.host, host_files, commits)
+        logger.info(f'Generating a template with {template_files} files and {binaries} binaries.')
+        self.template = make_template_repo(root, template_files, binaries, binary_size, changed)
+
+        shutil.copytree(self.host, self.installed, symlinks=True)
+        # Installing with the memo lets upgrades reuse the files which didn't change.
+        _install(Repository(self.installed), self.template, PhaseTimer(),
+                 render_memo=render_memo)
+
+    @contextmanager
+    def copy(self, source: str) -> Iterator[Repository]:
+        path = tempfile.mkdtemp(dir=self.root)
+        try:
+            shutil.copytree(source, path, symlinks=True, dirs_exist_ok=True)
+            yield Repository(path)
+        finally:
+            shutil.rmtree(path)
+
+
+def bench_install(fixtures: Fixtures, timer: PhaseTimer) -> Iterator[Callable[[], Any]]:
+    with fixtures.copy(fixtures.host) as repo:
+        yield lambda: _install(repo, fixtures.template, timer, fixtures.render_jobs,
+                               fixtures.render_memo)
+
+
+def bench_upgrade(fixtures: Fixtures, timer: PhaseTimer) -> Iterator[Callable[[], Any]]:
+    with fixtures.copy(fixtures.installed) as repo:
+        battenberg = Battenberg(repo, timer=timer, render_jobs=fixtures.render_jobs,
+                                render_memo=fixtures.render_memo)
+        yield lambda: battenberg.upgrade(checkout='v2', no_input=True)
+
+
+def _bench_worktree(fixtures: Fixtures, timer: PhaseTimer,
+                    empty: bool) -> Iterator[Callable[[], Any]]:
+    def run():
+        with TemporaryWorktree(repo, WORKTREE_NAME, empty=empty, timer=timer):
+            pass
+
+    with fixtures.copy(fixtures.installed) as repo:
+        yield run
+
+
+def bench_worktree(fixtures: Fixtures, timer: PhaseTimer) -> Iterator[Callable[[], Any]]:
+    yield from _bench_worktree(fixtures, timer, empty=True)
+
+
+def bench_worktree_checkout(fixtures: Fixtures, timer: PhaseTimer) -> Iterator[Callable[[], Any]]:
+    yield from _bench_worktree(fixtures, timer, empty=False)
+
+
+def bench_merge(fixtures: Fixtures, timer: PhaseTimer) -> Iterator[Callable[[], Any]]:
+    with fixtures.copy(fixtures.installed) as repo:
+        # Commit the upgraded template up front so only the merge itself is measured.
+        battenberg = Battenberg(repo, timer=timer)
+        cookiecutter_kwargs = battenberg._get_upgrade_cookiecutter_kwargs(
+            'v2', True, None, CONTEXT_FILE, False)
+        battenberg._commit_template_upgrade(battenberg._write_template_tree(cookiecutter_kwargs))
+        del timer.phases[:]
+        yield lambda: battenberg._merge_template_branch('Upgraded template')
+
+
+BENCHMARKS = {
+    'install': bench_install,
+    'upgrade': bench_upgrade,
+    'worktree': bench_worktree,
+    'worktree_checkout': bench_worktree_checkout,
+    'merge': bench_merge
+}
+
+
+def run_scenario(fixtures: Fixtures, scenario: str, repeat: int) -> Dict[str, Any]:
+    runs = []
+    phases = []
+    for _ in range(repeat):
+        timer = PhaseTimer()
+        # Each benchmark sets up its own fresh copy before yielding the operation to time.
+        setup = BENCHMARKS[scenario](fixtures, timer)
+        operation = next(setup)
+        start = time.perf_counter()
+        operation()
+        runs.append(time.perf_counter() - start)
+        phases.append(timer.report()['phases'])
+        setup.close()
+
+    return {
+        'scenario': scenario,
+        'runs': runs,
+        'min': min(runs),
+        'median': statistics.median(runs),
+        'phases': phases
+    }
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        'battenberg': battenberg.__version__,
+        'cookiecutter': cookiecutter.__version__,
+        'pygit2': pygit2.__version__,
+        'libgit2': pygit2.LIBGIT2_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform()
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> str:
+    """A human readable comparison of the median time of each scenario against "baseline"."""
+    previous = {result['scenario']: result['median'] for result in baseline['results']}
+    width = max(len(scenario) for scenario in SCENARIOS)
+    lines = []
+    for result in results['results']:
+        line = f"{result['scenario']:<{width}}  {result['median']:8.3f}s"
+        if previous.get(result['scenario']):
+            ratio = result['median'] / previous[result['scenario']]
+            line += f"  {previous[result['scenario']]:8.3f}s  {ratio:6.2f}x"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--host-files', default=1000, show_default=True,
+              help='The number of files in the synthetic host repository.')
+@click.option('--commits', default=50, show_default=True,
+              help='The number of commits in the history of the host repository.')
+@click.option('--template-files', default=500, show_default=True,
+              help='The number of Jinja templated files in the synthetic template.')
+@click.option('--binaries', default=10, show_default=True,
+              help='The number of binary files in the synthetic template.')
+@click.option('--binary-size', default=1024 * 1024, show_default=True,
+              help='The size in bytes of each binary file in the template.')
+@click.option('--changed', default=0.05, show_default=True,
+              help='The fraction of templated files which change between template versions.')
+@click.option('--render-jobs', type=click.IntRange(min=1),
+              help='Render template files across this many processes.')
+@click.option('--render-memo', is_flag=True,
+              help='Reuse the rendered files of unchanged template files when upgrading.')
+@click.option('--repeat', default=3, show_default=True,
+              help='How many times to run each scenario.')
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(SCENARIOS),
+              help='Only run these scenarios, defaults to all of them.')
+@click.option('--output', type=click.File('w'), default='-',
+              help='Where to write the JSON results, defaults to stdout.')
+@click.option('--baseline', type=click.File('r'),
+              help='JSON results of a previous run to compare the median timings against.')
+def main(host_files: int, commits: int, template_files: int, binaries: int, binary_size: int,
+         changed: float, render_jobs: Optional[int], render_memo: bool, repeat: int,
+         scenarios: List[str], output: IO[str], baseline: Optional[IO[str]]):
+    """Benchmarks battenberg against synthetic repositories and templates."""
+    logging.basicConfig(level=logging.INFO)
+    root = tempfile.mkdtemp()
+    try:
+        fixtures = Fixtures(root, host_files, commits, template_files, binaries, binary_size,
+                            changed, render_jobs, render_memo)
+        results = {
+            'environment': environment(),
+            'parameters': {
+                'host_files': host_files,
+                'commits': commits,
+                'template_files': template_files,
+                'binaries': binaries,
+                'binary_size': binary_size,
+                'changed': changed,
+                'render_jobs': render_jobs,
+                'render_memo': render_memo,
+                'repeat': repeat
+            },
+            'results': []
+        }
+        for scenario in scenarios or SCENARIOS:
+            logger.info(f'Running {scenario}.')
+            results['results'].append(run_scenario(fixtures, scenario, repeat))
+    finally:
+        shutil.rmtree(root)
+
+    json.dump(results, output, indent=2)
+    output.write('\n')
+    if baseline:
+        click.echo(compare(results, json.load(baseline)), err=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
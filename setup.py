@@ -15,7 +15,7 @@ with io.open('battenberg/__init__.py', 'rt', encoding='utf8') as f:
 
 install_requires = [
     'Click>=6.0',
-    'cookiecutter>=1.6.0',
+    'cookiecutter>=2.6',
     # You'll also need to install libgit2 to get this to work.
     # See instructions here: https://www.pygit2.org/install.html
     'pygit2>=1.0'
@@ -82,6 +82,15 @@ def template_repo() -> Repository:
     return repo
 
 
+@pytest.fixture
+def template_url(template_repo: Repository) -> str:
+    # Cookiecutter only recognises URLs which mention git and names its clone after the last
+    # path segment, so link the template repo under a conventional "<name>.git" path.
+    path = os.path.join(tempfile.mkdtemp(), 'template.git')
+    os.symlink(template_repo.workdir, path)
+    return f'file://{path}'
+
+
 @pytest.fixture
 def installed_repo(repo: Repository, template_repo: Repository) -> Repository:
     battenberg = Battenberg(repo)
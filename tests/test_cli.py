@@ -1,11 +1,24 @@
+import os
+import json
+import shutil
 from typing import Dict
 from unittest.mock import Mock, patch
 import pytest
 from click.testing import CliRunner
 from cookiecutter.exceptions import CookiecutterException
 from pygit2 import Repository
-from battenberg import cli
+from battenberg import cli, core
+from battenberg.core import (
+    InstallResult,
+    MergeTargetResult,
+    UpgradeResult,
+    INSTALL_ERROR,
+    INSTALL_SUCCESS,
+    UPGRADE_CONFLICT,
+    UPGRADE_SUCCESS
+)
 from battenberg.errors import BattenbergException, MergeConflictException
+from tests.conftest import TemporaryRepository
 
 
 @pytest.fixture
@@ -44,10 +57,43 @@ def test_install(Battenberg: Mock, obj: Dict):
     assert result.exit_code == 0
     assert result.output == ''
     Battenberg.return_value.install.assert_called_once_with(
-        template, checkout=None, no_input=False
+        template, checkout=None, no_input=False, use_worktree=True,
+        in_memory=False
     )
 
 
+def test_install_many(obj: Dict):
+    manifest = [{'target': 'repo-a', 'context': {'name': 'a'}}, {'target': '/repo-b'}]
+    with patch('battenberg.cli.BatchInstaller') as BatchInstaller:
+        BatchInstaller.return_value.install.return_value = [
+            InstallResult('out/repo-a', INSTALL_SUCCESS, seconds=1.5),
+            InstallResult('/repo-b', INSTALL_ERROR, 'test-error', 0.25)
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(cli.install_many, ['test-template', '-', '--jobs', '2'],
+                               input=json.dumps(manifest), obj={'target': 'out'})
+
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        'success: out/repo-a [1.50s]',
+        'error: /repo-b [0.25s] (test-error)',
+        'Installed 1/2 repositories'
+    ]
+    assert BatchInstaller.call_args.args == (
+        [('out/repo-a', {'name': 'a'}), ('/repo-b', None)],)
+    BatchInstaller.return_value.install.assert_called_once_with(
+        'test-template', jobs=2, initial_branch=None, checkout=None)
+
+
+def test_install_many_invalid_manifest(obj: Dict):
+    runner = CliRunner()
+    result = runner.invoke(cli.install_many, ['test-template', '-'], input='[{}]', obj=obj)
+
+    assert result.exit_code == 2
+    assert 'Expected a JSON list of targets' in result.output
+
+
 def test_upgrade(Battenberg: Mock, obj: Dict):
     runner = CliRunner()
     result = runner.invoke(cli.upgrade, obj=obj)
@@ -58,23 +104,253 @@ def test_upgrade(Battenberg: Mock, obj: Dict):
         checkout=None,
         context_file='.cookiecutter.json',
         merge_target=None,
-        no_input=False
+        no_input=False,
+        use_worktree=True,
+        in_memory=False,
+        bare=False,
+        output_branch=None,
+        persistent_worktree=False
     )
 
 
+def test_upgrade_many_merge_targets(Battenberg: Mock, obj: Dict):
+    Battenberg.return_value.upgrade.return_value = [
+        MergeTargetResult('release-a', UPGRADE_SUCCESS),
+        MergeTargetResult('release-b', UPGRADE_CONFLICT, 'test-conflict')
+    ]
+
+    runner = CliRunner()
+    result = runner.invoke(cli.upgrade, ['--merge-target', 'release-a',
+                                         '--merge-target', 'release-b'], obj=obj)
+
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        'success: release-a',
+        'conflict: release-b (test-conflict)',
+        'Upgraded 1/2 merge targets'
+    ]
+    assert Battenberg.return_value.upgrade.call_args.kwargs['merge_target'] == [
+        'release-a', 'release-b']
+
+
+def test_render_jobs(Battenberg: Mock, installed_repo: Repository):
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ['-O', installed_repo.workdir, '--render-jobs', '4',
+                                      'upgrade'])
+
+    assert result.exit_code == 0, result.output
+    assert Battenberg.call_args.kwargs['render_jobs'] == 4
+
+
+def test_shared_objects_dir(Battenberg: Mock, installed_repo: Repository, tmpdir):
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ['-O', installed_repo.workdir, '--shared-objects-dir',
+                                      str(tmpdir), 'upgrade'])
+
+    assert result.exit_code == 0, result.output
+    assert Battenberg.call_args.kwargs['shared_objects'].path == str(tmpdir)
+
+
+CONFLICTS = [{
+    'path': '.cookiecutter.json',
+    'type': 'both-modified',
+    'ancestor': 'test-ancestor',
+    'ours': 'test-ours',
+    'theirs': 'test-theirs'
+}]
+
+
 def test_upgrade_raises_merge_conflicts(Battenberg: Mock, obj: Dict):
-    Battenberg.return_value.upgrade.side_effect = MergeConflictException
-    stdout = b'test-stdout'  # Use a bytestream as subprocess does.
+    Battenberg.return_value.upgrade.side_effect = MergeConflictException('test-conflict',
+                                                                         CONFLICTS)
+
+    runner = CliRunner()
+    result = runner.invoke(cli.upgrade, obj=obj)
+
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        'Unmerged paths:',
+        '  both-modified: .cookiecutter.json',
+        'Cannot merge upgrade automatically, please manually resolve the conflicts'
+    ]
+
+
+def test_upgrade_reports_merge_conflicts_as_json(Battenberg: Mock, obj: Dict):
+    Battenberg.return_value.upgrade.side_effect = MergeConflictException('test-conflict',
+                                                                         CONFLICTS)
+
+    runner = CliRunner()
+    result = runner.invoke(cli.upgrade, ['--conflict-format', 'json'], obj=obj)
+
+    assert result.exit_code == 1
+    assert json.loads(result.output) == {'message': 'test-conflict', 'conflicts': CONFLICTS}
+
+
+def test_upgrade_many(Battenberg: Mock, obj: Dict):
+    with patch('battenberg.cli.open_repository') as open_repository:
+        runner = CliRunner()
+        result = runner.invoke(cli.upgrade_many, ['repo-a', 'repo-b', '--jobs', '1'], obj=obj)
+
+        assert [c.args for c in open_repository.call_args_list] == [('repo-a',), ('repo-b',)]
+
+    assert result.exit_code == 0
+    assert 'success: repo-a' in result.output
+    assert 'success: repo-b' in result.output
+    assert Battenberg.return_value.upgrade.call_count == 2
+    Battenberg.return_value.upgrade.assert_called_with(
+        checkout=None,
+        context_file='.cookiecutter.json',
+        merge_target=None,
+        no_input=True,
+        use_worktree=True,
+        in_memory=False,
+        bare=False,
+        output_branch=None,
+        persistent_worktree=False
+    )
+
 
-    with patch('battenberg.cli.subprocess') as subprocess:
-        completed_process = subprocess.run.return_value
-        completed_process.stdout = stdout
+def test_upgrade_many_remote_template_in_parallel(template_url: str, tmpdir):
+    repositories = []
+    for i in range(6):
+        with TemporaryRepository() as repo_path:
+            path = str(tmpdir.join(f'repo-{i}'))
+            shutil.copytree(repo_path, path)
+        core.Battenberg(Repository(path)).install(template_url, no_input=True)
+        repositories.append(path)
 
+    runner = CliRunner()
+    # Each worker must clone the template into a directory of its own.
+    result = runner.invoke(cli.upgrade_many, repositories + [
+        '--jobs', '4', '--checkout', 'upgrade', '--in-memory'], obj={'target': '.'})
+
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines()[-1] == 'Upgraded 6/6 repositories'
+
+
+def test_upgrade_many_reports_failures(Battenberg: Mock, obj: Dict):
+    Battenberg.return_value.upgrade.side_effect = [
+        MergeConflictException('test-conflict'),
+        BattenbergException('test-error'),
+        False
+    ]
+
+    with patch('battenberg.cli.open_repository'):
+        runner = CliRunner()
+        result = runner.invoke(cli.upgrade_many, ['repo-a', 'repo-b', 'repo-c', '--jobs', '1'],
+                               obj=obj)
+
+    assert result.exit_code == 1
+    assert 'conflict: repo-a (test-conflict)' in result.output
+    assert 'error: repo-b (test-error)' in result.output
+    assert 'no-changes: repo-c' in result.output
+    assert 'Upgraded 1/3 repositories' in result.output
+
+
+def test_upgrade_plan(Battenberg: Mock, obj: Dict):
+    Battenberg.return_value.plan_upgrade.return_value = {'conflicts': ['test-path']}
+
+    runner = CliRunner()
+    result = runner.invoke(cli.upgrade, ['--plan'], obj=obj)
+
+    assert result.exit_code == 0
+    assert result.output == '{"conflicts": ["test-path"]}\n'
+    Battenberg.return_value.upgrade.assert_not_called()
+    Battenberg.return_value.plan_upgrade.assert_called_once_with(
+        checkout=None,
+        no_input=False,
+        merge_target=None,
+        context_file='.cookiecutter.json',
+        bare=False
+    )
+
+
+def test_upgrade_many_plan(Battenberg: Mock, obj: Dict):
+    Battenberg.return_value.plan_upgrade.side_effect = [
+        {'repository': 'repo-a', 'conflicts': []},
+        BattenbergException('test-error')
+    ]
+
+    with patch('battenberg.cli.open_repository'):
+        runner = CliRunner()
+        result = runner.invoke(cli.upgrade_many, ['repo-a', 'repo-b', '--jobs', '1', '--plan'],
+                               obj=obj)
+
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        '{"conflicts": [], "repository": "repo-a"}',
+        '{"error": "test-error", "repository": "repo-b"}'
+    ]
+
+
+def test_profile(Battenberg: Mock, tmpdir):
+    def upgrade(**kwargs):
+        with Battenberg.call_args.kwargs['timer'].phase('upgrade'):
+            return True
+
+    Battenberg.return_value.upgrade.side_effect = upgrade
+    profile_output = os.path.join(str(tmpdir), 'profile.json')
+
+    with patch('battenberg.cli.open_repository'):
         runner = CliRunner()
-        result = runner.invoke(cli.upgrade, obj=obj)
+        result = runner.invoke(cli.main, ['--profile', '--profile-output', profile_output,
+                                          'upgrade'])
+
+    assert result.exit_code == 0
+    assert result.stderr.splitlines()[0].startswith('upgrade ')
+    with open(profile_output) as f:
+        report = json.load(f)
+    assert [record['phase'] for record in report['phases']] == ['upgrade']
+    assert report['total'] == report['phases'][0]['seconds']
 
-        subprocess.run.assert_called_once_with(['git', 'status'], stdout=subprocess.PIPE,
-                                               stderr=subprocess.STDOUT)
+
+def test_upgrade_many_dedupe(obj: Dict):
+    with patch('battenberg.cli.BatchUpgrader') as BatchUpgrader:
+        BatchUpgrader.return_value.group.return_value = [['repo-a', 'repo-c'], ['repo-b']]
+        BatchUpgrader.return_value.upgrade.side_effect = [
+            [UpgradeResult('repo-a', UPGRADE_SUCCESS), UpgradeResult('repo-c', UPGRADE_SUCCESS)],
+            [UpgradeResult('repo-b', UPGRADE_CONFLICT, 'test-conflict')]
+        ]
+
+        runner = CliRunner()
+        result = runner.invoke(cli.upgrade_many,
+                               ['repo-a', 'repo-b', 'repo-c', '--dedupe', '--jobs', '1'], obj=obj)
 
     assert result.exit_code == 1
-    assert stdout.decode('utf-8') in result.output
+    assert result.output.splitlines() == [
+        'success: repo-a',
+        'conflict: repo-b (test-conflict)',
+        'success: repo-c',
+        'Upgraded 2/3 repositories'
+    ]
+    BatchUpgrader.return_value.group.assert_called_once_with(
+        checkout=None,
+        merge_target=None,
+        context_file='.cookiecutter.json',
+        bare=False
+    )
+    BatchUpgrader.return_value.upgrade.assert_called_with(
+        checkout=None,
+        merge_target=None,
+        context_file='.cookiecutter.json',
+        in_memory=False,
+        bare=False,
+        output_branch=None
+    )
+
+
+def test_progress(Battenberg: Mock):
+    def upgrade(**kwargs):
+        Battenberg.call_args.kwargs['progress'].emit('test-event', key='value')
+        return True
+
+    Battenberg.return_value.upgrade.side_effect = upgrade
+
+    with patch('battenberg.cli.open_repository'):
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ['--progress', '-', 'upgrade'])
+
+    assert result.exit_code == 0
+    event = json.loads(result.stdout.splitlines()[0])
+    assert event['event'] == 'test-event'
+    assert event['key'] == 'value'
@@ -1,9 +1,51 @@
+import os
+import re
+import json
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Union
 from unittest.mock import patch, Mock
 import pytest
-from pygit2 import Reference, Repository
+from pygit2 import Commit, GitError, Reference, Repository, init_repository
 from cookiecutter.exceptions import FailedHookException
-from battenberg.errors import TemplateConflictException, TemplateNotFoundException
-from battenberg.core import Battenberg
+from cookiecutter.main import cookiecutter
+from cookiecutter.generate import generate_file
+from battenberg.errors import (
+    BattenbergException,
+    MergeConflictException,
+    RepositoryEmptyException,
+    TemplateConflictException,
+    TemplateNotFoundException
+)
+from battenberg.core import (
+    PERSISTENT_WORKTREE_NAME,
+    WORKTREE_NAME,
+    Battenberg,
+    BatchInstaller,
+    BatchUpgrader,
+    INSTALL_ERROR,
+    INSTALL_SUCCESS,
+    UPGRADE_CONFLICT,
+    UPGRADE_ERROR,
+    UPGRADE_SUCCESS
+)
+from battenberg.parallel_render import parallel_rendering
+from battenberg.profiling import PhaseTimer
+from battenberg.progress import (
+    EVENT_MERGED,
+    EVENT_PHASE_END,
+    EVENT_PHASE_START,
+    EVENT_RENDERED,
+    EVENT_RESULT,
+    EVENT_STAGED,
+    MERGE_MERGED,
+    Progress
+)
+from battenberg.render_cache import RenderCache
+from battenberg.render_memo import MEMO_FILE
+from battenberg.shared_objects import SharedObjectStore
+from battenberg.template_mirror import TemplateMirror
 
 
 def find_ref_from_message(repo: Repository, message: str, ref_name: str = 'main') -> Reference:
@@ -11,9 +53,10 @@ def find_ref_from_message(repo: Repository, message: str, ref_name: str = 'main'
                 if ref.message == message)
 
 
-def test_install(repo: Repository, template_repo: Repository):
+@pytest.mark.parametrize('use_worktree', (True, False))
+def test_install(repo: Repository, template_repo: Repository, use_worktree: bool):
     battenberg = Battenberg(repo)
-    battenberg.install(template_repo.workdir, no_input=True)
+    battenberg.install(template_repo.workdir, no_input=True, use_worktree=use_worktree)
 
     assert battenberg.is_installed()
     # Ensure we have the appropriate branches we expect.
@@ -77,9 +120,10 @@ def test_upgrade_fetches_remote_template(installed_repo: Repository, template_re
         get_mock.assert_called_once_with('refs/remotes/origin/template')
 
 
-def test_upgrade(installed_repo: Repository, template_repo: Repository):
+@pytest.mark.parametrize('use_worktree', (True, False))
+def test_upgrade(installed_repo: Repository, template_repo: Repository, use_worktree: bool):
     battenberg = Battenberg(installed_repo)
-    battenberg.upgrade(checkout='upgrade', no_input=True)
+    battenberg.upgrade(checkout='upgrade', no_input=True, use_worktree=use_worktree)
 
     template_oids = {ref.oid_new for ref in installed_repo.references['refs/heads/template'].log()}
     template_commits = [installed_repo[oid].message for oid in template_oids]
@@ -93,6 +137,76 @@ def test_upgrade(installed_repo: Repository, template_repo: Repository):
     assert template_oids & set(installed_repo[main_merge_ref.oid_new].parent_ids)
 
 
+def test_upgrade_records_phases(installed_repo: Repository):
+    timer = PhaseTimer()
+    battenberg = Battenberg(installed_repo, timer=timer)
+    battenberg.upgrade(checkout='upgrade', no_input=True)
+
+    phases = [record['phase'] for record in timer.phases]
+    assert phases[0] == 'upgrade'
+    assert not {
+        'upgrade.worktree_create',
+        'upgrade.cookiecutter',
+        'upgrade.shift',
+        'upgrade.stage',
+        'upgrade.commit',
+        'upgrade.worktree_remove',
+        'upgrade.merge',
+        'upgrade.merge.merge_index',
+    } - set(phases)
+
+
+def test_upgrade_emits_progress(installed_repo: Repository):
+    events = []
+    battenberg = Battenberg(installed_repo, progress=Progress([events.append]))
+    battenberg.upgrade(checkout='upgrade', no_input=True)
+
+    by_type = {}
+    for event in events:
+        by_type.setdefault(event['event'], []).append(event)
+    assert events[0] == dict(by_type[EVENT_PHASE_START][0], phase='upgrade')
+    assert events[-1]['event'] == EVENT_PHASE_END
+    assert by_type[EVENT_RENDERED][0]['files'] > 0
+    assert by_type[EVENT_STAGED][0]['files'] > 0
+    merged = by_type[EVENT_MERGED][0]
+    assert merged['status'] == MERGE_MERGED
+    assert merged['commit'] == str(installed_repo.head.target)
+
+
+def test_iter_events(installed_repo: Repository):
+    battenberg = Battenberg(installed_repo)
+    events = list(battenberg.iter_events('upgrade', checkout='upgrade', no_input=True))
+
+    assert events[0]['event'] == EVENT_PHASE_START
+    assert events[-1]['event'] == EVENT_RESULT
+    assert events[-1]['result'] is True
+    assert not battenberg.progress.callbacks
+
+
+def test_iter_events_raises(installed_repo: Repository, template_repo: Repository):
+    battenberg = Battenberg(installed_repo)
+    events = battenberg.iter_events('install', template_repo.workdir)
+
+    assert next(events)['event'] == EVENT_PHASE_START
+    with pytest.raises(TemplateConflictException):
+        list(events)
+
+
+def test_upgrade_persistent_worktree(installed_repo: Repository):
+    battenberg = Battenberg(installed_repo)
+    assert battenberg.upgrade(checkout='upgrade', no_input=True, persistent_worktree=True)
+
+    assert PERSISTENT_WORKTREE_NAME in installed_repo.list_worktrees()
+    assert 'new.txt' in installed_repo[installed_repo.head.target].tree
+    template_tree = installed_repo.lookup_branch('template').peel(Commit).tree
+    assert {entry.name for entry in template_tree} == {'.cookiecutter.json', 'new.txt'}
+
+    # Later upgrades reuse the worktree, and can still use a temporary one alongside it.
+    battenberg.upgrade(checkout='upgrade', no_input=True, persistent_worktree=True)
+    battenberg.upgrade(checkout='upgrade', no_input=True)
+    assert PERSISTENT_WORKTREE_NAME in installed_repo.list_worktrees()
+
+
 def test_update_merge_target(installed_repo: Repository, template_repo: Repository):
     merge_target = 'target'
     battenberg = Battenberg(installed_repo)
@@ -109,3 +223,567 @@ def test_update_merge_target(installed_repo: Repository, template_repo: Reposito
     assert main_merge_ref
     # Ensure the merge commit on the merge target branch was derived from the template branch.
     assert template_upgrade_oid in set(installed_repo[main_merge_ref.oid_new].parent_ids)
+
+
+def _upgrade_merge_target(path: str, merge_target: str) -> Union[bool, str]:
+    try:
+        return Battenberg(Repository(path)).upgrade(checkout='upgrade', no_input=True,
+                                                    merge_target=merge_target, in_memory=True)
+    except Exception as e:
+        # Not every pygit2 error can be pickled back out of the worker, report it as text.
+        return f'{type(e).__name__}: {e}'
+
+
+def test_upgrade_merge_targets_concurrently(installed_repo: Repository):
+    template = installed_repo.lookup_branch('template').target
+    merge_targets = ['release-a', 'release-b', 'release-c']
+
+    with ProcessPoolExecutor(len(merge_targets)) as executor:
+        results = list(executor.map(_upgrade_merge_target,
+                                    [installed_repo.workdir] * len(merge_targets),
+                                    merge_targets))
+
+    assert results == [True] * len(merge_targets)
+    # Runs took turns committing, so the later ones found the identical render already committed.
+    upgrade = installed_repo.lookup_branch('template').peel(Commit)
+    assert upgrade.parent_ids == [template]
+    merged = {installed_repo.lookup_branch(merge_target).peel(Commit).parent_ids[1]
+              for merge_target in merge_targets}
+    assert merged == {upgrade.id}
+    assert not installed_repo.list_worktrees()
+    assert not [branch for branch in installed_repo.listall_branches()
+                if branch.startswith(WORKTREE_NAME)]
+
+
+def test_upgrade_renders_next_to_worktree(installed_repo: Repository):
+    output_dirs = []
+
+    def record_output_dir(**kwargs):
+        # The worktree must be a sibling so the rendered files can be renamed into it.
+        output_dirs.append(kwargs['output_dir'])
+        siblings = os.listdir(os.path.dirname(kwargs['output_dir']))
+        assert any(name.startswith(f'{WORKTREE_NAME}-') for name in siblings)
+        return cookiecutter(**kwargs)
+
+    battenberg = Battenberg(installed_repo)
+    with patch('battenberg.core.cookiecutter', side_effect=record_output_dir):
+        battenberg.upgrade(checkout='upgrade', no_input=True)
+
+    assert len(output_dirs) == 1
+    assert 'new.txt' in installed_repo[installed_repo.head.target].tree
+
+
+def test_upgrade_renders_in_parallel(installed_repo: Repository):
+    battenberg = Battenberg(installed_repo, render_jobs=2)
+    with patch('battenberg.core.parallel_rendering', wraps=parallel_rendering) as rendering:
+        battenberg.upgrade(checkout='upgrade', no_input=True)
+
+    rendering.assert_called_once_with(2, None)
+    assert 'new.txt' in installed_repo[installed_repo.head.target].tree
+
+
+def test_upgrade_reuses_rendered_files(repo: Repository, template_repo: Repository):
+    battenberg = Battenberg(repo, render_memo=True)
+    battenberg.install(template_repo.workdir, no_input=True)
+    battenberg.upgrade(checkout='upgrade', no_input=True)
+    new_txt = repo[repo.head.target].tree['new.txt'].id
+
+    with patch('battenberg.parallel_render.generate_file', wraps=generate_file) as generate:
+        battenberg.upgrade(checkout='upgrade', no_input=True, use_worktree=False)
+
+    # Only the context file, which renders the whole context, is rendered again.
+    assert [call.args[1] for call in generate.call_args_list] == ['.cookiecutter.json']
+    assert repo[repo.head.target].tree['new.txt'].id == new_txt
+
+
+def test_upgrade_reuses_render_cache(repo: Repository, template_url: str, tmpdir):
+    render_cache = RenderCache(str(tmpdir.join('cache')))
+
+    battenberg = Battenberg(repo, render_cache=render_cache)
+    battenberg.install(template_url, no_input=True)
+    # The first upgrade renders with the installed context which differs from the install.
+    battenberg.upgrade(no_input=True)
+    assert len(os.listdir(render_cache.path)) == 2
+
+    with patch('battenberg.core.cookiecutter') as cookiecutter:
+        battenberg.upgrade(no_input=True)
+        cookiecutter.assert_not_called()
+
+    assert len(os.listdir(render_cache.path)) == 2
+
+
+def test_upgrade_skips_render_cache_when_remote_unlistable(repo: Repository, template_url: str,
+                                                           tmpdir):
+    render_cache = RenderCache(str(tmpdir.join('cache')))
+    battenberg = Battenberg(repo, render_cache=render_cache)
+    battenberg.install(template_url, no_input=True)
+    cached = os.listdir(render_cache.path)
+
+    with patch('battenberg.utils.list_remote_refs', side_effect=GitError('test-error')):
+        assert battenberg.upgrade(checkout='upgrade', no_input=True)
+
+    assert 'new.txt' in repo[repo.head.target].tree
+    assert os.listdir(render_cache.path) == cached
+
+
+def test_upgrade_renders_from_template_mirror(repo: Repository, template_url: str, tmpdir):
+    template_mirror = TemplateMirror(str(tmpdir.join('mirrors')), offline=True)
+
+    battenberg = Battenberg(repo, template_mirror=template_mirror)
+    battenberg.install(template_url, no_input=True)
+    assert 'new.txt' not in repo[repo.head.target].tree
+
+    # Make the template unreachable, the upgrade must be rendered from the mirror alone.
+    os.remove(template_url[len('file://'):])
+    battenberg.upgrade(checkout='upgrade', no_input=True)
+
+    assert 'new.txt' in repo[repo.head.target].tree
+
+
+def test_upgrade_in_memory(installed_repo: Repository, template_repo: Repository):
+    status = installed_repo.status()
+
+    battenberg = Battenberg(installed_repo)
+    battenberg.upgrade(checkout='upgrade', no_input=True, in_memory=True)
+
+    template_oid = installed_repo.references['refs/heads/template'].target
+    head = installed_repo[installed_repo.head.target]
+    assert head.message == f'Upgraded template \'{template_repo.workdir}\''
+    assert template_oid in head.parent_ids
+    # The changed paths have been checked out, leaving a clean working directory.
+    assert installed_repo.status() == status
+    with open(os.path.join(installed_repo.workdir, '.cookiecutter.json'), 'rb') as f:
+        assert f.read() == head.tree['.cookiecutter.json'].data
+
+
+def test_upgrade_in_memory_updates_working_directory_last(installed_repo: Repository):
+    head = installed_repo.head.target
+    status = installed_repo.status()
+    create_commit = installed_repo.create_commit
+
+    def fail_merge_commit(*args):
+        if args[3].startswith('Upgraded template'):
+            raise GitError('test-error')
+        return create_commit(*args)
+
+    battenberg = Battenberg(installed_repo)
+    with patch.object(installed_repo, 'create_commit', side_effect=fail_merge_commit), \
+            pytest.raises(GitError):
+        battenberg.upgrade(checkout='upgrade', no_input=True, in_memory=True)
+
+    # The failed merge commit left neither the working directory nor the index ahead of HEAD.
+    repo = Repository(installed_repo.path)
+    assert repo.head.target == head
+    assert repo.status() == status
+    with open(os.path.join(repo.workdir, '.cookiecutter.json'), 'rb') as f:
+        assert f.read() == repo[head].tree['.cookiecutter.json'].data
+
+
+def test_upgrade_in_memory_refuses_to_overwrite_local_changes(installed_repo: Repository):
+    head = installed_repo.head.target
+    context_path = os.path.join(installed_repo.workdir, '.cookiecutter.json')
+    with open(context_path, 'a') as f:
+        f.write('\n')
+    with open(context_path) as f:
+        context = f.read()
+
+    battenberg = Battenberg(installed_repo)
+    with pytest.raises(BattenbergException, match='.cookiecutter.json'):
+        battenberg.upgrade(checkout='upgrade', no_input=True, in_memory=True)
+
+    assert installed_repo.head.target == head
+    with open(context_path) as f:
+        assert f.read() == context
+
+
+def test_upgrade_in_memory_merge_target(installed_repo: Repository):
+    head = installed_repo.head.target
+    status = installed_repo.status()
+
+    battenberg = Battenberg(installed_repo)
+    battenberg.upgrade(checkout='upgrade', no_input=True, merge_target='target', in_memory=True)
+
+    # The checked out branch is left untouched.
+    assert installed_repo.head.name == 'refs/heads/main'
+    assert installed_repo.head.target == head
+    assert installed_repo.status() == status
+    target = installed_repo[installed_repo.references['refs/heads/target'].target]
+    assert target.parent_ids == [head, installed_repo.references['refs/heads/template'].target]
+
+
+def diverge_context(repo: Repository):
+    # Diverge the context file on the main branch so it conflicts with a template upgrade, which
+    # always renders a new output directory.
+    context_path = os.path.join(repo.workdir, '.cookiecutter.json')
+    with open(context_path) as f:
+        context = re.sub(r'"_output_dir": ".*"', '"_output_dir": "diverged"', f.read())
+    with open(context_path, 'w') as f:
+        f.write(context)
+    repo.index.add_all()
+    repo.index.write()
+    repo.create_commit('HEAD', repo.default_signature, repo.default_signature, 'Diverge',
+                       repo.index.write_tree(), [repo.head.target])
+
+
+def test_upgrade_in_memory_falls_back_on_conflicts(installed_repo: Repository):
+    diverge_context(installed_repo)
+
+    battenberg = Battenberg(installed_repo)
+    with pytest.raises(MergeConflictException) as e:
+        battenberg.upgrade(checkout='upgrade', no_input=True, in_memory=True)
+
+    # Conflicts are left in the working directory for the user to resolve.
+    assert installed_repo.index.conflicts is not None
+    assert [(c['path'], c['type']) for c in e.value.conflicts] == [
+        ('.cookiecutter.json', 'both-modified')
+    ]
+
+
+def test_upgrade_many_merge_targets(installed_repo: Repository):
+    template = installed_repo.lookup_branch('template').target
+    installed_repo.create_branch('release-a', installed_repo[installed_repo.head.target])
+    diverge_context(installed_repo)
+    head = installed_repo.head
+    for name in ('conflicted-a', 'conflicted-b'):
+        installed_repo.create_branch(name, installed_repo[head.target])
+
+    battenberg = Battenberg(installed_repo)
+    results = battenberg.upgrade(
+        checkout='upgrade', no_input=True,
+        merge_target=['release-a', 'conflicted-a', 'conflicted-b', 'release-a'])
+
+    assert [(result.merge_target, result.status) for result in results] == [
+        ('release-a', UPGRADE_SUCCESS),
+        ('conflicted-a', UPGRADE_CONFLICT),
+        ('conflicted-b', UPGRADE_CONFLICT)
+    ]
+    # The template was rendered and committed once for every merge target.
+    upgrade = installed_repo.lookup_branch('template').peel(Commit)
+    assert upgrade.parent_ids == [template]
+    release_a = installed_repo.lookup_branch('release-a').peel(Commit)
+    assert release_a.parent_ids[1] == upgrade.id
+    assert 'new.txt' in release_a.tree
+    # Conflicting merge targets, the checked out branch and the working directory are left alone.
+    repo = Repository(installed_repo.path)
+    for name in ('conflicted-a', 'conflicted-b'):
+        assert repo.lookup_branch(name).target == head.target
+    assert repo.head.name == head.name
+    assert repo.head.target == head.target
+    assert repo.index.conflicts is None
+    assert repo.status() == {}
+
+
+def test_upgrade_many_merge_targets_leaves_checked_out_conflicts(installed_repo: Repository):
+    installed_repo.create_branch('release-a', installed_repo[installed_repo.head.target])
+    diverge_context(installed_repo)
+    head = installed_repo.head.shorthand
+
+    battenberg = Battenberg(installed_repo)
+    results = battenberg.upgrade(checkout='upgrade', no_input=True,
+                                 merge_target=['release-a', head])
+
+    assert [result.status for result in results] == [UPGRADE_SUCCESS, UPGRADE_CONFLICT]
+    # Only the checked out merge target's conflicts are left to resolve by hand.
+    repo = Repository(installed_repo.path)
+    assert repo.head.shorthand == head
+    assert [ours.path for _, ours, _ in repo.index.conflicts] == ['.cookiecutter.json']
+
+
+def test_upgrade_many_merge_targets_rejects_output_branch(installed_repo: Repository):
+    battenberg = Battenberg(installed_repo)
+    with pytest.raises(BattenbergException):
+        battenberg.upgrade(checkout='upgrade', no_input=True, merge_target=['a', 'b'],
+                           output_branch='output')
+
+
+def test_upgrade_many_merge_targets_rejects_empty(installed_repo: Repository):
+    template = installed_repo.lookup_branch('template').target
+
+    battenberg = Battenberg(installed_repo)
+    with pytest.raises(BattenbergException, match='At least one merge target'):
+        battenberg.upgrade(checkout='upgrade', no_input=True, merge_target=[])
+
+    # Nothing was rendered or committed first.
+    assert installed_repo.lookup_branch('template').target == template
+
+
+@pytest.fixture
+def bare_repo(installed_repo: Repository, tmpdir) -> Repository:
+    bare_repo = init_repository(str(tmpdir.join('bare.git')), bare=True)
+    remote = bare_repo.remotes.create('origin', installed_repo.path, '+refs/heads/*:refs/heads/*')
+    remote.fetch()
+    bare_repo.references['HEAD'].set_target('refs/heads/main')
+    return bare_repo
+
+
+def test_upgrade_bare(bare_repo: Repository):
+    main = bare_repo.references['refs/heads/main'].target
+    template = bare_repo.references['refs/heads/template'].target
+
+    battenberg = Battenberg(bare_repo)
+    battenberg.upgrade(checkout='upgrade', no_input=True, output_branch='upgrade-template')
+
+    # The merge target is left untouched, the result is ready to be pushed from the output branch.
+    assert bare_repo.references['refs/heads/main'].target == main
+    new_template = bare_repo.references['refs/heads/template'].target
+    assert bare_repo[new_template].parent_ids == [template]
+    output = bare_repo[bare_repo.references['refs/heads/upgrade-template'].target]
+    assert output.parent_ids == [main, new_template]
+    assert 'new.txt' in output.tree
+
+
+def test_upgrade_bare_flag_does_not_touch_working_directory(installed_repo: Repository):
+    head = installed_repo.head.target
+    installed_repo.create_branch('release', installed_repo[head])
+    status = installed_repo.status()
+    cookiecutter_json = os.path.join(installed_repo.workdir, '.cookiecutter.json')
+    os.remove(cookiecutter_json)
+
+    battenberg = Battenberg(installed_repo)
+    # The context is read from the merge target rather than the (now missing) file on disk.
+    battenberg.upgrade(checkout='upgrade', no_input=True, bare=True, merge_target='release')
+
+    assert installed_repo.lookup_branch('release').peel(Commit).parent_ids[0] == head
+    assert installed_repo.head.target == head
+    assert not os.path.exists(cookiecutter_json)
+    assert set(installed_repo.status()) == set(status) | {'.cookiecutter.json'}
+
+
+@pytest.mark.parametrize('merge_target', (None, 'main', ['release', 'main']))
+def test_upgrade_bare_flag_rejects_checked_out_branch(installed_repo: Repository, merge_target):
+    head = installed_repo.head.target
+    template = installed_repo.lookup_branch('template').target
+
+    battenberg = Battenberg(installed_repo)
+    with pytest.raises(BattenbergException, match='checked out branch main'):
+        battenberg.upgrade(checkout='upgrade', no_input=True, bare=True,
+                           merge_target=merge_target)
+
+    assert installed_repo.head.target == head
+    assert installed_repo.lookup_branch('template').target == template
+
+
+def test_upgrade_bare_flag_writes_output_branch(installed_repo: Repository):
+    head = installed_repo.head.target
+
+    battenberg = Battenberg(installed_repo)
+    battenberg.upgrade(checkout='upgrade', no_input=True, bare=True, output_branch='output')
+
+    assert installed_repo.head.target == head
+    assert installed_repo.lookup_branch('output').peel(Commit).parent_ids[0] == head
+
+
+def test_upgrade_bare_raises_repository_empty(tmpdir):
+    bare_repo = init_repository(str(tmpdir.join('empty.git')), bare=True)
+    bare_repo.create_branch('template', bare_repo[bare_repo.create_commit(
+        None, bare_repo.default_signature, bare_repo.default_signature, 'Template',
+        bare_repo.TreeBuilder().write(), []
+    )])
+
+    with pytest.raises(RepositoryEmptyException):
+        Battenberg(bare_repo).upgrade(no_input=True)
+
+
+@pytest.mark.parametrize('use_worktree', (True, False))
+def test_upgrade_skips_unchanged_template(repo: Repository, template_url: str,
+                                          use_worktree: bool):
+    battenberg = Battenberg(repo)
+    battenberg.install(template_url, no_input=True)
+
+    template = repo.references['refs/heads/template'].target
+    head = repo.head.target
+    for _ in range(2):
+        # Every render records a different output directory in the context file, which alone
+        # doesn't make for an upgrade.
+        with patch.object(battenberg, '_merge_template_branch') as merge:
+            assert not battenberg.upgrade(no_input=True, use_worktree=use_worktree)
+            merge.assert_not_called()
+
+    assert repo.references['refs/heads/template'].target == template
+    assert repo.head.target == head
+
+
+def test_upgrade_merges_unchanged_template_when_not_merged(installed_repo: Repository):
+    # A branch from before the template was installed which is yet to be merged with it.
+    installed_repo.branches.local.create(
+        'old', installed_repo[installed_repo[installed_repo.head.target].parent_ids[0]])
+    template = installed_repo.references['refs/heads/template'].target
+
+    battenberg = Battenberg(installed_repo)
+    with patch.object(battenberg, '_write_template_tree') as write_template_tree:
+        # Render exactly what's already on the template branch.
+        write_template_tree.return_value = installed_repo[template].tree.id
+        assert battenberg.upgrade(no_input=True, use_worktree=False, merge_target='old',
+                                  in_memory=True)
+
+    assert installed_repo.references['refs/heads/template'].target == template
+    old = installed_repo[installed_repo.references['refs/heads/old'].target]
+    assert template in old.parent_ids
+
+
+def test_plan_upgrade(installed_repo: Repository, template_repo: Repository):
+    references = {name: installed_repo.references[name].target
+                  for name in installed_repo.references}
+
+    battenberg = Battenberg(installed_repo)
+    report = battenberg.plan_upgrade(checkout='upgrade', no_input=True)
+
+    assert report == {
+        'repository': installed_repo.workdir,
+        'template': template_repo.workdir,
+        'checkout': 'upgrade',
+        'merge_target': 'HEAD',
+        'changed': True,
+        # The output directory is always rendered into the context.
+        'changes': {'added': [], 'modified': ['.cookiecutter.json'], 'deleted': []},
+        'conflicts': []
+    }
+    assert {name: installed_repo.references[name].target
+            for name in installed_repo.references} == references
+
+
+def test_plan_upgrade_with_shared_objects_writes_nothing(installed_repo: Repository, tmpdir):
+    references = {name: installed_repo.references[name].target
+                  for name in installed_repo.references}
+    shared_objects = SharedObjectStore(str(tmpdir.join('objects')))
+
+    battenberg = Battenberg(installed_repo, shared_objects=shared_objects, render_memo=True)
+    report = battenberg.plan_upgrade(checkout='upgrade', no_input=True)
+
+    assert report['changed']
+    assert not os.path.exists(os.path.join(installed_repo.path, 'objects', 'info', 'alternates'))
+    assert not os.path.exists(shared_objects.path)
+    assert not os.path.exists(os.path.join(installed_repo.path, 'battenberg', MEMO_FILE))
+    assert {name: installed_repo.references[name].target
+            for name in installed_repo.references} == references
+
+
+def test_plan_upgrade_predicts_conflicts(installed_repo: Repository):
+    diverge_context(installed_repo)
+    head = installed_repo.head.target
+
+    battenberg = Battenberg(installed_repo)
+    report = battenberg.plan_upgrade(checkout='upgrade', no_input=True)
+
+    assert report['conflicts'] == ['.cookiecutter.json']
+    assert installed_repo.head.target == head
+    assert installed_repo.index.conflicts is None
+
+
+def test_plan_upgrade_raises_template_not_found(repo: Repository):
+    with pytest.raises(TemplateNotFoundException):
+        Battenberg(repo).plan_upgrade()
+
+
+@pytest.fixture
+def installed_repos(installed_repo: Repository) -> List[Repository]:
+    # Copies share the exact same template context, unlike separate installs.
+    path = os.path.join(tempfile.mkdtemp(), 'copy')
+    shutil.copytree(installed_repo.workdir, path, symlinks=True)
+    return [installed_repo, Repository(path)]
+
+
+def test_batch_upgrade(installed_repos: List[Repository]):
+    batch = BatchUpgrader(installed_repos)
+    with patch('battenberg.core.cookiecutter', wraps=cookiecutter) as cookiecutter_mock:
+        results = batch.upgrade(checkout='upgrade')
+
+    # Both repositories share a context so the template is only rendered once.
+    cookiecutter_mock.assert_called_once()
+    assert [result.status for result in results] == [UPGRADE_SUCCESS, UPGRADE_SUCCESS]
+    assert [result.repository for result in results] == [repo.workdir for repo in installed_repos]
+    trees = {repo.lookup_branch('template').peel(Commit).tree.id for repo in installed_repos}
+    assert len(trees) == 1
+    for repo in installed_repos:
+        assert 'new.txt' in repo[repo.head.target].tree
+
+
+def test_batch_upgrade_shares_objects(installed_repos: List[Repository], tmpdir):
+    shared_objects = SharedObjectStore(str(tmpdir.join('objects')))
+    with patch('battenberg.core.copy_tree_objects') as copy_tree_objects:
+        results = BatchUpgrader(installed_repos, shared_objects=shared_objects).upgrade(
+            checkout='upgrade')
+
+    assert [result.status for result in results] == [UPGRADE_SUCCESS, UPGRADE_SUCCESS]
+    copy_tree_objects.assert_not_called()
+    for repo in installed_repos:
+        tree = repo.lookup_branch('template').peel(Commit).tree.id
+        # Only the commits are written into each repository, the tree is borrowed.
+        assert not os.path.exists(os.path.join(repo.path, 'objects', str(tree)[:2],
+                                               str(tree)[2:]))
+        assert 'new.txt' in Repository(repo.path)[repo.head.target].tree
+
+
+def test_batch_upgrade_bare_rejects_checked_out_branch(installed_repos: List[Repository]):
+    heads = [repo.head.target for repo in installed_repos]
+
+    results = BatchUpgrader(installed_repos).upgrade(checkout='upgrade', bare=True)
+
+    assert [result.status for result in results] == [UPGRADE_ERROR, UPGRADE_ERROR]
+    assert 'checked out branch main' in results[0].message
+    assert [repo.head.target for repo in installed_repos] == heads
+
+
+def test_batch_upgrade_reports_failures(installed_repos: List[Repository], tmpdir):
+    diverge_context(installed_repos[1])
+    missing = str(tmpdir.join('missing'))
+
+    results = BatchUpgrader(installed_repos + [missing]).upgrade(checkout='upgrade',
+                                                                 in_memory=True)
+
+    assert [result.status for result in results] == [
+        UPGRADE_SUCCESS, UPGRADE_CONFLICT, UPGRADE_ERROR
+    ]
+    assert results[2].repository == missing
+    assert results[2].message
+
+
+def test_batch_group_ignores_volatile_context(installed_repos: List[Repository], tmpdir):
+    # Only differs in the output directory, which cookiecutter overwrites anyway.
+    diverge_context(installed_repos[1])
+    missing = str(tmpdir.join('missing'))
+
+    groups = BatchUpgrader(installed_repos + [missing]).group()
+
+    assert groups == [installed_repos, [missing]]
+
+
+def test_batch_install(template_url: str, tmpdir):
+    targets = [(str(tmpdir.join('repo-a')), {'question': 'shared'}),
+               (str(tmpdir.join('repo-b')), {'question': 'other'}),
+               (str(tmpdir.join('repo-c')), {'question': 'shared'})]
+    mirror = TemplateMirror(str(tmpdir.join('mirrors')))
+
+    with patch('battenberg.core.cookiecutter', wraps=cookiecutter) as cookiecutter_mock, \
+            patch.object(TemplateMirror, '_fetch', autospec=True,
+                         side_effect=TemplateMirror._fetch) as fetch:
+        results = BatchInstaller(targets, template_mirror=mirror).install(template_url)
+
+    # The template is fetched once and rendered once per distinct context.
+    fetch.assert_called_once()
+    assert cookiecutter_mock.call_count == 2
+    assert [result.status for result in results] == [INSTALL_SUCCESS] * 3
+    assert [result.repository for result in results] == [path for path, _ in targets]
+    assert all(result.seconds > 0 for result in results)
+
+    repos = [Repository(path) for path, _ in targets]
+    trees = [repo.lookup_branch('template').peel(Commit).tree.id for repo in repos]
+    assert trees[0] == trees[2] != trees[1]
+    for repo, (_, context) in zip(repos, targets):
+        # The default branch of the template is mirrored and the merge is checked out.
+        assert repo.head.name == 'refs/heads/main'
+        assert not repo.list_worktrees()
+        with open(os.path.join(repo.workdir, '.cookiecutter.json')) as f:
+            assert json.load(f)['question'] == context['question']
+        assert repo.status() == {}
+
+
+def test_batch_install_reports_failures(installed_repo: Repository, template_repo: Repository,
+                                        tmpdir):
+    new = str(tmpdir.join('new'))
+
+    results = BatchInstaller([(installed_repo.workdir, None), (new, None)]).install(
+        template_repo.workdir)
+
+    assert [result.status for result in results] == [INSTALL_ERROR, INSTALL_SUCCESS]
+    assert results[0].message == 'Template already installed'
@@ -0,0 +1,101 @@
+import os
+import json
+import stat
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+from unittest.mock import patch
+import pytest
+import cookiecutter.main
+from cookiecutter.exceptions import UndefinedVariableInTemplate
+from cookiecutter.main import cookiecutter as stock_cookiecutter
+from battenberg.parallel_render import MIN_PARALLEL_FILES, generate_files, parallel_rendering
+
+
+HOOK = """\
+import os
+with open(os.path.join({output!r}, 'hooks.log'), 'a') as f:
+    f.write('{name} ' + ' '.join(sorted(os.listdir('.'))) + '\\n')
+"""
+
+
+def _write(path: str, content, mode: str = 'w', newline: str = None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode, newline=newline) as f:
+        f.write(content)
+
+
+@pytest.fixture
+def template(tmpdir) -> str:
+    path = str(tmpdir.join('template'))
+    root = os.path.join(path, '{{cookiecutter.name}}')
+    _write(os.path.join(path, 'cookiecutter.json'), json.dumps({
+        'name': 'project',
+        'greeting': 'hello',
+        '_copy_without_render': ['raw/*', 'copied/*']
+    }))
+    for i in range(MIN_PARALLEL_FILES * 2):
+        _write(os.path.join(root, f'dir_{i % 3}', f'file_{i}.txt'),
+               f'{{{{ cookiecutter.greeting }}}} {i}\n'
+               '{% for n in range(3) %}{{ n }}\n{% endfor %}')
+    _write(os.path.join(root, '{{cookiecutter.name}}.py'), '# {{ cookiecutter.name }}\r\n',
+           newline='')
+    _write(os.path.join(root, 'run.sh'), 'echo {{ cookiecutter.name }}\n')
+    os.chmod(os.path.join(root, 'run.sh'), 0o755)
+    _write(os.path.join(root, 'binary.bin'), bytes(range(256)), 'wb')
+    _write(os.path.join(root, 'raw', 'file.txt'), '{{ cookiecutter.name }}\n')
+    _write(os.path.join(root, 'copied', 'nested', 'file.txt'), '{{ cookiecutter.name }}\n')
+    _write(os.path.join(path, 'hooks', 'pre_gen_project.py'),
+           HOOK.format(output=str(tmpdir), name='pre'))
+    _write(os.path.join(path, 'hooks', 'post_gen_project.py'),
+           HOOK.format(output=str(tmpdir), name='post'))
+    return path
+
+
+def _snapshot(path: str) -> Dict[str, tuple]:
+    snapshot = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            full_path = os.path.join(root, name)
+            with open(full_path, 'rb') as f:
+                snapshot[os.path.relpath(full_path, path)] = (
+                    f.read(), stat.S_IMODE(os.stat(full_path).st_mode))
+    return snapshot
+
+
+def test_parallel_rendering_matches_cookiecutter(template: str, tmpdir):
+    expected = stock_cookiecutter(template, no_input=True, output_dir=str(tmpdir.join('stock')))
+    with open(tmpdir.join('hooks.log')) as f:
+        expected_hooks = f.read()
+    os.remove(tmpdir.join('hooks.log'))
+
+    with parallel_rendering(2), patch('battenberg.parallel_render.ProcessPoolExecutor',
+                                      wraps=ProcessPoolExecutor) as pool:
+        rendered = stock_cookiecutter(template, no_input=True,
+                                      output_dir=str(tmpdir.join('parallel')))
+
+    pool.assert_called_once()
+    assert _snapshot(rendered) == _snapshot(expected)
+    # Hooks run before and after every file is generated, just as they do with cookiecutter.
+    with open(tmpdir.join('hooks.log')) as f:
+        assert f.read() == expected_hooks
+
+
+def test_parallel_rendering_restores_cookiecutter():
+    original = cookiecutter.main.generate_files
+    with pytest.raises(ValueError):
+        with parallel_rendering(2):
+            assert cookiecutter.main.generate_files is not original
+            raise ValueError()
+    assert cookiecutter.main.generate_files is original
+
+
+def test_generate_files_reports_undefined_variables(template: str, tmpdir):
+    _write(os.path.join(template, '{{cookiecutter.name}}', 'dir_0', 'zz_broken.txt'),
+           '{{ cookiecutter.missing.value }}')
+
+    with pytest.raises(UndefinedVariableInTemplate, match='zz_broken.txt'):
+        generate_files(template, {'cookiecutter': {'name': 'project', 'greeting': 'hello'}},
+                       output_dir=str(tmpdir.join('output')), accept_hooks=False, jobs=2)
+
+    # The partially generated project is removed, like cookiecutter does.
+    assert not os.path.exists(tmpdir.join('output', 'project'))
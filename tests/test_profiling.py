@@ -0,0 +1,58 @@
+import pytest
+from unittest.mock import Mock, call
+from battenberg.profiling import PHASE_END, PHASE_START, PhaseTimer
+
+
+def test_phase_records_nested_phases():
+    timer = PhaseTimer()
+    with timer.phase('upgrade'):
+        with timer.phase('render'):
+            pass
+        with timer.phase('merge'):
+            pass
+
+    assert [record['phase'] for record in timer.phases] == [
+        'upgrade', 'upgrade.render', 'upgrade.merge'
+    ]
+    assert all(record['seconds'] >= 0 for record in timer.phases)
+
+
+def test_phase_records_failed_phases():
+    timer = PhaseTimer()
+    with pytest.raises(ValueError):
+        with timer.phase('upgrade'):
+            raise ValueError()
+
+    assert timer.phases[0]['seconds'] is not None
+    with timer.phase('install'):
+        pass
+    assert timer.phases[1]['phase'] == 'install'
+
+
+def test_hooks():
+    hook = Mock()
+    timer = PhaseTimer([hook])
+    with timer.phase('upgrade'):
+        with timer.phase('render'):
+            pass
+
+    assert hook.call_args_list == [
+        call(PHASE_START, 'upgrade', None),
+        call(PHASE_START, 'upgrade.render', None),
+        call(PHASE_END, 'upgrade.render', timer.phases[1]['seconds']),
+        call(PHASE_END, 'upgrade', timer.phases[0]['seconds']),
+    ]
+
+
+def test_report_totals_top_level_phases():
+    timer = PhaseTimer()
+    timer.phases = [
+        {'phase': 'upgrade', 'seconds': 2.0},
+        {'phase': 'upgrade.render', 'seconds': 1.5},
+        {'phase': 'install', 'seconds': 1.0},
+    ]
+
+    assert timer.report()['total'] == 3.0
+    lines = timer.format().splitlines()
+    assert lines[1].startswith('upgrade.render')
+    assert lines[-1].split() == ['total', '3.000s']
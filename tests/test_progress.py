@@ -0,0 +1,53 @@
+from unittest.mock import Mock, patch
+from battenberg.profiling import PHASE_END, PHASE_START
+from battenberg.progress import (
+    EVENT_FETCH_PROGRESS,
+    EVENT_PHASE_END,
+    EVENT_PHASE_START,
+    Progress
+)
+
+
+def test_emit():
+    callback = Mock()
+    progress = Progress([callback])
+
+    progress.emit('test-event', key='value')
+
+    event = callback.call_args.args[0]
+    assert event['event'] == 'test-event'
+    assert event['key'] == 'value'
+    assert isinstance(event['time'], float)
+
+
+def test_emit_without_callbacks():
+    progress = Progress()
+    assert not progress.enabled
+    progress.emit('test-event')
+
+
+def test_phase_hook():
+    events = []
+    progress = Progress([events.append])
+
+    progress.phase_hook(PHASE_START, 'upgrade', None)
+    progress.phase_hook(PHASE_END, 'upgrade', 1.5)
+
+    assert [(e['event'], e['phase']) for e in events] == [
+        (EVENT_PHASE_START, 'upgrade'), (EVENT_PHASE_END, 'upgrade')
+    ]
+    assert events[1]['seconds'] == 1.5
+
+
+def test_remote_callbacks_throttle_fetch_progress():
+    events = []
+    callbacks = Progress([events.append]).remote_callbacks()
+
+    with patch('battenberg.progress.time.monotonic', side_effect=[10.0, 10.01, 10.02]):
+        callbacks.transfer_progress(Mock(received_bytes=1, received_objects=1, total_objects=3))
+        callbacks.transfer_progress(Mock(received_bytes=2, received_objects=2, total_objects=3))
+        # The final update is always published.
+        callbacks.transfer_progress(Mock(received_bytes=3, received_objects=3, total_objects=3))
+
+    assert [e['event'] for e in events] == [EVENT_FETCH_PROGRESS] * 2
+    assert [e['received_objects'] for e in events] == [1, 3]
@@ -0,0 +1,61 @@
+import os
+import pytest
+from battenberg.render_cache import RenderCache, canonicalize_context
+
+
+@pytest.fixture
+def rendered_path(tmpdir) -> str:
+    path = os.path.join(str(tmpdir), 'rendered')
+    os.makedirs(os.path.join(path, 'nested'))
+    with open(os.path.join(path, 'nested', 'file.txt'), 'w') as f:
+        f.write('x' * 10)
+    return path
+
+
+@pytest.fixture
+def cache(tmpdir) -> RenderCache:
+    return RenderCache(os.path.join(str(tmpdir), 'cache'))
+
+
+def test_canonicalize_context_ignores_volatile_keys():
+    assert canonicalize_context({'b': 1, 'a': 2, '_output_dir': '/tmp/x'}) == \
+        canonicalize_context({'a': 2, 'b': 1, '_output_dir': '/tmp/y'})
+    assert canonicalize_context(None) == canonicalize_context({})
+
+
+def test_key():
+    key = RenderCache.key('test-template', 'v1', 'test-commit', {'question': 'answer'})
+    assert key == RenderCache.key('test-template', 'v1', 'test-commit', {'question': 'answer'})
+    assert key != RenderCache.key('test-template', 'v1', 'test-commit', {'question': 'other'})
+    assert key != RenderCache.key('test-template', 'v2', 'test-commit', {'question': 'answer'})
+    assert key != RenderCache.key('test-template', 'v1', 'other-commit', {'question': 'answer'})
+
+
+def test_get_missing(cache: RenderCache):
+    assert cache.get('test-key') is None
+
+
+def test_put_and_get(cache: RenderCache, rendered_path: str):
+    entry_path = cache.put('test-key', rendered_path)
+
+    assert cache.get('test-key') == entry_path
+    with open(os.path.join(entry_path, 'nested', 'file.txt')) as f:
+        assert f.read() == 'x' * 10
+
+
+def test_put_existing_entry(cache: RenderCache, rendered_path: str):
+    entry_path = cache.put('test-key', rendered_path)
+    assert cache.put('test-key', rendered_path) == entry_path
+    assert os.listdir(cache.path) == ['test-key']
+
+
+def test_evicts_least_recently_used(cache: RenderCache, rendered_path: str):
+    cache.max_size = 25
+    cache.put('first', rendered_path)
+    cache.put('second', rendered_path)
+    os.utime(cache.get('first'), (0, 0))
+    os.utime(cache.get('second'), (1, 1))
+
+    cache.put('third', rendered_path)
+
+    assert sorted(os.listdir(cache.path)) == ['second', 'third']
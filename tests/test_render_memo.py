@@ -0,0 +1,120 @@
+from typing import Any
+from unittest.mock import patch
+import pytest
+from cookiecutter.utils import create_env_with_context
+from pygit2 import Repository
+from battenberg.render_memo import RenderMemo, _context_keys, _Unmemoizable
+
+
+CONTEXT = {'cookiecutter': {'name': 'project', 'other': 'value', '_output_dir': '/tmp/x'}}
+
+
+@pytest.fixture
+def env():
+    return create_env_with_context(CONTEXT)
+
+
+@pytest.fixture
+def memo(repo: Repository, tmpdir, monkeypatch) -> RenderMemo:
+    monkeypatch.chdir(str(tmpdir))
+    memo = RenderMemo(repo)
+    assert memo.prepare(CONTEXT)
+    return memo
+
+
+def _write(name: str, content: str):
+    with open(name, 'w') as f:
+        f.write(content)
+
+
+@pytest.mark.parametrize('source,keys', [
+    ('plain text', set()),
+    ('{{ cookiecutter.name }} {{ cookiecutter["other"] }}', {'name', 'other'}),
+    ('{% for n in range(3) %}{{ cookiecutter.name | upper }}{% endfor %}', {'name'}),
+    ('{{ cookiecutter | jsonify }}', None),
+    ('{% for k, v in cookiecutter.items() %}{{ k }}{% endfor %}', None)
+])
+def test_context_keys(env, source: str, keys):
+    assert _context_keys(env.parse(source)) == keys
+
+
+@pytest.mark.parametrize('source', [
+    '{% include "other.txt" %}',
+    '{% now "utc" %}',
+    '{{ random_ascii_string(8) }}',
+    '{{ uuid4() }}',
+    '{{ [1, 2] | random }}'
+])
+def test_context_keys_unmemoizable(env, source: str):
+    with pytest.raises(_Unmemoizable):
+        _context_keys(env.parse(source))
+
+
+def test_key(memo: RenderMemo, env):
+    _write('file.txt', '{{ cookiecutter.name }}')
+    key = memo.key('file.txt', CONTEXT, env)
+
+    assert key == memo.key('file.txt', CONTEXT, env)
+    # Only the values the file renders matter.
+    other = {'cookiecutter': dict(CONTEXT['cookiecutter'], other='changed')}
+    assert memo.key('file.txt', other, env) == key
+    changed = {'cookiecutter': dict(CONTEXT['cookiecutter'], name='changed')}
+    assert memo.key('file.txt', changed, env) != key
+
+    _write('file.txt', '{{ cookiecutter.name }}!')
+    assert memo.key('file.txt', CONTEXT, env) != key
+
+
+@pytest.mark.parametrize('name,value', [
+    ('_new_lines', '\r\n'),
+    ('_jinja2_env_vars', {'trim_blocks': True}),
+    ('_extensions', ['cookiecutter.extensions.SlugifyExtension'])
+])
+def test_key_includes_environment(memo: RenderMemo, env, name: str, value: Any):
+    _write('file.txt', '{% if cookiecutter.name %}\n{{ cookiecutter.name }}{% endif %}')
+    key = memo.key('file.txt', CONTEXT, env)
+
+    configured = {'cookiecutter': dict(CONTEXT['cookiecutter'], **{name: value})}
+    assert memo.key('file.txt', configured, env) != key
+
+
+def test_key_unmemoizable(memo: RenderMemo, env):
+    _write('.gitignore', '*.log')
+    _write('now.txt', '{% now "utc" %}')
+
+    assert memo.key('.gitignore', CONTEXT, env) is None
+    assert memo.key('now.txt', CONTEXT, env) is None
+
+
+def test_prepare_rejects_unknown_extensions(memo: RenderMemo):
+    assert not memo.prepare({'cookiecutter': {'_extensions': ['local_extensions.Filters']}})
+
+
+def test_reuse_and_record(repo: Repository, memo: RenderMemo, env):
+    _write('file.txt', '{{ cookiecutter.name }}')
+    assert not memo.reuse('file.txt', 'rendered.txt', CONTEXT, env)
+
+    blob = repo.create_blob(b'project')
+    builder = repo.TreeBuilder()
+    builder.insert('rendered.txt', blob, 0o100644)
+    memo.record(builder.write())
+
+    memo = RenderMemo(repo)
+    memo.prepare(CONTEXT)
+    assert memo.reuse('file.txt', 'rendered.txt', CONTEXT, env)
+    assert memo.hits == {'rendered.txt': (blob, 0o100644)}
+    assert not memo.misses
+
+
+def test_reuse_skips_parsing_known_sources(repo: Repository, memo: RenderMemo, env):
+    _write('file.txt', '{{ cookiecutter.name }}')
+    memo.reuse('file.txt', 'rendered.txt', CONTEXT, env)
+    builder = repo.TreeBuilder()
+    builder.insert('rendered.txt', repo.create_blob(b'project'), 0o100644)
+    memo.record(builder.write())
+
+    memo = RenderMemo(repo)
+    memo.prepare(CONTEXT)
+    with patch.object(env, 'parse') as parse:
+        assert memo.reuse('file.txt', 'rendered.txt', CONTEXT, env)
+    parse.assert_not_called()
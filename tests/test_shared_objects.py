@@ -0,0 +1,60 @@
+import os
+import subprocess
+import pytest
+from pygit2 import Repository
+from battenberg.shared_objects import TREE_REF_PREFIX, SharedObjectStore
+from battenberg.utils import create_tree_from_directory
+
+
+URL = 'https://example.com/template.git'
+
+
+@pytest.fixture
+def shared_objects(tmpdir) -> SharedObjectStore:
+    return SharedObjectStore(str(tmpdir.join('objects')))
+
+
+@pytest.fixture
+def rendered(tmpdir) -> str:
+    path = tmpdir.join('rendered')
+    path.join('file.txt').write('content', ensure=True)
+    path.join('.gitignore').write('*.log')
+    path.join('ignored.log').write('ignored')
+    return str(path)
+
+
+def test_write_tree(shared_objects: SharedObjectStore, repo: Repository, rendered: str):
+    tree = shared_objects.write_tree(repo, URL, rendered)
+
+    store = Repository(shared_objects.store_path(URL))
+    assert store.is_bare
+    assert store.references[f'{TREE_REF_PREFIX}{tree}'].target == tree
+    assert sorted(entry.name for entry in repo[tree]) == ['.gitignore', 'file.txt']
+    # Nothing is written into the repository's own object database.
+    assert not os.path.exists(os.path.join(repo.path, 'objects', str(tree)[:2], str(tree)[2:]))
+    # The same tree as writing it into the repository itself.
+    assert tree == create_tree_from_directory(repo, rendered)
+
+
+def test_attach_survives_reopening(shared_objects: SharedObjectStore, repo: Repository,
+                                   rendered: str):
+    tree = shared_objects.write_tree(repo, URL, rendered)
+    shared_objects.attach(repo, URL)
+
+    with open(os.path.join(repo.path, 'objects', 'info', 'alternates')) as f:
+        assert f.read().splitlines() == [
+            os.path.join(shared_objects.store_path(URL), 'objects')]
+    assert tree in Repository(repo.path)
+    # Git itself borrows the objects too.
+    subprocess.run(['git', 'cat-file', '-e', str(tree)], cwd=repo.workdir, check=True)
+
+
+def test_write_tree_copies_reused_blobs(shared_objects: SharedObjectStore, repo: Repository,
+                                        rendered: str):
+    blob = repo.create_blob(b'reused')
+
+    tree = shared_objects.write_tree(repo, URL, rendered, {'reused.txt': (blob, 0o100644)})
+
+    store = Repository(shared_objects.store_path(URL))
+    assert blob in store
+    assert store[tree]['reused.txt'].id == blob
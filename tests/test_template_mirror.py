@@ -0,0 +1,62 @@
+import os
+import subprocess
+import pytest
+from pygit2 import Repository
+from battenberg.template_mirror import TemplateMirror
+
+
+@pytest.fixture
+def template_mirror(tmpdir) -> TemplateMirror:
+    return TemplateMirror(str(tmpdir.join('mirrors')))
+
+
+def test_update_creates_mirror(template_mirror: TemplateMirror, template_repo: Repository,
+                               template_url: str):
+    commit = template_mirror.update(template_url)
+
+    assert commit == template_repo.references['refs/heads/main'].target
+    mirror = Repository(template_mirror.mirror_path(template_url))
+    assert mirror.is_bare
+    assert mirror.references['HEAD'].target == 'refs/heads/main'
+    assert template_mirror.update(template_url, 'upgrade') == \
+        template_repo.references['refs/heads/upgrade'].target
+
+
+def test_update_fetches_new_commits(template_mirror: TemplateMirror, template_repo: Repository,
+                                    template_url: str):
+    template_mirror.update(template_url)
+    template_repo.branches.local.create('new', template_repo[template_repo.head.target])
+
+    # Each instance only fetches a template once.
+    assert template_mirror.update(template_url, 'new') is None
+    assert TemplateMirror(template_mirror.path).update(template_url, 'new') == \
+        template_repo.head.target
+
+
+def test_update_offline_skips_fetch(template_mirror: TemplateMirror, template_url: str):
+    commit = TemplateMirror(template_mirror.path).update(template_url)
+    offline = TemplateMirror(template_mirror.path, offline=True)
+
+    with pytest.MonkeyPatch.context() as m:
+        m.setattr(offline, '_fetch', lambda *args: pytest.fail('Should not fetch'))
+        assert offline.update(template_url) == commit
+
+
+def test_resolve_without_mirror(template_mirror: TemplateMirror, template_url: str):
+    assert template_mirror.resolve(template_url) is None
+
+
+def test_redirect(template_mirror: TemplateMirror, template_url: str, tmpdir):
+    template_mirror.update(template_url)
+    os.environ.pop('GIT_CONFIG_COUNT', None)
+
+    with template_mirror.redirect(template_url) as mirror_path:
+        assert os.environ['GIT_CONFIG_KEY_0'] == f'url.{mirror_path}.insteadOf'
+        completed_process = subprocess.run(
+            ['git', 'ls-remote', '--get-url', template_url],
+            stdout=subprocess.PIPE, encoding='utf-8', cwd=str(tmpdir)
+        )
+        assert completed_process.stdout.strip() == mirror_path
+
+    assert 'GIT_CONFIG_COUNT' not in os.environ
+    assert 'GIT_CONFIG_KEY_0' not in os.environ
@@ -1,7 +1,8 @@
 import os
-from unittest.mock import patch
+import shutil
+from unittest.mock import ANY, patch
 import pytest
-from battenberg.temporary_worktree import TemporaryWorktree
+from battenberg.temporary_worktree import PersistentWorktree, TemporaryWorktree
 from battenberg.errors import (
     RepositoryEmptyException,
     WorktreeConflictException,
@@ -49,7 +50,9 @@ def test_raises_worktree_error(mkdtemp, repo, worktree_name, worktree_path):
                 pass
         
         add_worktree.assert_called_once_with(worktree_name,
-                                             os.path.join(worktree_path, worktree_name))
+                                             os.path.join(worktree_path, worktree_name), ANY)
+    # The branch created for the empty worktree is cleaned up.
+    assert worktree_name not in repo.listall_branches()
 
 
 @pytest.mark.parametrize('empty,dir_contents', (
@@ -66,3 +69,93 @@ def test_initializes_empty_worktree(repo, worktree_name, empty, dir_contents):
         # and immediately empties it in the same function. Some work todo here to make
         # this a little cleaner in the future I think.
         assert set(os.listdir(tmp_worktree.path)) == dir_contents
+
+
+def test_empty_worktree_checks_out_nothing(repo, worktree_name):
+    head_ids = []
+    for _ in range(2):
+        with TemporaryWorktree(repo, worktree_name) as tmp_worktree:
+            assert len(tmp_worktree.repo.index) == 0
+            assert len(tmp_worktree.repo[tmp_worktree.repo.head.target].tree) == 0
+            head_ids.append(tmp_worktree.repo.head.target)
+
+    # The empty commit is deterministic so repeated runs don't accumulate objects.
+    assert head_ids[0] == head_ids[1]
+    assert worktree_name not in repo.listall_branches()
+
+
+def test_persistent_worktree_is_reused(repo, worktree_name, worktree_path):
+    with PersistentWorktree(repo, worktree_name, worktree_path) as worktree:
+        assert set(os.listdir(worktree.path)) == {'.git'}
+        with open(os.path.join(worktree.path, 'rendered.txt'), 'w') as f:
+            f.write('rendered')
+        worktree.repo.set_head('refs/heads/master')
+
+    assert worktree_name in repo.list_worktrees()
+    # The worktree releases whichever branch it had checked out.
+    assert worktree.repo.head.name == f'refs/heads/{worktree_name}'
+
+    with patch.object(repo, 'add_worktree') as add_worktree:
+        with PersistentWorktree(repo, worktree_name, worktree_path) as worktree:
+            assert set(os.listdir(worktree.path)) == {'.git'}
+        add_worktree.assert_not_called()
+
+
+def test_persistent_worktree_recovers_deleted_directory(repo, worktree_name, worktree_path):
+    with PersistentWorktree(repo, worktree_name, worktree_path):
+        pass
+    shutil.rmtree(worktree_path)
+
+    with PersistentWorktree(repo, worktree_name, worktree_path) as worktree:
+        assert set(os.listdir(worktree.path)) == {'.git'}
+    assert worktree_name in repo.list_worktrees()
+
+
+def test_persistent_worktree_recovers_unregistered_directory(repo, worktree_name, worktree_path):
+    os.makedirs(worktree_path)
+    with open(os.path.join(worktree_path, 'stale.txt'), 'w') as f:
+        f.write('stale')
+
+    with PersistentWorktree(repo, worktree_name, worktree_path) as worktree:
+        assert set(os.listdir(worktree.path)) == {'.git'}
+
+
+def test_persistent_worktree_removes_stale_index_lock(repo, worktree_name, worktree_path):
+    with PersistentWorktree(repo, worktree_name, worktree_path):
+        pass
+    lock_path = os.path.join(repo.path, 'worktrees', worktree_name, 'index.lock')
+    open(lock_path, 'w').close()
+
+    with PersistentWorktree(repo, worktree_name, worktree_path) as worktree:
+        worktree.repo.index.add_all()
+        worktree.repo.index.write()
+    assert not os.path.exists(lock_path)
+
+
+def test_persistent_worktree_remove(repo, worktree_name, worktree_path):
+    worktree = PersistentWorktree(repo, worktree_name, worktree_path)
+    with worktree:
+        pass
+
+    worktree.remove()
+
+    assert worktree_name not in repo.list_worktrees()
+    assert worktree_name not in repo.listall_branches()
+    assert not os.path.exists(worktree_path)
+
+
+def test_removes_branch_while_other_worktrees_change(repo, worktree_name, worktree_path):
+    with TemporaryWorktree(repo, worktree_name):
+        # Another run's worktree metadata caught halfway, its HEAD still naming our branch.
+        other = os.path.join(repo.path, 'worktrees', 'other')
+        os.makedirs(other)
+        for name, content in (('HEAD', f'ref: refs/heads/{worktree_name}'),
+                              ('commondir', '../..'),
+                              ('gitdir', os.path.join(worktree_path, '.git'))):
+            with open(os.path.join(other, name), 'w') as f:
+                f.write(f'{content}\n')
+        os.makedirs(worktree_path)
+        with open(os.path.join(worktree_path, '.git'), 'w') as f:
+            f.write(f'gitdir: {other}\n')
+
+    assert worktree_name not in repo.listall_branches()
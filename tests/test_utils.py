@@ -1,8 +1,31 @@
 import os
+import shutil
+import threading
 from unittest.mock import Mock, patch
 import pytest
 from battenberg.errors import InvalidRepositoryException
-from battenberg.utils import open_repository, open_or_init_repository, construct_keypair
+import pygit2
+from battenberg.utils import (
+    copy_tree_objects,
+    open_repository,
+    open_or_init_repository,
+    remote_default_branch,
+    repository_lock,
+    construct_keypair,
+    create_tree_from_directory,
+    describe_conflicts,
+    is_same_render,
+    link_tree,
+    list_files,
+    resolve_remote_commit,
+    stage_paths
+)
+
+
+@pytest.fixture(autouse=True)
+def default_branches():
+    with patch.dict('battenberg.utils._default_branches', clear=True):
+        yield
 
 
 @pytest.fixture
@@ -80,11 +103,15 @@ def test_open_or_init_repository_initializes_repo(init_repository: Mock, Reposit
     )
 
 
-@patch('battenberg.utils.subprocess')
-def test_open_or_init_repository_initializes_repo_with_inferred_initial_branch(subprocess: Mock,
-        init_repository: Mock, Repository: Mock, discover_repository: Mock):
-    initial_branch = 'refs/heads/main'
-    subprocess.run.return_value.stdout = f'ref: {initial_branch}    HEAD'
+@patch('battenberg.utils.list_remote_refs')
+def test_open_or_init_repository_initializes_repo_with_inferred_initial_branch(
+        list_remote_refs: Mock, init_repository: Mock, Repository: Mock,
+        discover_repository: Mock):
+    initial_branch = 'refs/heads/release/v1'
+    list_remote_refs.return_value = [
+        {'name': 'HEAD', 'oid': 'head-oid', 'symref_target': initial_branch},
+        {'name': initial_branch, 'oid': 'head-oid', 'symref_target': None}
+    ]
     discover_repository.side_effect = Exception('No repo found')
 
     path = 'test-path'
@@ -92,19 +119,61 @@ def test_open_or_init_repository_initializes_repo_with_inferred_initial_branch(s
     repo = init_repository.return_value
     assert open_or_init_repository(path, template) == repo
     repo.references['HEAD'].set_target.assert_called_once_with(initial_branch)
+    list_remote_refs.assert_called_once_with(repo, template)
 
 
-@pytest.mark.parametrize('stdout', ('', 'invalid-symref'))
-@patch('battenberg.utils.subprocess')
-def test_open_or_init_repository_initializes_repo_with_invalid_remote_branches(subprocess: Mock,
-        init_repository: Mock, Repository: Mock, discover_repository: Mock, stdout: str):
-    subprocess.run.return_value.stdout = stdout
+@pytest.mark.parametrize('refs', (
+    [],
+    [{'name': 'HEAD', 'oid': 'head-oid', 'symref_target': None}],
+    pygit2.GitError('unreachable')
+))
+@patch('battenberg.utils.list_remote_refs')
+def test_open_or_init_repository_initializes_repo_with_invalid_remote_branches(
+        list_remote_refs: Mock, init_repository: Mock, Repository: Mock,
+        discover_repository: Mock, refs):
+    list_remote_refs.side_effect = refs if isinstance(refs, Exception) else [refs]
     discover_repository.side_effect = Exception('No repo found')
 
     path = 'test-path'
     template = 'test-template'
     repo = init_repository.return_value
     assert open_or_init_repository(path, template) == repo
+    repo.references['HEAD'].set_target.assert_not_called()
+
+
+@patch('battenberg.utils.list_remote_refs')
+def test_remote_default_branch_is_cached(list_remote_refs: Mock, monkeypatch):
+    list_remote_refs.return_value = [
+        {'name': 'HEAD', 'oid': 'head-oid', 'symref_target': 'refs/heads/main'}]
+    repo = Mock()
+
+    assert remote_default_branch(repo, 'test-template') == 'refs/heads/main'
+    assert remote_default_branch(repo, 'test-template') == 'refs/heads/main'
+    list_remote_refs.assert_called_once_with(repo, 'test-template')
+
+    # The branch is looked up again once it expires.
+    monkeypatch.setattr('battenberg.utils.DEFAULT_BRANCH_TTL', 0)
+    assert remote_default_branch(repo, 'test-template') == 'refs/heads/main'
+    assert list_remote_refs.call_count == 2
+
+
+@patch('battenberg.utils.list_remote_refs')
+def test_remote_default_branch_from_mirror(list_remote_refs: Mock, tmpdir):
+    mirror_path = str(tmpdir.join('mirror.git'))
+    mirror = pygit2.init_repository(mirror_path, bare=True)
+    repo = Mock()
+
+    # Mirrors which haven't been fetched yet don't know the default branch.
+    list_remote_refs.return_value = []
+    assert remote_default_branch(repo, 'unfetched-template', mirror_path) is None
+    list_remote_refs.assert_called_once()
+
+    tree = mirror.TreeBuilder().write()
+    mirror.create_commit('refs/heads/trunk', mirror.default_signature,
+                         mirror.default_signature, 'Initial commit', tree, [])
+    mirror.references['HEAD'].set_target('refs/heads/trunk')
+    assert remote_default_branch(repo, 'test-template', mirror_path) == 'refs/heads/trunk'
+    list_remote_refs.assert_called_once()
 
 
 def test_construct_keypair_defaults(Keypair: Mock):
@@ -120,3 +189,207 @@ def test_construct_keypair(Keypair: Mock):
     passphrase = 'test-passphrase'
     construct_keypair(public_key_path, private_key_path, passphrase)
     Keypair.assert_called_once_with('git', public_key_path, private_key_path, passphrase)
+
+
+@pytest.mark.parametrize('checkout,expected', (
+    (None, 'head-oid'),
+    ('main', 'main-oid'),
+    ('v1', 'peeled-oid'),
+    ('missing', None),
+    ('a' * 40, 'a' * 40),
+))
+@patch('battenberg.utils.list_remote_refs')
+def test_resolve_remote_commit(list_remote_refs: Mock, checkout: str, expected: str):
+    list_remote_refs.return_value = [
+        {'name': 'HEAD', 'oid': 'head-oid', 'symref_target': 'refs/heads/main'},
+        {'name': 'refs/heads/main', 'oid': 'main-oid', 'symref_target': None},
+        {'name': 'refs/tags/v1', 'oid': 'tag-oid', 'symref_target': None},
+        {'name': 'refs/tags/v1^{}', 'oid': 'peeled-oid', 'symref_target': None},
+    ]
+    assert resolve_remote_commit(Mock(), 'test-template', checkout) == expected
+
+
+def test_create_tree_from_directory(repo, tmpdir):
+    path = str(tmpdir.join('rendered'))
+    os.makedirs(os.path.join(path, 'nested'))
+    os.makedirs(os.path.join(path, 'empty'))
+    os.makedirs(os.path.join(path, 'ignored-dir'))
+    for name, content in (('.gitignore', '*.log\nignored-dir/\n'), ('nested/file.txt', 'a'),
+                          ('debug.log', 'b'), ('ignored-dir/file.txt', 'c'), ('run.sh', 'd')):
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(content)
+    os.chmod(os.path.join(path, 'run.sh'), 0o755)
+    os.symlink('nested/file.txt', os.path.join(path, 'link'))
+
+    tree = repo[create_tree_from_directory(repo, path)]
+
+    assert {entry.name for entry in tree} == {'.gitignore', 'nested', 'run.sh', 'link'}
+    assert tree['nested/file.txt'].data == b'a'
+    assert tree['run.sh'].filemode == 0o100755
+    assert tree['link'].filemode == 0o120000
+    assert tree['link'].data == b'nested/file.txt'
+    # The repository's own working directory must not be affected.
+    assert repo.workdir != path
+
+
+def test_create_tree_from_directory_matches_index(repo, tmpdir):
+    shutil.copytree(os.path.join(os.path.dirname(__file__), 'data', 'template'),
+                    repo.workdir, dirs_exist_ok=True)
+    repo.index.add_all()
+
+    assert create_tree_from_directory(repo, repo.workdir) == repo.index.write_tree()
+
+
+def test_link_tree(tmpdir):
+    src = str(tmpdir.join('src'))
+    dst = str(tmpdir.join('dst'))
+    os.makedirs(os.path.join(src, 'nested'))
+    with open(os.path.join(src, 'nested', 'file.txt'), 'w') as f:
+        f.write('a')
+    os.symlink('nested/file.txt', os.path.join(src, 'link'))
+
+    link_tree(src, dst)
+
+    assert os.path.samefile(os.path.join(src, 'nested', 'file.txt'),
+                            os.path.join(dst, 'nested', 'file.txt'))
+    assert os.readlink(os.path.join(dst, 'link')) == 'nested/file.txt'
+
+
+def test_link_tree_falls_back_to_copying(tmpdir):
+    src = str(tmpdir.join('src'))
+    dst = str(tmpdir.join('dst'))
+    os.makedirs(src)
+    with open(os.path.join(src, 'file.txt'), 'w') as f:
+        f.write('a')
+
+    with patch('battenberg.utils.os.link', side_effect=OSError):
+        link_tree(src, dst)
+
+    assert not os.path.samefile(os.path.join(src, 'file.txt'), os.path.join(dst, 'file.txt'))
+    with open(os.path.join(dst, 'file.txt')) as f:
+        assert f.read() == 'a'
+
+
+def test_copy_tree_objects(repo, tmpdir):
+    shutil.copytree(os.path.join(os.path.dirname(__file__), 'data', 'template'),
+                    str(tmpdir.join('rendered')))
+    tree = create_tree_from_directory(repo, str(tmpdir.join('rendered')))
+    target = pygit2.init_repository(str(tmpdir.join('target')), bare=True)
+
+    copy_tree_objects(repo, target, tree)
+
+    assert tree in target
+    for entry in repo[tree]:
+        assert entry.id in target
+    # Copying again is a no-op.
+    copy_tree_objects(repo, target, tree)
+
+
+def _render_tree(repo, tmpdir, name, files):
+    for path, content in files.items():
+        tmpdir.join(name, path).write(content, ensure=True)
+    return create_tree_from_directory(repo, str(tmpdir.join(name)))
+
+
+CONTEXT_JSON = '{\n  "name": "a",\n  "_output_dir": "/tmp/a"\n}\n'
+
+
+@pytest.mark.parametrize('files,same', (
+    ({'.cookiecutter.json': CONTEXT_JSON.replace('/tmp/a', '/tmp/b')}, True),
+    ({'.cookiecutter.json': CONTEXT_JSON.replace('"a"', '"b"')}, False),
+    # Only the output directory of the context file itself is ignored.
+    ({'.cookiecutter.json': CONTEXT_JSON.replace('  ', '    ')}, False),
+    ({'other.json': CONTEXT_JSON.replace('/tmp/a', '/tmp/b')}, False),
+    ({'VERSION': '1.0\n'}, False),
+    ({'package.json': '{\n    "a": 1\n}\n'}, False),
+    ({'new.txt': ''}, False)
+))
+def test_is_same_render(repo, tmpdir, files, same):
+    rendered = {'.cookiecutter.json': CONTEXT_JSON, 'other.json': CONTEXT_JSON,
+                'VERSION': '1\n', 'package.json': '{"a": 1}\n'}
+    tree = _render_tree(repo, tmpdir, 'a', rendered)
+    other = _render_tree(repo, tmpdir, 'b', dict(rendered, **files))
+
+    assert is_same_render(repo, tree, other) == same
+    assert is_same_render(repo, tree, tree)
+
+
+def test_describe_conflicts():
+    def entry(path: str, oid: str) -> Mock:
+        return Mock(path=path, id=oid)
+
+    index = Mock(conflicts=[
+        (entry('modified', 'a'), entry('modified', 'b'), entry('modified', 'c')),
+        (None, entry('added', 'b'), entry('added', 'c')),
+        (entry('deleted-ours', 'a'), None, entry('deleted-ours', 'c')),
+        (entry('deleted-theirs', 'a'), entry('deleted-theirs', 'b'), None),
+    ])
+
+    assert [(c['path'], c['type'], c['ancestor'], c['ours'], c['theirs'])
+            for c in describe_conflicts(index)] == [
+        ('added', 'both-added', None, 'b', 'c'),
+        ('deleted-ours', 'deleted-by-us', 'a', None, 'c'),
+        ('deleted-theirs', 'deleted-by-them', 'a', 'b', None),
+        ('modified', 'both-modified', 'a', 'b', 'c'),
+    ]
+    assert describe_conflicts(Mock(conflicts=None)) == []
+
+
+def test_list_files(tmpdir):
+    path = str(tmpdir)
+    os.makedirs(os.path.join(path, 'nested', '.git'))
+    os.makedirs(os.path.join(path, 'empty'))
+    for name in ('file.txt', 'nested/file.txt', 'nested/.git/HEAD'):
+        with open(os.path.join(path, name), 'w') as f:
+            f.write('a')
+    os.symlink('nested', os.path.join(path, 'link'))
+
+    assert sorted(list_files(path)) == ['file.txt', 'link', 'nested/file.txt']
+
+
+def test_stage_paths_matches_add_all(repo):
+    shutil.copytree(os.path.join(os.path.dirname(__file__), 'data', 'template'),
+                    repo.workdir, dirs_exist_ok=True)
+    with open(os.path.join(repo.workdir, 'hello.txt'), 'a') as f:
+        f.write('modified')
+    repo.index.add_all()
+
+    assert stage_paths(repo, list_files(repo.workdir)) == repo.index.write_tree()
+
+
+def test_stage_paths(repo):
+    head = repo[repo.head.target].tree
+    with open(os.path.join(repo.path, 'info', 'exclude'), 'a') as f:
+        f.write('\n*.log\n')
+    for name, content in (('new.txt', 'a'), ('debug.log', 'b')):
+        with open(os.path.join(repo.workdir, name), 'w') as f:
+            f.write(content)
+
+    with patch.object(pygit2.Index, 'add', autospec=True, side_effect=pygit2.Index.add) as add:
+        tree = repo[stage_paths(repo, ['hello.txt', 'new.txt', 'debug.log'])]
+
+    # Files of HEAD which weren't rendered are removed and ignored files are skipped.
+    assert {entry.name for entry in tree} == {'hello.txt', 'new.txt'}
+    assert tree['hello.txt'].id == head['hello.txt'].id
+    # Only new or modified files are hashed and added to the index again.
+    assert [call.args[1] for call in add.call_args_list] == ['new.txt']
+    # The index is written so the worktree's status reflects what was staged.
+    repo.index.read()
+    assert repo.index.write_tree() == tree.id
+
+
+def test_repository_lock(repo: pygit2.Repository):
+    acquired = threading.Event()
+
+    def acquire():
+        with repository_lock(repo, 'test-lock'):
+            acquired.set()
+
+    with repository_lock(repo, 'test-lock'):
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        assert not acquired.wait(0.2)
+    thread.join(5)
+
+    assert acquired.is_set()
+    assert os.path.exists(os.path.join(repo.path, 'battenberg', 'test-lock.lock'))